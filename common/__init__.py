@@ -0,0 +1 @@
+# 複数の週の課題で共有するモジュール
@@ -0,0 +1,47 @@
+import struct
+import zipfile
+
+import numpy as np
+
+
+# 空間ハッシュのセルの座標 cells (..., 3) を、大きさ tableSize (2 のべき乗) の表の番号にする
+def getCellKeys(cells, tableSize):
+    h = (
+        (cells[..., 0] * 73856093)
+        ^ (cells[..., 1] * 19349663)
+        ^ (cells[..., 2] * 83492791)
+    )
+    return h & (tableSize - 1)
+
+
+# np.savez で圧縮せずに保存した .npz を読み込み、名前から配列への辞書を返す
+# 各配列はファイルに割り当てた読み取り専用の np.memmap にする
+# (.npz の中の .npy は圧縮していないので、ファイル内の位置を求めれば直接割り当てられる)
+def loadMappedNpz(path):
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} is compressed and cannot be mapped")
+            # ローカルファイルヘッダ (30 バイト + ファイル名 + 拡張フィールド) の後に .npy がある
+            f.seek(info.header_offset + 26)
+            nameLength, extraLength = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + nameLength + extraLength)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+            if 0 in shape:
+                # 大きさ 0 の配列はファイルに割り当てられない
+                arrays[info.filename.removesuffix(".npy")] = np.empty(shape, dtype)
+                continue
+            arrays[info.filename.removesuffix(".npy")] = np.memmap(
+                f,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortranOrder else "C",
+            )
+    return arrays
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+# 曲線の区間ごとの計算結果 (折れ線の頂点など) のキャッシュ
+# 区間 i は制御点 stride * i から 4 個だけに依存するので、制御点が変わったときは
+# 変わった制御点を使う区間だけを計算し直す (末尾への追加・削除なら最後の数区間だけ)
+# 区間ごとの結果は、種類ごとに1つのバッファに区間の順に並べておき、まとめて描画できるようにする
+class CurveCache:
+    def __init__(self, evaluate, stride, num_arrays=1, width=2):
+        # evaluate(first, segments) は区間 first 以降の制御点 (segments, 4, width) から、
+        # 区間ごとに num_arrays 個の (頂点数, 2) の配列のタプルを並べたリストを返す
+        self.evaluate = evaluate
+        self.stride = stride  # 隣の区間との制御点のずれ
+        self.width = width  # 制御点1つあたりの値の数 (座標以外に重みなども比べられる)
+        self.buffers = [np.empty((0, 2)) for _ in range(num_arrays)]
+        self.invalidate()
+
+    # 全ての区間を計算し直すようにする (制御点以外のパラメータが変わったとき)
+    def invalidate(self):
+        self.points = np.empty((0, self.width))  # 前回の制御点
+        self.starts = []  # 区間ごとの、各バッファでの開始位置
+        self.counts = [0] * len(self.buffers)  # 各バッファの使っている頂点数
+        self.evaluated = 0  # これまでに計算した区間の数
+
+    # 制御点 control_points に合わせて変わった区間だけを計算し直し、各バッファの使っている部分を返す
+    # 返す配列はバッファのビューなので、次に update を呼ぶと書き換わることがある
+    def update(self, control_points):
+        points = np.asarray(control_points, dtype=np.float64).reshape(-1, self.width)
+        n = min(len(points), len(self.points))
+        changed = np.flatnonzero((points[:n] != self.points[:n]).any(axis=1))
+        # 最初に変わった (か増えた) 制御点
+        first = changed[0] if len(changed) > 0 else n
+        num_segments = max((len(points) - 4) // self.stride + 1, 0)
+
+        # 区間 i は制御点 stride * i + 3 までを使うので、それが first より前なら計算し直さなくてよい
+        keep = max(-(-(first - 3) // self.stride), 0)
+        keep = min(keep, len(self.starts), num_segments)
+        if keep < len(self.starts):
+            self.counts = list(self.starts[keep])
+            del self.starts[keep:]
+
+        if keep < num_segments:
+            index = self.stride * np.arange(keep, num_segments)[:, None] + np.arange(4)
+            for results in self.evaluate(keep, points[index]):
+                self.starts.append(tuple(self.counts))
+                for k, values in enumerate(results):
+                    self.append(k, values)
+            self.evaluated += num_segments - keep
+        self.points = points.copy()
+        return tuple(b[:c] for b, c in zip(self.buffers, self.counts))
+
+    # バッファ k の末尾に頂点 values を追加する (足りなければ容量を倍にする)
+    def append(self, k, values):
+        buffer, count = self.buffers[k], self.counts[k]
+        if count + len(values) > len(buffer):
+            grown = np.empty((max(2 * len(buffer), count + len(values), 256), 2))
+            grown[:count] = buffer[:count]
+            self.buffers[k] = buffer = grown
+        buffer[count : count + len(values)] = values
+        self.counts[k] = count + len(values)
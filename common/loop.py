@@ -0,0 +1,156 @@
+import contextlib
+import csv
+import time
+from collections import deque
+
+from OpenGL.GL import *
+from OpenGL.GLU import *
+from OpenGL.GLUT import *
+
+
+# フレームの統計の CSV の出力先 path を開く。with 文で使い、path が None なら None になる
+# (GLUT のループを with 文の中で回し、ファイルを開いたままにする)
+def openTrace(path):
+    if path is None:
+        return contextlib.nullcontext()
+    return open(path, "w", newline="", buffering=1)
+
+
+# 固定時間刻みのシミュレーションループ
+# 経過した実時間を貯めておき (アキュムレータ)、step 秒ずつ update(step) を呼んで進めてから描画する
+# 1フレームで maxSubsteps 回進めても追いつかないときは、描画を飛ばして次のフレームで追いつく
+# 描画を maxFrameSkip 回続けて飛ばしたら、残りの遅れを捨てて描画する
+# 直近 window フレームの統計 (シミュレーションと描画の時間、fps、1フレームあたりのステップ数) を
+# 画面に重ねて表示したり、traceFile (openTrace で開いたファイル) に CSV で書き出したりできる
+class FixedStepLoop:
+    def __init__(
+        self,
+        update,
+        step=0.01,
+        maxSubsteps=8,
+        maxFrameSkip=4,
+        intervalMsec=10,
+        window=60,
+        traceFile=None,
+    ):
+        self.update = update  # シミュレーションを step 秒進める関数
+        self.step = step  # シミュレーションの時間刻み [秒]
+        self.maxSubsteps = maxSubsteps  # 1フレームで進める最大のステップ数
+        self.maxFrameSkip = maxFrameSkip  # 続けて飛ばしてよい描画の数
+        self.intervalMsec = intervalMsec  # タイマーの呼び出し間隔 [ミリ秒]
+        self.accumulator = 0.0  # まだシミュレーションしていない実時間 [秒]
+        self.lastTime = None
+        self.skippedFrames = 0  # 続けて飛ばした描画の数
+        self.drawMsec = 0.0  # 最後の描画にかかった時間 [ミリ秒]
+        self.ticks = deque(
+            maxlen=window
+        )  # (時刻, シミュレーション時間, ステップ数, 描画したか)
+        self.draws = deque(maxlen=window)  # 描画にかかった時間
+        self.showOverlay = False  # 統計を画面に重ねて表示するかどうか
+        self.trace = None
+        if traceFile is not None:
+            self.trace = csv.writer(traceFile)
+            self.trace.writerow(
+                ["time", "substeps", "sim_ms", "draw_ms", "rendered", "lag_ms"]
+            )
+
+    # ループを開始する
+    def start(self):
+        glutTimerFunc(0, self.tick, 0)
+
+    # タイマーから呼ばれ、貯まった時間の分だけシミュレーションを進める
+    def tick(self, value):
+        now = time.perf_counter()
+        if self.lastTime is not None:
+            self.accumulator += now - self.lastTime
+        self.lastTime = now
+
+        substeps = 0
+        while self.accumulator >= self.step and substeps < self.maxSubsteps:
+            self.update(self.step)
+            self.accumulator -= self.step
+            substeps += 1
+        simMsec = (time.perf_counter() - now) * 1000.0
+
+        rendered = substeps > 0  # 進めていなければ描き直さない
+        if self.accumulator >= self.step:  # 追いついていない
+            if self.skippedFrames < self.maxFrameSkip:
+                rendered = False
+            else:
+                self.accumulator %= self.step  # 遅れを捨てる
+        if rendered:
+            self.skippedFrames = 0
+            glutPostRedisplay()
+        elif substeps > 0:
+            self.skippedFrames += 1
+
+        self.ticks.append((now, simMsec, substeps, rendered))
+        if self.trace is not None:
+            self.trace.writerow(
+                [
+                    f"{now:.6f}",
+                    substeps,
+                    f"{simMsec:.3f}",
+                    f"{self.drawMsec:.3f}",
+                    int(rendered),
+                    f"{self.accumulator * 1000.0:.3f}",
+                ]
+            )
+        glutTimerFunc(self.intervalMsec, self.tick, value)
+
+    # 描画関数 display を、かかった時間を測る関数にして返す
+    def wrapDisplay(self, display):
+        def timedDisplay():
+            start = time.perf_counter()
+            display()
+            self.drawMsec = (time.perf_counter() - start) * 1000.0
+            self.draws.append(self.drawMsec)
+
+        return timedDisplay
+
+    # 直近のフレームの統計を辞書で返す
+    def getStats(self):
+        ticks = list(self.ticks)
+        frames = sum(1 for t in ticks if t[3])
+        elapsed = ticks[-1][0] - ticks[0][0] if len(ticks) > 1 else 0.0
+        return {
+            "sim_ms": sum(t[1] for t in ticks) / max(len(ticks), 1),
+            "draw_ms": sum(self.draws) / max(len(self.draws), 1),
+            "fps": (frames - 1) / elapsed if elapsed > 0 and frames > 1 else 0.0,
+            "substeps": sum(t[2] for t in ticks) / max(frames, 1),
+        }
+
+    # 統計を画面の左上に color の文字で表示する。display の中で glutSwapBuffers の前に呼ぶ
+    def drawOverlay(self, color=(0.0, 0.0, 0.0)):
+        if not self.showOverlay:
+            return
+        stats = self.getStats()
+        lines = [
+            f"fps {stats['fps']:.1f}",
+            f"sim {stats['sim_ms']:.2f} ms",
+            f"draw {stats['draw_ms']:.2f} ms",
+            f"substeps/frame {stats['substeps']:.2f}",
+        ]
+        width = glutGet(GLUT_WINDOW_WIDTH)
+        height = glutGet(GLUT_WINDOW_HEIGHT)
+
+        glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_DEPTH_TEST)
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        gluOrtho2D(0, width, 0, height)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+        glColor3f(*color)
+        for k, line in enumerate(lines):
+            glRasterPos2i(8, height - 16 * (k + 1))
+            for c in line:
+                glutBitmapCharacter(GLUT_BITMAP_HELVETICA_12, ord(c))
+        glPopMatrix()
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glPopAttrib()
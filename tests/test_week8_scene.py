@@ -0,0 +1,40 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "week8"))
+import kadai08_sample_utf8 as week8
+
+
+# 球のないシーン (床だけ) を描画できるか
+class EmptySceneTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = week8.g_Scene, week8.g_LightDirection
+        week8.g_LightDirection = week8.normalize(week8.g_LightDirection)
+        week8.g_GBufferCache.clear()
+
+    def tearDown(self):
+        week8.g_Scene, week8.g_LightDirection = self.saved
+        week8.g_GBufferCache.clear()
+
+    def test_render_board_only(self):
+        week8.g_Scene = week8.Scene([], week8.g_Board)
+        image = week8.renderImage(100, 100, 1)
+        self.assertEqual(image.shape, (201, 201, 3))
+        self.assertTrue((image.sum(axis=2) > 0).any())
+
+        # レイは床に当たるか背景になり、床の色には影が付かない
+        gbuffer = week8.getGBuffer(week8.getPrimaryRays(-100, 101, -100, 101))
+        board = gbuffer.objectId == week8.ID_BOARD
+        self.assertTrue(np.all(board | (gbuffer.objectId == -1)))
+        position = gbuffer.position[board]
+        np.testing.assert_array_equal(
+            week8.shadeGBuffer(gbuffer)[board],
+            week8.g_Board.getColorVecBatch(position[:, 0], position[:, 2]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,14 @@
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
-import math, sys, time, random, colorsys
+import math, os, sys, random, colorsys
+import argparse
 
-state = {"last": None, "t": 0.0}
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.loop import FixedStepLoop, openTrace
+
+state = {"t": 0.0, "loop": None}
 lists = {"flower": None}
 random.seed(42)
 
@@ -66,13 +71,11 @@ def display():
         glScalef(s, s, 1)
         glCallList(lists["flower"])
         glPopMatrix()
+    state["loop"].drawOverlay((1.0, 1.0, 1.0))
     glutSwapBuffers()
 
 
-def timer(_):
-    now = time.perf_counter()
-    dt = 0.016 if state["last"] is None else max(0.0, min(0.05, now - state["last"]))
-    state["last"] = now
+def update(dt):
     state["t"] += dt
     for f in flowers:
         f.x += f.vx * dt
@@ -91,8 +94,11 @@ def timer(_):
         if f.y > 1 - r:
             f.y = 1 - r
             f.vy *= -1
-    glutPostRedisplay()
-    glutTimerFunc(16, timer, 0)
+
+
+def keyboard(key, x, y):
+    if key == b"s":  # s キーで統計の表示のオン/オフ
+        state["loop"].showOverlay = not state["loop"].showOverlay
 
 
 def init():
@@ -107,11 +113,19 @@ def init():
 
 
 if __name__ == "__main__":
-    glutInit(sys.argv)
-    glutInitDisplayMode(GLUT_RGBA | GLUT_DOUBLE)
-    glutInitWindowSize(720, 720)
-    glutCreateWindow(sys.argv[0])
-    init()
-    glutDisplayFunc(display)
-    glutTimerFunc(0, timer, 0)
-    glutMainLoop()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stats", action="store_true", help="フレームの統計を表示する")
+    parser.add_argument("--trace", metavar="FILE", help="フレームの統計の CSV の出力先")
+    args, rest = parser.parse_known_args()
+    with openTrace(args.trace) as traceFile:
+        state["loop"] = FixedStepLoop(update, 1 / 120, traceFile=traceFile)
+        state["loop"].showOverlay = args.stats
+        glutInit([sys.argv[0]] + rest)
+        glutInitDisplayMode(GLUT_RGBA | GLUT_DOUBLE)
+        glutInitWindowSize(720, 720)
+        glutCreateWindow(sys.argv[0])
+        init()
+        glutDisplayFunc(state["loop"].wrapDisplay(display))
+        glutKeyboardFunc(keyboard)
+        state["loop"].start()
+        glutMainLoop()
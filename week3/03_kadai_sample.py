@@ -1,10 +1,16 @@
+import os
 import sys
+import argparse
 from OpenGL.GLUT import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 import math
 import random
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.loop import FixedStepLoop, openTrace
+
 
 # ティーポットデータのクラスの定義
 class TeapotData:
@@ -36,6 +42,7 @@ g_EyeY = g_EyeCenterY
 g_EyeZ = g_EyeCenterZ
 
 g_AnimationIntervalMsec = 10
+g_Loop = None  # アニメーションのループ (FixedStepLoop)
 
 g_RotationDegree = 0.0
 g_DeltaRotationDegree = 0.3
@@ -177,11 +184,12 @@ def display():
 
     glPopMatrix()
 
+    g_Loop.drawOverlay()
     glutSwapBuffers()  # バッファの入れ替え
 
 
-# 一定時間ごとに呼び出される関数
-def timer(value):
+# アニメーションを1ステップ (g_AnimationIntervalMsec ミリ秒) 進める関数
+def update(step):
     global g_EyeX, g_EyeY, g_EyeZ
     # 回転角度の更新
     global g_RotationDegree
@@ -196,9 +204,11 @@ def timer(value):
     g_EyeZ = g_EyeCenterZ + g_EyeRadius * math.cos(orbitAngle)
     g_EyeY = g_EyeCenterY + 2.0 * math.sin(verticalAngle)
 
-    glutPostRedisplay()
 
-    glutTimerFunc(g_AnimationIntervalMsec, timer, value)
+# キーが押されたときの処理
+def keyboard(key, x, y):
+    if key == b"s":  # s キーで統計の表示のオン/オフ
+        g_Loop.showOverlay = not g_Loop.showOverlay
 
 
 # ウィンドウサイズが変更されたときの処理
@@ -269,14 +279,29 @@ def init():
 
 
 if __name__ == "__main__":
-    glutInit(sys.argv)  # ライブラリの初期化
-    glutInitDisplayMode(GLUT_DOUBLE | GLUT_RGB | GLUT_DEPTH)
-    glutInitWindowSize(g_WindowWidth, g_WindowHeight)  # ウィンドウサイズを指定
-    glutCreateWindow(
-        "Teapot Merry-Go-Round"
-    )  # ウィンドウタイトルに表示する文字列を指定する場合
-    glutDisplayFunc(display)  # 表示関数を指定
-    glutReshapeFunc(reshape)  # ウィンドウサイズが変更されたときに実行される関数を指定
-    timer(0)  # timer関数の実行
-    init()  # 初期設定を行う
-    glutMainLoop()  # イベント待ち
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stats", action="store_true", help="フレームの統計を表示する")
+    parser.add_argument("--trace", metavar="FILE", help="フレームの統計の CSV の出力先")
+    args, rest = parser.parse_known_args()
+    with openTrace(args.trace) as traceFile:
+        g_Loop = FixedStepLoop(
+            update,
+            g_AnimationIntervalMsec / 1000.0,
+            intervalMsec=g_AnimationIntervalMsec,
+            traceFile=traceFile,
+        )
+        g_Loop.showOverlay = args.stats
+
+        glutInit([sys.argv[0]] + rest)  # ライブラリの初期化
+        glutInitDisplayMode(GLUT_DOUBLE | GLUT_RGB | GLUT_DEPTH)
+        glutInitWindowSize(g_WindowWidth, g_WindowHeight)  # ウィンドウサイズを指定
+        glutCreateWindow(
+            "Teapot Merry-Go-Round"
+        )  # ウィンドウタイトルに表示する文字列を指定する場合
+        glutDisplayFunc(g_Loop.wrapDisplay(display))  # 表示関数を指定
+        # ウィンドウサイズが変更されたときに実行される関数を指定
+        glutReshapeFunc(reshape)
+        glutKeyboardFunc(keyboard)  # キーボード関数を指定
+        g_Loop.start()  # アニメーションのループを開始する
+        init()  # 初期設定を行う
+        glutMainLoop()  # イベント待ち
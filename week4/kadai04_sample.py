@@ -1,9 +1,18 @@
+import argparse
+import os
 import sys
+import time
+from functools import cache
+
 import numpy as np
 from OpenGL.GLUT import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.curve import CurveCache
+
 # 制御点を格納する配列
 g_ControlPoints = []
 
@@ -11,6 +20,18 @@ g_ControlPoints = []
 g_WindowWidth = 512
 g_WindowHeight = 512
 
+# 1区間あたりのサンプル数
+SAMPLES = 101
+
+# 曲率に応じて法線の長さを変えるスケールファクタ
+CURVATURE_SCALE = 5000.0
+
+# 曲線を折れ線で近似するときの許容誤差 [ピクセル]
+g_Tolerance = 0.25
+
+# 曲線を許容誤差に応じて分割するかどうか (False なら SAMPLES 個に等分する)
+g_Adaptive = True
+
 
 def bezier_derivatives(control_points, t):
     if len(control_points) != 4:
@@ -58,84 +79,287 @@ def bezier_derivatives(control_points, t):
     return B, B_prime, B_double_prime
 
 
+# t を samples 個に等分したときの3次のバーンスタイン基底行列
+# 点・1次導関数・2次導関数の基底を、それぞれ (samples, 4) の配列で返す
+@cache
+def bernstein_basis(samples=SAMPLES):
+    t = np.linspace(0.0, 1.0, samples)[:, None]
+    s = 1.0 - t
+    basis = np.hstack([s**3, 3 * s**2 * t, 3 * s * t**2, t**3])
+    d1 = np.hstack([-3 * s**2, 3 * s**2 - 6 * s * t, 6 * s * t - 3 * t**2, 3 * t**2])
+    d2 = np.hstack([6 * s, 6 * t - 12 * s, 6 * s - 12 * t, 6 * t])
+    return basis, d1, d2
+
+
+# 制御点の列 (n, 2) を、端点を共有する4点ずつの区間 (segments, 4, 2) に分ける
+def get_segments(control_points):
+    points = np.asarray(control_points, dtype=np.float64).reshape(-1, 2)
+    num_curves = (len(points) - 1) // 3
+    if num_curves <= 0:
+        return np.empty((0, 4, 2))
+    return points[3 * np.arange(num_curves)[:, None] + np.arange(4)]
+
+
+# 全ての区間の全てのサンプルについて、点・1次導関数・2次導関数をまとめて計算する
+# それぞれ (segments, samples, 2) の配列で返す
+def bezier_derivatives_batch(segments, samples=SAMPLES):
+    return tuple(basis @ segments for basis in bernstein_basis(samples))
+
+
+# 曲率 (segments, samples) と、接線が十分に長く曲率を計算できたかどうかのマスクを返す
+def curvature_batch(tangent, second_derivative):
+    tangent_norm_sq = np.sum(tangent**2, axis=-1)
+    valid = tangent_norm_sq > 1e-6
+    numerator = (
+        tangent[..., 0] * second_derivative[..., 1]
+        - tangent[..., 1] * second_derivative[..., 0]
+    )
+    curvature = numerator / np.where(valid, tangent_norm_sq, 1.0) ** 1.5
+    return np.where(valid, curvature, 0.0), valid
+
+
+# 曲率に応じた長さの法線 (曲率くし) の終点 (segments, samples, 2) とマスクを返す
+def curvature_comb(point, tangent, second_derivative, scale=CURVATURE_SCALE):
+    curvature, valid = curvature_batch(tangent, second_derivative)
+    normal = np.stack([-tangent[..., 1], tangent[..., 0]], axis=-1)
+    normal_norm = np.linalg.norm(normal, axis=-1, keepdims=True)
+    normal /= np.where(normal_norm > 1e-6, normal_norm, 1.0)
+    return point + normal * (scale * np.abs(curvature))[..., None], valid
+
+
+# Wang の公式で、各区間を折れ線で近似したときの誤差が tolerance 以下になる分割数を求める
+# 3次の場合、分割数 n は sqrt(3 * 2 / 8 * max|p[i] - 2 p[i+1] + p[i+2]| / tolerance) 以上
+def wang_subdivisions(segments, tolerance):
+    second = segments[:, :2] - 2 * segments[:, 1:3] + segments[:, 2:]
+    m = np.linalg.norm(second, axis=-1).max(axis=1)
+    return np.maximum(np.ceil(np.sqrt(0.75 * m / tolerance)), 1).astype(np.int64)
+
+
+# 各区間を wang_subdivisions の数に等分した点を並べた折れ線 (vertices, 2) を返す
+# 区間は端点を共有しているので、2つ目以降の区間の始点は省く
+def flatten_adaptive(segments, tolerance):
+    if len(segments) == 0:
+        return np.empty((0, 2))
+    n = wang_subdivisions(segments, tolerance)
+    index = np.repeat(np.arange(len(segments)), n)
+    first = np.repeat(np.cumsum(n) - n, n)
+    t = (np.arange(n.sum()) - first + 1) / np.repeat(n, n)
+    s = 1.0 - t
+    basis = np.stack([s**3, 3 * s**2 * t, 3 * s * t**2, t**3], axis=1)
+    points = np.einsum("vk,vkd->vd", basis, segments[index])
+    return np.vstack([segments[0, 0], points])
+
+
+# 各区間を SAMPLES 個に等分した点を並べた折れ線 (vertices, 2) を返す
+def flatten_uniform(segments, samples=SAMPLES):
+    return (bernstein_basis(samples)[0] @ segments).reshape(-1, 2)
+
+
+# 区間 first 以降の制御点 (segments, 4, 2) について、区間ごとに曲線の折れ線の頂点と
+# 曲率くしの線分の頂点を計算する (CurveCache から呼ばれる)
+# 折れ線には区間の始点を含めない (最初の区間だけ含める) ので、続けて並べると1本の折れ線になる
+def evaluate_segments(first, segments):
+    point, tangent, second_derivative = bezier_derivatives_batch(segments)
+    end, valid = curvature_comb(point, tangent, second_derivative)
+    combs = np.stack([point, end], axis=2)
+    if g_Adaptive:
+        n = wang_subdivisions(segments, g_Tolerance)
+        curves = np.split(
+            flatten_adaptive(segments, g_Tolerance)[1:], np.cumsum(n)[:-1]
+        )
+    else:
+        curves = list(point[:, 1:])
+    if first == 0:
+        curves[0] = np.vstack([segments[0, 0], curves[0]])
+    return [
+        (curve, comb[v].reshape(-1, 2)) for curve, comb, v in zip(curves, combs, valid)
+    ]
+
+
+# 区間ごとの曲線と曲率くしのキャッシュ
+g_CurveCache = CurveCache(evaluate_segments, 3, 2)
+
+
 # 表示部分をこの関数で記入
 def display():
     glClearColor(1.0, 1.0, 1.0, 1.0)  # 消去色指定
     glClear(GL_COLOR_BUFFER_BIT)
 
-    # 制御点の描画
-    glPointSize(5)
-    glColor3d(0.0, 0.0, 0.0)
-    glBegin(GL_POINTS)
-    for point in g_ControlPoints:
-        glVertex2dv(point)
-    glEnd()
-
-    # 制御点を結ぶ線分の描画
-    glColor3d(1.0, 0.0, 0.0)
-    glLineWidth(1)
-    glBegin(GL_LINE_STRIP)
-    for point in g_ControlPoints:
-        glVertex2dv(point)
-    glEnd()
-
-    # ベジェ曲線の描画
-    num_curves = (len(g_ControlPoints) - 1) // 3
-    for i in range(num_curves):
-        start_index = i * 3
-        control_points = g_ControlPoints[start_index : start_index + 4]
-        if len(control_points) == 4:
-            # 曲線の描画
-            glColor3d(0.0, 0.0, 0.0)
-            glLineWidth(2)
-            glBegin(GL_LINE_STRIP)
-            for j in range(101):
-                t = j / 100.0
-                point, _, _ = bezier_derivatives(control_points, t)
-                if point is not None:
-                    glVertex2dv(point)
-            glEnd()
-
-            # 法線の描画
-            glColor3d(0.0, 0.0, 1.0)  # 法線は青色
-            glLineWidth(1)
-            for j in range(0, 101, 1):  # 曲線ごとに11個の法線を描画
-                t = j / 100.0
-                point, tangent, second_derivative = bezier_derivatives(
-                    control_points, t
-                )
-                if (
-                    point is not None
-                    and tangent is not None
-                    and second_derivative is not None
-                ):
-                    tangent_norm_sq = tangent[0] ** 2 + tangent[1] ** 2
-                    if tangent_norm_sq > 1e-6:
-                        # 曲率の計算
-                        curvature_numerator = (
-                            tangent[0] * second_derivative[1]
-                            - tangent[1] * second_derivative[0]
-                        )
-                        curvature = curvature_numerator / (tangent_norm_sq**1.5)
-
-                        # 法線ベクトル
-                        normal = np.array([-tangent[1], tangent[0]])
-                        normal_norm = np.linalg.norm(normal)
-                        if normal_norm > 1e-6:
-                            normal /= normal_norm
-
-                        # 曲率に応じて法線の長さを変更
-                        normal_length = 5000.0 * abs(curvature)  # スケールファクタ
-
-                        p2 = point + normal * normal_length
-
-                        glBegin(GL_LINES)
-                        glVertex2dv(point)
-                        glVertex2dv(p2)
-                        glEnd()
+    glEnableClientState(GL_VERTEX_ARRAY)
+    if g_ControlPoints:
+        control_points = np.asarray(g_ControlPoints, dtype=np.float64)
+        glVertexPointer(2, GL_DOUBLE, 0, control_points)
+
+        # 制御点の描画
+        glPointSize(5)
+        glColor3d(0.0, 0.0, 0.0)
+        glDrawArrays(GL_POINTS, 0, len(control_points))
+
+        # 制御点を結ぶ線分の描画
+        glColor3d(1.0, 0.0, 0.0)
+        glLineWidth(1)
+        glDrawArrays(GL_LINE_STRIP, 0, len(control_points))
+
+    # ベジェ曲線の描画 (制御点が変わった区間だけを計算し直す)
+    curve, lines = g_CurveCache.update(g_ControlPoints)
+    if len(curve) > 0:
+        # 曲線の描画。区間は端点を共有しているので1本の折れ線として描ける
+        glColor3d(0.0, 0.0, 0.0)
+        glLineWidth(2)
+        glVertexPointer(2, GL_DOUBLE, 0, curve)
+        glDrawArrays(GL_LINE_STRIP, 0, len(curve))
+
+        # 法線の描画 (曲率くし)
+        glColor3d(0.0, 0.0, 1.0)  # 法線は青色
+        glLineWidth(1)
+        glVertexPointer(2, GL_DOUBLE, 0, lines)
+        glDrawArrays(GL_LINES, 0, len(lines))
+    glDisableClientState(GL_VERTEX_ARRAY)
     glFlush()  # 画面出力
 
 
+# 制御点 num_points 個の曲線について、区間ごと・サンプルごとに bezier_derivatives を呼ぶ計算と
+# まとめて計算する bezier_derivatives_batch / curvature_comb の時間と結果の差を表示する
+def benchmark(num_points=3001, repeat=5):
+    rng = np.random.default_rng(0)
+    control_points = list(rng.uniform(0, 512, size=(num_points, 2)))
+    segments = get_segments(control_points)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        point, tangent, second_derivative = bezier_derivatives_batch(segments)
+        end, valid = curvature_comb(point, tangent, second_derivative)
+    batch_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    loop_points = np.empty_like(point)
+    loop_ends = np.empty_like(end)
+    for i, control in enumerate(segments):
+        for j in range(SAMPLES):
+            p, d1, d2 = bezier_derivatives(control, j / (SAMPLES - 1))
+            loop_points[i, j] = p
+            normal = np.array([-d1[1], d1[0]])
+            normal /= np.linalg.norm(normal)
+            curvature = (d1[0] * d2[1] - d1[1] * d2[0]) / (d1 @ d1) ** 1.5
+            loop_ends[i, j] = p + normal * CURVATURE_SCALE * abs(curvature)
+    loop_time = time.perf_counter() - start
+
+    print(f"control points={num_points} segments={len(segments)} samples={SAMPLES}")
+    print(f"loop  {loop_time * 1000:9.2f} ms")
+    print(f"batch {batch_time * 1000:9.2f} ms ({loop_time / batch_time:.0f}x)")
+    print(f"max diff point {np.abs(point - loop_points).max():.2e}", end=" ")
+    print(f"comb {np.abs(end - loop_ends)[valid].max():.2e}")
+
+
+# 折れ線 curve が曲線からどれだけ離れているかを、各区間の分割の間を細かく調べて求める
+# 分割数 n は区間ごとの分割数 (SAMPLES 個に等分した場合は SAMPLES - 1)
+def flatten_error(segments, n, checks=16):
+    index = np.repeat(np.arange(len(segments)), n)
+    first = np.repeat(np.cumsum(n) - n, n)
+    piece = (np.arange(n.sum()) - first)[:, None]
+    u = np.linspace(0.0, 1.0, checks + 2)[1:-1]
+    t = (piece + u) / np.repeat(n, n)[:, None]
+    t0, t1 = piece / np.repeat(n, n)[:, None], (piece + 1) / np.repeat(n, n)[:, None]
+
+    def evaluate(t):
+        s = 1.0 - t
+        basis = np.stack([s**3, 3 * s**2 * t, 3 * s * t**2, t**3], axis=-1)
+        return np.einsum("vck,vkd->vcd", basis, segments[index])
+
+    p0, p1 = evaluate(t0), evaluate(t1)
+    chord = p0 + (p1 - p0) * u[None, :, None]
+    return np.linalg.norm(evaluate(t) - chord, axis=-1).max()
+
+
+# ベンチマーク用の曲線の組を (名前, 区間 (segments, 4, 2)) のリストで返す
+# circle: 半径の異なる円を4つの3次曲線で近似したもの、spiral: 螺旋上の点を通る滑らかな曲線、
+# random: 乱数で置いた制御点 (ほとんどの区間が大きく曲がる)
+def make_curve_sets(seed=0):
+    rng = np.random.default_rng(seed)
+    k = 0.5522847498  # 4つの3次曲線で円を近似するときの制御点の距離
+    unit = np.array(
+        [
+            [[1, 0], [1, k], [k, 1], [0, 1]],
+            [[0, 1], [-k, 1], [-1, k], [-1, 0]],
+            [[-1, 0], [-1, -k], [-k, -1], [0, -1]],
+            [[0, -1], [k, -1], [1, -k], [1, 0]],
+        ]
+    )
+    radii = rng.uniform(2, 250, size=250)
+    centers = rng.uniform(0, 512, size=(250, 2))
+    circles = (radii[:, None, None, None] * unit + centers[:, None, None]).reshape(
+        -1, 4, 2
+    )
+
+    theta = np.linspace(0, 40 * np.pi, 1003)
+    path = 256 + np.stack([np.cos(theta), np.sin(theta)], axis=1) * theta[:, None]
+    spiral = np.stack(
+        [
+            path[1:-2],
+            path[1:-2] + (path[2:-1] - path[:-3]) / 6,
+            path[2:-1] - (path[3:] - path[1:-2]) / 6,
+            path[2:-1],
+        ],
+        axis=1,
+    )
+
+    random = get_segments(rng.uniform(0, 512, size=(3001, 2)))
+    return [("circle", circles), ("spiral", spiral), ("random", random)]
+
+
+# 曲線の組ごとに、SAMPLES 個に等分した場合と許容誤差で分割した場合の頂点数・時間・誤差を比べる
+def benchmark_flatten(tolerance=0.25, repeat=10):
+    print(f"tolerance={tolerance} px, uniform samples={SAMPLES}")
+    print(
+        f"{'curves':>8} {'segments':>8} {'method':>8} {'vertices':>9}"
+        f" {'time[ms]':>9} {'error[px]':>9}"
+    )
+    for name, segments in make_curve_sets():
+        uniform_n = np.full(len(segments), SAMPLES - 1)
+        for method, flatten, n in [
+            ("uniform", lambda segments=segments: flatten_uniform(segments), uniform_n),
+            (
+                "adaptive",
+                lambda segments=segments: flatten_adaptive(segments, tolerance),
+                wang_subdivisions(segments, tolerance),
+            ),
+        ]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                curve = flatten()
+            elapsed = (time.perf_counter() - start) / repeat
+            print(
+                f"{name:>8} {len(segments):>8} {method:>8} {len(curve):>9}"
+                f" {elapsed * 1000:9.2f} {flatten_error(segments, n):9.4f}"
+            )
+
+
+# 制御点を1つずつ max_points 個まで追加していく編集をまねて、追加するたびに
+# 全ての区間を計算し直す場合と CurveCache を使う場合の1回の更新の時間を比べる
+def benchmark_cache(max_points=601, report=100):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 512, size=(max_points, 2))
+    cache = CurveCache(evaluate_segments, 3, 2)
+    full_time = cache_time = 0.0
+    print(f"{'points':>7} {'full[ms]':>9} {'cache[ms]':>10} {'evaluated':>10}")
+    for n in range(1, max_points + 1):
+        start = time.perf_counter()
+        full = CurveCache(evaluate_segments, 3, 2).update(points[:n])
+        full_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        cached = cache.update(points[:n])
+        cache_time += time.perf_counter() - start
+        assert all(np.array_equal(a, b) for a, b in zip(full, cached))
+
+        if n % report == 0:
+            print(
+                f"{n:>7} {full_time / report * 1000:9.3f}"
+                f" {cache_time / report * 1000:10.3f} {cache.evaluated:>10}"
+            )
+            full_time = cache_time = 0.0
+
+
 # ウィンドウのサイズが変更されたときの処理
 def resize(w, h):
     if h > 0:
@@ -169,7 +393,16 @@ def mouse(button, state, x, y):
 
 # キーが押されたときのイベント処理
 def keyboard(key, x, y):
-    if key == b"q":
+    global g_Adaptive, g_Tolerance
+    if key == b"a":  # a キーで許容誤差による分割と等分を切り替える
+        g_Adaptive = not g_Adaptive
+    elif key == b"+":  # + / - キーで許容誤差を変える
+        g_Tolerance *= 2.0
+    elif key == b"-":
+        g_Tolerance /= 2.0
+    if key in [b"a", b"+", b"-"]:
+        g_CurveCache.invalidate()  # 曲線の分割の設定が変わったので全て計算し直す
+    elif key == b"q":
         pass
     elif key == b"Q":
         pass
@@ -190,7 +423,42 @@ def init():
 
 
 if __name__ == "__main__":
-    glutInit(sys.argv)  # ライブラリの初期化
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--random", type=int, default=0, help="乱数で置く制御点の数")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=g_Tolerance,
+        help="曲線を折れ線で近似するときの許容誤差 [ピクセル]",
+    )
+    parser.add_argument(
+        "--bench", action="store_true", help="曲線の計算時間を比べて終了する"
+    )
+    parser.add_argument(
+        "--bench-cache",
+        action="store_true",
+        help="制御点を追加するたびの曲線の更新時間を比べて終了する",
+    )
+    parser.add_argument(
+        "--bench-flatten",
+        action="store_true",
+        help="等分と許容誤差による分割の頂点数と時間を比べて終了する",
+    )
+    args, rest = parser.parse_known_args()
+    g_Tolerance = args.tolerance
+    if args.bench:
+        benchmark()
+        sys.exit(0)
+    if args.bench_cache:
+        benchmark_cache()
+        sys.exit(0)
+    if args.bench_flatten:
+        benchmark_flatten(args.tolerance)
+        sys.exit(0)
+    rng = np.random.default_rng(0)
+    g_ControlPoints.extend(rng.uniform(0, g_WindowWidth, size=(args.random, 2)))
+
+    glutInit([sys.argv[0]] + rest)  # ライブラリの初期化
     glutInitWindowSize(g_WindowWidth, g_WindowHeight)  # ウィンドウサイズを指定
     glutCreateWindow(sys.argv[0])  # ウィンドウを作成
     glutDisplayFunc(display)  # 表示関数を指定
@@ -1,11 +1,16 @@
+import argparse
+import os
 import sys
+import time
+
 import numpy as np
 from OpenGL.GLUT import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
-# 制御点を格納する配列
-g_ControlPoints = []
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.curve import CurveCache
 
 # ウィンドウサイズを保持する
 g_WindowWidth = 512
@@ -19,6 +24,15 @@ g_NotVector = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
 # 課題(2)では次のノットベクトルを変更する
 # g_NotVector = [0, 0, 0, 0, 1, 1, 1, 1]
 
+# 曲線を描くときのパラメータ t の刻み幅
+T_STEP = 0.01
+
+# BSplineCurve で1つの区間を描くときのサンプル数
+SPAN_SAMPLES = 100
+
+# BSplineCurve のノットベクトルの作り方
+KNOT_MODES = ["custom", "uniform", "clamped", "chord"]
+
 
 # 基底関数 N{i,n}(t)の値を計算する
 def getBaseN(i, n, t) -> float:
@@ -44,47 +58,400 @@ def getBaseN(i, n, t) -> float:
         return term1 + term2
 
 
+# t を含む区間の番号 span (knots[span] <= t < knots[span+1]) を二分探索で求める
+# n 次で制御点が numPoints 個のときに曲線が定義される区間 n … numPoints-1 の範囲に収める
+# t は配列でもよい。knots を省略すると g_NotVector を使う
+def findSpan(t, numPoints, n=3, knots=None):
+    knots = np.asarray(g_NotVector if knots is None else knots, dtype=np.float64)
+    span = np.searchsorted(knots, t, side="right")
+    return np.clip(span - 1, n, numPoints - 1)
+
+
+# 区間 span で 0 にならない n+1 個の基底関数 N{span-n,n}(t) … N{span,n}(t) の値を、
+# 0 次から順に三角形の形に計算していく (de Boor の漸化式)
+# t と span は配列でもよく、(len(t), n+1) の配列を返す。knots を省略すると g_NotVector を使う
+def getBasisFuns(span, t, n=3, knots=None):
+    knots = np.asarray(g_NotVector if knots is None else knots, dtype=np.float64)
+    t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+    span = np.broadcast_to(span, t.shape)
+    values = np.zeros((len(t), n + 1))
+    values[:, 0] = 1.0
+    left = np.zeros((len(t), n + 1))
+    right = np.zeros((len(t), n + 1))
+    for j in range(1, n + 1):
+        left[:, j] = t - knots[span + 1 - j]
+        right[:, j] = knots[span + j] - t
+        saved = 0.0
+        for r in range(j):
+            # ノットが重なって分母がゼロになる項は無視する
+            denominator = right[:, r + 1] + left[:, j - r]
+            temp = np.divide(
+                values[:, r],
+                denominator,
+                out=np.zeros(len(t)),
+                where=denominator != 0.0,
+            )
+            values[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        values[:, j] = saved
+    return values
+
+
+# 疎な基底行列 (サンプル数, 制御点の数)
+# 各行で 0 にならない n+1 個の値 values と、その最初の列の番号 start だけを持つ
+class BasisMatrix:
+    def __init__(self, start, values, numPoints):
+        self.start = start  # 各行の 0 でない最初の列 (サンプル数,)
+        self.values = values  # 各行の 0 でない値 (サンプル数, n+1)
+        self.numPoints = numPoints  # 列の数 (制御点の数)
+
+    # 制御点 points (numPoints, 2) に掛けて、曲線上の点 (サンプル数, 2) を返す
+    def multiply(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        index = self.start[:, None] + np.arange(self.values.shape[1])
+        return np.einsum("sk,skd->sd", self.values, points[index])
+
+    # 普通の (サンプル数, 制御点の数) の行列にする
+    def toDense(self):
+        dense = np.zeros((len(self.start), self.numPoints))
+        rows = np.arange(len(self.start))[:, None]
+        dense[rows, self.start[:, None] + np.arange(self.values.shape[1])] = self.values
+        return dense
+
+
+# 3次Bスプライン曲線 (制御点に重みを付ければ NURBS 曲線)
+# 制御点・重み・ノットベクトルをまとめて持ち、制御点の数に合わせてノットベクトルを作り直す
+# ノットベクトルの作り方 knotMode は KNOT_MODES のどれか
+#   "custom": knots で与えたノットベクトルを使い、足りなくなったら最後の間隔で末尾に伸ばす
+#   "uniform": 一様 (0, 1, 2, …)
+#   "clamped": 両端に同じ値を4つずつ並べた開一様 (曲線が両端の制御点を通る)
+#   "chord": 制御点の間の距離 (弦長) を足したパラメータを3つずつ平均したもの (両端は clamped と同じ)
+# clamped と chord は正規化しないので、末尾に制御点を追加しても最後の数個のノットしか変わらない
+class BSplineCurve:
+    def __init__(self, knotMode="custom", knots=None):
+        self.knotMode = knotMode
+        self.points = np.empty((0, 2))  # 制御点
+        self.weights = np.empty(0)  # 制御点の重み
+        self.knots = np.asarray([] if knots is None else knots, dtype=np.float64)
+        self.cache = CurveCache(self.evaluateSpans, 1, width=5)  # 区間ごとの折れ線
+        self.matrix = None  # 曲線全体の基底行列 (BasisMatrix)
+        self.matrixKey = None  # matrix を作ったときのノットベクトル
+
+    # 制御点 points (と重み weights) を末尾に追加する
+    # ノットベクトルを伸ばせずに追加できなかったときは False を返す
+    def extend(self, points, weights=None):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        weights = np.ones(len(points)) if weights is None else weights
+        if self.knotMode == "custom" and not self.extendKnots(
+            len(self.points) + len(points)
+        ):
+            return False
+        self.points = np.vstack([self.points, points])
+        self.weights = np.concatenate([self.weights, weights])
+        self.updateKnots()
+        return True
+
+    # 制御点 point を重み weight で末尾に追加する
+    def append(self, point, weight=1.0):
+        return self.extend([point], [weight])
+
+    # 末尾の制御点を削除する
+    def pop(self):
+        if len(self.points) > 0:
+            self.points = self.points[:-1]
+            self.weights = self.weights[:-1]
+            self.updateKnots()
+
+    # index 番目の制御点の重みを変える
+    def setWeight(self, index, weight):
+        self.weights = self.weights.copy()
+        self.weights[index] = weight
+
+    # ノットベクトルの作り方を変える
+    def setKnotMode(self, knotMode):
+        self.knotMode = knotMode
+        self.updateKnots()
+
+    # "custom" のノットベクトルを、制御点 numPoints 個に足りるまで最後の間隔で伸ばす
+    # 末尾のノットが重なっている (端が clamped の) ときは、重なったノットをまとめて
+    # 最後の間隔だけ外側へずらし、元の端の値を内側のノットとして1つ残す
+    # ノットが全て同じ値で間隔がないときだけは伸ばせないので False を返す
+    def extendKnots(self, numPoints):
+        while len(self.knots) < numPoints + 4:
+            end = self.knots[-1] if len(self.knots) > 0 else 0.0
+            multiplicity = np.count_nonzero(self.knots == end)
+            if multiplicity == len(self.knots):
+                return False
+            step = end - self.knots[-multiplicity - 1]
+            self.knots = np.concatenate(
+                [self.knots[:-multiplicity], [end], np.full(multiplicity, end + step)]
+            )
+        return True
+
+    # 制御点の数と knotMode に合わせてノットベクトルを作り直す
+    def updateKnots(self):
+        n = len(self.points)
+        if self.knotMode == "uniform":
+            self.knots = np.arange(n + 4, dtype=np.float64)
+        elif self.knotMode == "clamped":
+            interior = np.arange(1.0, max(n - 3, 1))
+            end = max(n - 3, 0)
+            self.knots = np.concatenate([np.zeros(4), interior, np.full(4, end)])
+        elif self.knotMode == "chord":
+            chord = np.linalg.norm(np.diff(self.points, axis=0), axis=1)
+            u = np.concatenate([[0.0], np.cumsum(chord)])
+            interior = np.convolve(u, np.ones(3) / 3, mode="valid")[1 : max(n - 3, 1)]
+            end = u[-1] if n > 0 else 0.0
+            self.knots = np.concatenate([np.zeros(4), interior, np.full(4, end)])
+
+    # Boehm のアルゴリズムでノット u を1つ挿入する。曲線の形は変えずに制御点が1つ増える
+    # 重み付きの制御点 (w x, w y, w) の同次座標で計算するので NURBS でもそのまま使える
+    # 挿入したノットを残すため、以降は "custom" のノットベクトルとして扱う
+    def insertKnot(self, u):
+        n = len(self.points)
+        if n < 4 or not self.knots[3] <= u < self.knots[n]:
+            return False
+        k = int(findSpan(u, n, 3, self.knots))
+        homogeneous = np.column_stack(
+            [self.points * self.weights[:, None], self.weights]
+        )
+        inserted = np.empty((n + 1, 3))
+        inserted[: k - 2] = homogeneous[: k - 2]
+        inserted[k + 1 :] = homogeneous[k:]
+        for i in range(k - 2, k + 1):
+            alpha = (u - self.knots[i]) / (self.knots[i + 3] - self.knots[i])
+            inserted[i] = alpha * homogeneous[i] + (1.0 - alpha) * homogeneous[i - 1]
+        self.knots = np.insert(self.knots, k + 1, u)
+        self.weights = inserted[:, 2]
+        self.points = inserted[:, :2] / inserted[:, 2:]
+        self.knotMode = "custom"
+        return True
+
+    # 区間キャッシュで比べる値 (制御点ごとに x, y, 重み, ノット2つ)
+    # 区間 j は制御点 j-3 … j とノット j-2 … j+3 を使うので、制御点 i にノット i+1 と i+3 を付けておけば、
+    # 区間の4つの制御点でその区間が使うノットを全て比べられる
+    def getSignature(self):
+        n = len(self.points)
+        return np.column_stack(
+            [self.points, self.weights, self.knots[1 : n + 1], self.knots[3 : n + 3]]
+        )
+
+    # 区間 first 以降の (spans, 4, 5) の値について、区間ごとに曲線上の点を SPAN_SAMPLES 個計算する
+    # (CurveCache から呼ばれる)。m 番目の区間 j = first + m + 3 では 0 にならない基底関数
+    # N{j-3,3} … N{j,3} だけを getBasisFuns でまとめて計算する。長さ 0 の区間には点を置かない
+    def evaluateSpans(self, first, spans):
+        span = first + 3 + np.arange(len(spans))
+        t0, t1 = self.knots[span], self.knots[span + 1]
+        count = np.where(t1 > t0, SPAN_SAMPLES, 0)
+
+        index = np.repeat(np.arange(len(spans)), count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        t = t0[index] + (t1 - t0)[index] * k / SPAN_SAMPLES
+        values = getBasisFuns(span[index], t, 3, self.knots) * spans[index, :, 2]
+        curve = np.einsum("sk,skd->sd", values, spans[index, :, :2])
+        curve /= values.sum(axis=1)[:, None]
+        return [(c,) for c in np.split(curve, np.cumsum(count)[:-1])]
+
+    # 変わった区間だけを計算し直して、曲線全体の折れ線を返す
+    def update(self):
+        (curve,) = self.cache.update(self.getSignature())
+        return curve
+
+    # 曲線全体を区間ごとに SPAN_SAMPLES 個ずつサンプリングする疎な基底行列を返す
+    # ノットベクトルが変わるまでは、一度作った行列を使い回す
+    def getBasisMatrix(self):
+        n = len(self.points)
+        key = (n, self.knots.tobytes())
+        if self.matrixKey != key:
+            span = np.arange(3, max(n, 3))
+            span = span[self.knots[span + 1] > self.knots[span]]
+            k = np.tile(np.arange(SPAN_SAMPLES), len(span))
+            span = np.repeat(span, SPAN_SAMPLES)
+            t = self.knots[span] + (self.knots[span + 1] - self.knots[span]) * (
+                k / SPAN_SAMPLES
+            )
+            self.matrix = BasisMatrix(span - 3, getBasisFuns(span, t, 3, self.knots), n)
+            self.matrixKey = key
+        return self.matrix
+
+    # 基底行列を使って曲線全体の点を計算する (重み付きの同次座標で掛けてから割る)
+    def evaluate(self):
+        homogeneous = np.column_stack(
+            [self.points * self.weights[:, None], self.weights]
+        )
+        result = self.getBasisMatrix().multiply(homogeneous)
+        return result[:, :2] / result[:, 2:]
+
+    # パラメータ t (配列) での曲線上の点
+    def evaluateAt(self, t):
+        n = len(self.points)
+        span = findSpan(t, n, 3, self.knots)
+        values = getBasisFuns(span, t, 3, self.knots)
+        index = span[:, None] - 3 + np.arange(4)
+        values = values * self.weights[index]
+        return (
+            np.einsum("sk,skd->sd", values, self.points[index])
+            / values.sum(axis=1)[:, None]
+        )
+
+
+# 編集中の曲線。最初は g_NotVector をノットベクトルとして使う
+g_Curve = BSplineCurve("custom", g_NotVector)
+
+
 # 表示部分をこの関数で記入
 def display():
     glClearColor(1.0, 1.0, 1.0, 1.0)  # 消去色指定
     glClear(GL_COLOR_BUFFER_BIT)
 
+    glEnableClientState(GL_VERTEX_ARRAY)
+    points = np.ascontiguousarray(g_Curve.points)
+    glVertexPointer(2, GL_DOUBLE, 0, points)
+
     # 制御点の描画
     glPointSize(5)
     glColor3d(0.0, 0.0, 0.0)
-    glBegin(GL_POINTS)
-    for point in g_ControlPoints:
-        glVertex2dv(point)
-    glEnd()
+    glDrawArrays(GL_POINTS, 0, len(points))
 
     # 制御点を結ぶ線分の描画
     glColor3d(1.0, 0.0, 0.0)
     glLineWidth(1)
-    glBegin(GL_LINE_STRIP)
-    for point in g_ControlPoints:
-        glVertex2dv(point)
-    glEnd()
+    glDrawArrays(GL_LINE_STRIP, 0, len(points))
 
     # ここにBスプライン曲線を描画するプログラムコードを入れる
     # ヒント1: 3次Bスプラインの場合は制御点を4つ入れるまでは何も描けない
     # ヒント2: パラメータtの値の取り得る範囲に注意
-    if len(g_ControlPoints) >= 4:
+    # 区間ごとの曲線はキャッシュしておき、制御点・重み・ノットが変わった区間だけを計算し直す
+    curve = g_Curve.update()
+    if len(curve) > 0:
         glColor3d(0.0, 0.0, 0.0)
         glLineWidth(2)
-        glBegin(GL_LINE_STRIP)
+        glVertexPointer(2, GL_DOUBLE, 0, curve)
+        glDrawArrays(GL_LINE_STRIP, 0, len(curve))
+    glDisableClientState(GL_VERTEX_ARRAY)
+
+    glFlush()  # 画面出力
 
-        t_start = g_NotVector[3]
-        t_end = g_NotVector[len(g_ControlPoints)]
 
-        for t in np.arange(t_start, t_end, 0.01):
-            point_on_curve = np.array([0.0, 0.0])
-            for i in range(len(g_ControlPoints)):
-                base_n = getBaseN(i, 3, t)
-                point_on_curve += base_n * g_ControlPoints[i]
-            glVertex2dv(point_on_curve)
-        glEnd()
+# 制御点を1つずつ maxPoints 個まで追加していく編集をまねて、追加するたびの
+# 区間キャッシュの更新の時間と、report 個ごとに全ての区間を計算し直す時間を比べる
+def benchmarkCache(maxPoints=601, report=100, knotMode="uniform"):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 512, size=(maxPoints, 2))
+    curve = BSplineCurve(knotMode)
+    cacheTime = 0.0
+    print(f"knots={knotMode}")
+    print(f"{'points':>7} {'full[ms]':>9} {'cache[ms]':>10} {'evaluated':>10}")
+    for n in range(1, maxPoints + 1):
+        curve.append(points[n - 1])
+        start = time.perf_counter()
+        cached = curve.update()
+        cacheTime += time.perf_counter() - start
 
-    glFlush()  # 画面出力
+        if n % report == 0:
+            start = time.perf_counter()
+            curve.cache.invalidate()
+            full = curve.update()
+            fullTime = time.perf_counter() - start
+            assert np.array_equal(full, cached)
+            print(
+                f"{n:>7} {fullTime * 1000:9.3f}"
+                f" {cacheTime / report * 1000:10.3f} {curve.cache.evaluated:>10}"
+            )
+            cacheTime = 0.0
+
+
+# knotMode ごとに numPoints 個の制御点の NURBS 曲線を作り、全体の計算、
+# 変更のない再描画、制御点を1つ追加した後の再描画の時間を測る
+# また、ノットを挿入しても曲線の形が変わらないことと、挿入後も制御点を追加できることを確かめる
+def benchmarkCurve(numPoints=10000):
+    rng = np.random.default_rng(0)
+    points = np.cumsum(rng.normal(scale=4.0, size=(numPoints, 2)), axis=0)
+    weights = rng.uniform(0.5, 2.0, size=numPoints)
+    print(f"control points={numPoints} samples/span={SPAN_SAMPLES}")
+    print(
+        f"{'knots':>8} {'matrix[ms]':>11} {'first[ms]':>10} {'redraw[ms]':>11}"
+        f" {'append[ms]':>11} {'diff':>9} {'insert':>9} {'re-append':>9}"
+    )
+    for knotMode in KNOT_MODES[1:]:
+        curve = BSplineCurve(knotMode)
+        curve.extend(points, weights)
+
+        start = time.perf_counter()
+        full = curve.evaluate()
+        matrixTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cached = curve.update()
+        firstTime = time.perf_counter() - start
+        diff = np.abs(full - cached).max()
+
+        start = time.perf_counter()
+        curve.update()
+        redrawTime = time.perf_counter() - start
+
+        curve.append(points[-1] + 1.0)
+        start = time.perf_counter()
+        curve.update()
+        appendTime = time.perf_counter() - start
+
+        t = np.linspace(curve.knots[3], curve.knots[len(curve.points)], 1000)[:-1]
+        before = curve.evaluateAt(t)
+        curve.insertKnot(0.5 * (curve.knots[3] + curve.knots[len(curve.points)]))
+        insertError = np.abs(curve.evaluateAt(t) - before).max()
+        # 挿入で "custom" になった後も、ノットベクトルを伸ばして制御点を追加できる
+        appended = curve.append(points[-1] + 2.0) and len(curve.update()) > 0
+        print(
+            f"{knotMode:>8} {matrixTime * 1000:11.2f} {firstTime * 1000:10.2f}"
+            f" {redrawTime * 1000:11.3f} {appendTime * 1000:11.3f}"
+            f" {diff:9.2e} {insertError:9.2e} {str(appended):>9}"
+        )
+
+
+# 制御点の数ごとに、曲線全体を getBaseN で計算する場合と、getBasisFuns で基底行列を作る場合、
+# 作っておいた基底行列を掛けるだけの場合の時間と結果の差を比べる
+# 基底行列は一様なノットベクトルの BSplineCurve.getBasisMatrix で作る
+def benchmarkBasis(pointCounts=(6, 12, 24, 48)):
+    global g_NotVector
+    saved = g_NotVector
+    rng = np.random.default_rng(0)
+    print(
+        f"{'points':>7} {'samples':>8} {'getBaseN[ms]':>13} {'build[ms]':>10}"
+        f" {'multiply[ms]':>13} {'diff':>9}"
+    )
+    try:
+        for numPoints in pointCounts:
+            curve = BSplineCurve("uniform")
+            curve.extend(rng.uniform(0, 512, size=(numPoints, 2)))
+            points = curve.points
+            g_NotVector = list(curve.knots)
+
+            # getBasisMatrix と同じく、区間ごとに SPAN_SAMPLES 個ずつサンプリングする
+            start = time.perf_counter()
+            reference = []
+            for k in range(3 * SPAN_SAMPLES, numPoints * SPAN_SAMPLES):
+                t = k / SPAN_SAMPLES
+                point = np.zeros(2)
+                for i in range(numPoints):
+                    point += getBaseN(i, 3, t) * points[i]
+                reference.append(point)
+            naiveTime = time.perf_counter() - start
+
+            start = time.perf_counter()
+            matrix = curve.getBasisMatrix()
+            buildTime = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = curve.getBasisMatrix().multiply(points)
+            multiplyTime = time.perf_counter() - start
+
+            diff = np.abs(result - np.array(reference)).max()
+            print(
+                f"{numPoints:>7} {len(matrix.start):>8} {naiveTime * 1000:13.2f}"
+                f" {buildTime * 1000:10.3f} {multiplyTime * 1000:13.3f} {diff:9.2e}"
+            )
+    finally:
+        g_NotVector = saved
 
 
 # ウィンドウのサイズが変更されたときの処理
@@ -108,21 +475,30 @@ def mouse(button, state, x, y):
     if state == GLUT_DOWN:
         # 左ボタンだったらクリックした位置に制御点を置く
         if button == GLUT_LEFT_BUTTON:
-            # ノット数を増やせばいくらでも制御点を追加できるが、今回はノットベクトルが固定されているので
-            # いくらでも追加できるわけではない
-            if len(g_ControlPoints) < len(g_NotVector) - 4:
-                g_ControlPoints.append(np.array([x, y]))
+            # 曲線がノットベクトルを伸ばすので、いくらでも制御点を追加できる
+            g_Curve.append([x, y])
 
         # 右ボタンだったら末尾の制御点を削除
         if button == GLUT_RIGHT_BUTTON:
-            if g_ControlPoints:
-                g_ControlPoints.pop()
+            g_Curve.pop()
     glutPostRedisplay()
 
 
 # キーが押されたときのイベント処理
 def keyboard(key, x, y):
-    if key == b"q":
+    if key == b"k":  # k キーでノットベクトルの作り方を切り替える
+        mode = KNOT_MODES[(KNOT_MODES.index(g_Curve.knotMode) + 1) % len(KNOT_MODES)]
+        g_Curve.setKnotMode(mode)
+        print("knots:", mode, g_Curve.knots)
+    elif key == b"i":  # i キーで定義域の中央にノットを挿入する
+        n = len(g_Curve.points)
+        if n >= 4:
+            g_Curve.insertKnot(0.5 * (g_Curve.knots[3] + g_Curve.knots[n]))
+    elif key in [b"w", b"W"] and len(g_Curve.points) > 0:
+        # w / W キーで最後の制御点の重みを2倍 / 半分にする
+        scale = 2.0 if key == b"w" else 0.5
+        g_Curve.setWeight(-1, g_Curve.weights[-1] * scale)
+    elif key == b"q":
         pass
     elif key == b"Q":
         pass
@@ -143,7 +519,44 @@ def init():
 
 
 if __name__ == "__main__":
-    glutInit(sys.argv)  # ライブラリの初期化
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bench-cache",
+        action="store_true",
+        help="制御点を追加するたびの曲線の更新時間を比べて終了する",
+    )
+    parser.add_argument(
+        "--bench-basis",
+        action="store_true",
+        help="基底関数の計算方法ごとの時間を比べて終了する",
+    )
+    parser.add_argument(
+        "--knots",
+        choices=KNOT_MODES,
+        default="custom",
+        help="ノットベクトルの作り方 (custom は g_NotVector から始める)",
+    )
+    parser.add_argument("--random", type=int, default=0, help="乱数で置く制御点の数")
+    parser.add_argument(
+        "--bench-curve",
+        action="store_true",
+        help="10000 個の制御点の曲線の計算時間を測って終了する",
+    )
+    args, rest = parser.parse_known_args()
+    if args.bench_curve:
+        benchmarkCurve()
+        sys.exit(0)
+    if args.bench_basis:
+        benchmarkBasis()
+        sys.exit(0)
+    if args.bench_cache:
+        benchmarkCache()
+        sys.exit(0)
+    g_Curve.setKnotMode(args.knots)
+    rng = np.random.default_rng(0)
+    g_Curve.extend(rng.uniform(0, g_WindowWidth, size=(args.random, 2)))
+
+    glutInit([sys.argv[0]] + rest)  # ライブラリの初期化
     glutInitWindowSize(g_WindowWidth, g_WindowHeight)  # ウィンドウサイズを指定
     glutCreateWindow(sys.argv[0])  # ウィンドウを作成
     glutDisplayFunc(display)  # 表示関数を指定
@@ -1,5 +1,16 @@
+import argparse
+import gzip
+import os
+import sys
+import time
+import zipfile
+from collections import deque
+
 import numpy as np
-import math
+
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.arrays import getCellKeys, loadMappedNpz
 
 # 出力ファイル名
 OUTPUT_FILENAME = "parametric_surface.obj"
@@ -8,82 +19,832 @@ OUTPUT_FILENAME = "parametric_surface.obj"
 NUM_U = 50  # U方向の分割数
 NUM_V = 50  # V方向の分割数
 
-# 配列をnumpyで定義 (x, y, z座標)
-x = np.zeros((NUM_U + 1, NUM_V + 1))
-y = np.zeros((NUM_U + 1, NUM_V + 1))
-z = np.zeros((NUM_U + 1, NUM_V + 1))
+CHUNK_ROWS = 65536  # OBJ をまとめて整形する行数
+WRITE_BUFFER_SIZE = 1 << 22  # 書き出しのバッファの大きさ
+GZIP_LEVEL = 1  # gzip の圧縮レベル (書き出しの速さを優先する)
+# 座標を書き出す小数点以下の桁数
+# None にすると repr で誤差なく書き出すが、1行ずつ書く場合と比べて 1.2 倍ほどしか速くならない
+DEFAULT_DECIMALS = 6
 
 
 # u,v の値から3次元座標を返す関数
+# u, v は np.meshgrid で作った配列でもよく、その場合は同じ形の配列 x, y, z を返す
 def function(u, v):
     # 平面の場合
     # x = u * 100
     # y = v * 100
-    # z = 0
+    # z = np.zeros_like(u)
 
     # 波紋
     # x = u * 100
     # y = v * 100
-    # z = math.sin(8 * math.pi * math.sqrt((u) ** 2 + (v - 0.5) ** 2)) / 10 * 100
+    # z = np.sin(8 * np.pi * np.sqrt((u) ** 2 + (v - 0.5) ** 2)) / 10 * 100
 
     # ガウス関数
     # x = u * 100
     # y = v * 100
-    # z = math.exp(-((u - 0.5) ** 2 + (v - 0.5) ** 2) / 0.1) / 2 * 100
+    # z = np.exp(-((u - 0.5) ** 2 + (v - 0.5) ** 2) / 0.1) / 2 * 100
 
     # 球
-    x = math.cos(u * math.pi * 2) * math.cos((v * 2 - 1) * math.pi / 2)
-    y = math.sin(u * math.pi * 2) * math.cos((v * 2 - 1) * math.pi / 2)
-    z = math.sin((v * 2 - 1) * math.pi / 2)
+    x = np.cos(u * np.pi * 2) * np.cos((v * 2 - 1) * np.pi / 2)
+    y = np.sin(u * np.pi * 2) * np.cos((v * 2 - 1) * np.pi / 2)
+    z = np.sin((v * 2 - 1) * np.pi / 2)
 
     return x, y, z
 
 
-# 配列に座標値を設定する
-def setCoordinates():
-    for i in range(NUM_U + 1):
-        for j in range(NUM_V + 1):
-            # u と v の値を 0.0 ～ 1.0 に正規化する
-            u = 1.0 / NUM_U * i
-            v = 1.0 / NUM_V * j
+# u, v の値の配列 us, vs の全ての組み合わせで曲面 surface(u, v) を評価し、
+# 頂点 (u, v) を i * len(vs) + j 番目に並べた座標の配列 (V, 3) を返す
+def sampleSurface(surface, us, vs):
+    u, v = np.meshgrid(us, vs, indexing="ij")
+    vertices = np.empty((len(us), len(vs), 3))
+    for k, values in enumerate(surface(u, v)):
+        vertices[:, :, k] = values  # 定数を返す座標があってもよいように代入で広げる
+    return vertices.reshape(-1, 3)
 
-            # 座標値の設定
-            x[i][j], y[i][j], z[i][j] = function(u, v)
 
+# u 方向の firstRow 行目から lastRow 行目の手前までの格子の各マスを2つの三角形に分け、
+# 三角形の頂点番号 (0 から始まる) の int32 の配列 (F, 3) を返す
+def getGridFaces(numV, firstRow, lastRow):
+    index = np.arange(
+        firstRow * (numV + 1), (lastRow + 1) * (numV + 1), dtype=np.int32
+    ).reshape(-1, numV + 1)
+    lt = index[:-1, :-1]  # 左上の頂点番号
+    lb = index[:-1, 1:]  # 左下の頂点番号
+    rt = index[1:, :-1]  # 右上の頂点番号
+    rb = index[1:, 1:]  # 右下の頂点番号
+    faces = np.stack(
+        [np.stack([lb, rt, lt], axis=-1), np.stack([lb, rb, rt], axis=-1)], axis=2
+    )
+    return faces.reshape(-1, 3)
 
-# OBJ 形式でのファイル出力
-def exportOBJ():
+
+# u 方向に numU 個、v 方向に numV 個に分割した曲面 surface(u, v) のメッシュを作る
+# 頂点 (u, v) は i * (numV + 1) + j 番目に並べ、頂点の座標 (V, 3) と
+# 三角形の頂点番号 (0 から始まる) の int32 の配列 (F, 3) を返す
+def buildMesh(surface=function, numU=NUM_U, numV=NUM_V):
+    # u と v の値を 0.0 ～ 1.0 に正規化する
+    vertices = sampleSurface(
+        surface, np.arange(numU + 1) * (1.0 / numU), np.arange(numV + 1) * (1.0 / numV)
+    )
+    return vertices, getGridFaces(numV, 0, numU)
+
+
+# buildMesh と同じメッシュを u 方向 rows 行ずつ作るジェネレータ
+# ("v", 頂点の座標) と ("f", 頂点番号) の組を、面が使う頂点が先に出るように順に返すので、
+# メモリに乗らない大きさのメッシュでも writeOBJ で作りながら書き出せる
+def buildMeshChunks(surface=function, numU=NUM_U, numV=NUM_V, rows=CHUNK_ROWS):
+    vs = np.arange(numV + 1) * (1.0 / numV)
+    for start in range(0, numU + 1, rows):
+        stop = min(start + rows, numU + 1)
+        yield "v", sampleSurface(surface, np.arange(start, stop) * (1.0 / numU), vs)
+        # 前のまとまりの最後の行とこのまとまりの間の面も含める
+        first = max(start - 1, 0)
+        if stop - 1 > first:
+            yield "f", getGridFaces(numV, first, stop - 1)
+
+
+# 10 の累乗の表 (整数の桁数を調べるのに使う)
+POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
+
+# 整数の配列 values (N, 3) を1行ずつ "prefix a b c" の形式にしたバイト列を返す
+# decimals を指定すると、values を 10 ** decimals 倍した値として小数点以下 decimals 桁で書く
+# 数字を1桁ずつ配列の演算で出力用の uint8 の配列に書き込み、Python で1つずつ整形しない
+def formatIntegerLines(prefix, values, decimals=0):
+    negative = values < 0
+    magnitude = np.abs(values)
+    # 各値の桁数 (小数点以下があるときは、整数部の 0 を含めて decimals + 1 桁以上)
+    digits = np.maximum(
+        np.searchsorted(POWERS_OF_TEN, magnitude, side="right"), decimals + 1
+    )
+    width = negative + digits + (decimals > 0)
+
+    # 各行は prefix、(空白と値) x 3、改行からなる
+    lineLength = len(prefix) + 4 + width.sum(axis=1)
+    lineEnd = np.cumsum(lineLength)
+    out = np.full(lineEnd[-1], ord(" "), dtype=np.uint8)
+    out[lineEnd - 1] = ord("\n")
+    lineStart = lineEnd - lineLength
+    for k, char in enumerate(prefix.encode("ascii")):
+        out[lineStart + k] = char
+
+    # 各値の最後の文字の位置
+    last = (lineStart + len(prefix) - 1)[:, None] + np.cumsum(width + 1, axis=1)
+    out[(last - width + 1)[negative]] = ord("-")
+    if decimals > 0:
+        out[(last - decimals).ravel()] = ord(".")
+    minDigits = digits.min()
+    for k in range(digits.max()):
+        position = last - k - (k >= decimals > 0)
+        digit = (magnitude % 10 + ord("0")).astype(np.uint8)
+        if k < minDigits:
+            out[position] = digit
+        else:
+            mask = k < digits
+            out[position[mask]] = digit[mask]
+        magnitude //= 10
+    return out.tobytes()
+
+
+# 配列 values (N, 3) を1行ずつ "prefix a b c" の形式にしたバイト列を返す
+# 整数の配列と、小数の配列 (小数点以下 decimals 桁) は formatIntegerLines でまとめて整形する
+# decimals が None のときは誤差なく書けるように repr で整形する (遅い)
+def formatLines(prefix, values, decimals=DEFAULT_DECIMALS):
+    if np.issubdtype(values.dtype, np.integer):
+        return formatIntegerLines(prefix, values.astype(np.int64))
+    if decimals is not None:
+        scaled = np.rint(values * 10.0**decimals)
+        # 整数に収まらない値を含むときは下の % で整形する
+        if np.all(np.abs(scaled) < 2**62):
+            return formatIntegerLines(prefix, scaled.astype(np.int64), decimals)
+        fmt = f"%.{decimals}f"
+    else:
+        fmt = "%r"
+    line = f"{prefix} {fmt} {fmt} {fmt}\n"
+    return ((line * len(values)) % tuple(values.ravel().tolist())).encode("ascii")
+
+
+# ("v", 頂点の座標) と ("f", 頂点番号 (0 から始まる)) の組を順に OBJ 形式で書き出す
+# 頂点番号は書き出した頂点の数に関係なく、メッシュ全体での番号を指定する
+# 配列は CHUNK_ROWS 行ずつ整形して大きなバッファを通して書き出し、
+# ファイル名が .gz で終わるときは gzip で圧縮する
+# 座標は小数点以下 decimals 桁で書き出す (None にすると誤差なく書き出すが遅い)
+def writeOBJ(chunks, filename=OUTPUT_FILENAME, decimals=DEFAULT_DECIMALS):
     try:
         # ファイルを開く
-        with open(OUTPUT_FILENAME, "w") as fout:
-            # 頂点情報の出力
-            for i in range(NUM_U + 1):
-                for j in range(NUM_V + 1):
-                    # 各頂点の座標値を出力する
-                    fout.write(f"v {x[i][j]} {y[i][j]} {z[i][j]}\n")
-
-            # 面情報の出力
-            ###
-            # 課題：以下の部分を完成させて、面情報を出力するようにする
-            ###
-            for i in range(NUM_U):
-                for j in range(NUM_V):
-                    # OBJ形式では頂点番号は1から始まる
-                    lb_index = i * (NUM_U + 1) + j + 2  # 左下の頂点番号
-                    lt_index = i * (NUM_U + 1) + j + 1  # 左上の頂点番号
-                    rb_index = (i + 1) * (NUM_U + 1) + j + 2  # 右下の頂点番号
-                    rt_index = (i + 1) * (NUM_U + 1) + j + 1  # 右上の頂点番号
-
-                    # 三角形を構成する頂点番号を出力
-                    fout.write(f"f {lb_index} {rt_index} {lt_index}\n")
-                    fout.write(f"f {lb_index} {rb_index} {rt_index}\n")
+        if filename.endswith(".gz"):
+            fout = gzip.open(filename, "wb", compresslevel=GZIP_LEVEL)
+        else:
+            fout = open(filename, "wb", buffering=WRITE_BUFFER_SIZE)
+        with fout:
+            for kind, values in chunks:
+                for start in range(0, len(values), CHUNK_ROWS):
+                    block = values[start : start + CHUNK_ROWS]
+                    if kind == "v":
+                        # 頂点情報の出力
+                        fout.write(formatLines("v", block, decimals))
+                    else:
+                        # 面情報の出力 (OBJ形式では頂点番号は1から始まる)
+                        fout.write(formatLines("f", block + 1))
 
     except IOError as e:
         print(f"Error: {e}")
         exit(0)
 
 
+# OBJ 形式でのファイル出力
+def exportOBJ(vertices, faces, filename=OUTPUT_FILENAME, decimals=DEFAULT_DECIMALS):
+    writeOBJ([("v", vertices), ("f", faces)], filename, decimals)
+
+
+# OBJ の行の種類と、その行の先頭のキーワード
+LINE_VERTEX, LINE_TEXCOORD, LINE_NORMAL, LINE_FACE = 1, 2, 3, 4
+LINE_KEYWORDS = {LINE_VERTEX: b"v", LINE_TEXCOORD: b"vt", LINE_NORMAL: b"vn"}
+LINE_KEYWORDS[LINE_FACE] = b"f"
+LINE_WIDTHS = {LINE_VERTEX: 3, LINE_TEXCOORD: 2, LINE_NORMAL: 3}  # 読み込む値の数
+
+READ_CHUNK_BYTES = 1 << 24  # OBJ をまとめて解析する大きさ
+
+
+# OBJ の各行の先頭 lineStart の文字から行の種類の配列を返す (v, vt, vn, f 以外は 0)
+# data は行の先頭から2文字先まで読めるように、末尾に改行を付け足しておく
+def getLineKinds(data, lineStart):
+    kinds = np.zeros(len(lineStart), dtype=np.int8)
+    first, second, third = data[lineStart], data[lineStart + 1], data[lineStart + 2]
+    vertex = first == ord("v")
+    kinds[vertex & (second <= 32)] = LINE_VERTEX
+    kinds[vertex & (second == ord("t")) & (third <= 32)] = LINE_TEXCOORD
+    kinds[vertex & (second == ord("n")) & (third <= 32)] = LINE_NORMAL
+    kinds[(first == ord("f")) & (second <= 32)] = LINE_FACE
+    return kinds
+
+
+# 区切り文字の配列 separator で区切られた各トークンの先頭の文字なら True の配列を返す
+def getTokenStarts(separator):
+    return ~separator & np.concatenate(([True], separator[:-1]))
+
+
+# 位置 positions (昇順) のうち、各行 (先頭 starts、最後の行は末尾まで) にあるものの数を返す
+def countPerLine(positions, starts):
+    return np.diff(np.searchsorted(positions, starts), append=len(positions))
+
+
+# buf の start から end の手前までに書かれた整数を配列の演算で1桁ずつ読み、配列で返す
+def parseIntegers(buf, start, end):
+    negative = buf[start] == ord("-")
+    start = start + negative
+    length = end - start
+    values = np.zeros(len(start), dtype=np.int64)
+    invalid = length <= 0
+    for k in range(length.max(initial=0)):
+        inside = k < length
+        digit = buf[np.minimum(start + k, end - 1)] - np.uint8(ord("0"))
+        invalid |= inside & (digit > 9)
+        values = np.where(inside, values * 10 + digit, values)
+    if np.any(invalid):
+        raise ValueError("invalid index in face")
+    return np.where(negative, -values, values)
+
+
+# 頂点の座標などの行 (先頭 starts) だけを残した buf から、各行の最初の width 個の値を読む
+# キーワードとコメントを空白にした buf を np.fromstring でまとめて小数に変換し、
+# 値ごとに Python のオブジェクトを作らない
+def parseFloatLines(buf, starts, width):
+    counts = countPerLine(np.flatnonzero(getTokenStarts(buf <= 32)), starts)
+    if np.any(counts < width):
+        raise ValueError(f"expected {width} values per line")
+    try:
+        values = np.fromstring(buf, dtype=np.float64, sep=" ")
+    except ValueError:
+        values = None
+    if values is None or len(values) != counts.sum():
+        raise ValueError("invalid number in vertex data")
+    first = np.cumsum(counts) - counts
+    return values[first[:, None] + np.arange(width)]
+
+
+# 面の行 (先頭 starts) だけを残した buf から、各行の頂点の数と、
+# 各頂点の "v/vt/vn" の番号の配列 (C, 3) を返す (書かれていない番号は 0)
+def parseFaceLines(buf, starts):
+    space = buf <= 32
+    cornerStart = np.flatnonzero(getTokenStarts(space))
+    indices = np.zeros((len(cornerStart), 3), dtype=np.int64)
+    slash = buf == ord("/")
+    if not np.any(slash):
+        # "v" だけの面は、頂点の先頭と番号の先頭が同じになる
+        cornerEnd = np.flatnonzero(~space & np.concatenate((space[1:], [True]))) + 1
+        indices[:, 0] = parseIntegers(buf, cornerStart, cornerEnd)
+    else:
+        separator = space | slash
+        numberStart = np.flatnonzero(getTokenStarts(separator))
+        numberEnd = np.flatnonzero(~separator & np.concatenate((separator[1:], [True])))
+        # 番号がどの頂点の何番目 (v, vt, vn) のものかを、その前の "/" の数から求める
+        numbers = countPerLine(numberStart, cornerStart)
+        corner = np.repeat(np.arange(len(cornerStart)), numbers)
+        slashes = np.cumsum(slash, dtype=np.int32)
+        slot = slashes[numberStart] - slashes[cornerStart][corner]
+        if np.any(slot > 2):
+            raise ValueError("too many '/' in face")
+        indices[corner, slot] = parseIntegers(buf, numberStart, numberEnd + 1)
+    return countPerLine(cornerStart, starts), indices
+
+
+# 頂点の数が counts の多角形をそれぞれ扇形に三角形に分け、
+# 各三角形の頂点が全ての多角形の頂点を並べた中で何番目かを (T, 3) の配列で返す
+def triangulateFans(counts):
+    first = np.cumsum(counts) - counts
+    triangles = np.maximum(counts - 2, 0)
+    polygon = np.repeat(np.arange(len(counts)), triangles)
+    k = np.arange(len(polygon)) - np.repeat(np.cumsum(triangles) - triangles, triangles)
+    a = first[polygon]
+    return np.stack([a, a + k + 1, a + k + 2], axis=1)
+
+
+# OBJ ファイルを読み込み、名前から配列への辞書を返す
+# vertices (V, 3), texcoords (T, 2), normals (N, 3) と、三角形ごとの頂点番号 (0 から始まる)
+# faces, faceTexcoords, faceNormals (F, 3) int32 (書かれていない番号は -1) を持つ
+# 多角形の面は扇形に三角形に分け、負の番号はその行までに定義された数からの相対位置とする
+# ファイルを READ_CHUNK_BYTES ずつに分け、行の種類ごとにまとめて配列の演算で解析する
+# 行の途中からの "#" のコメントは読み飛ばす (行の先頭の空白には対応しない)
+def parseOBJ(filename):
+    raw = np.fromfile(filename, dtype=np.uint8)
+    data = np.full(len(raw) + 4, ord("\n"), dtype=np.uint8)
+    data[: len(raw)] = raw
+    lineEnd = np.flatnonzero(data[: len(raw) + 1] == ord("\n"))
+    lineStart = np.concatenate(([0], lineEnd[:-1] + 1))
+    kinds = getLineKinds(data, lineStart)
+    # 各行までに定義された頂点の座標などの数 (負の番号に使う)
+    defined = {kind: np.cumsum(kinds == kind) for kind in LINE_WIDTHS}
+
+    values = {kind: [] for kind in LINE_WIDTHS}
+    faceIndices = {kind: [] for kind in LINE_WIDTHS}
+    bounds = np.unique(
+        np.searchsorted(lineStart, np.arange(0, len(raw), READ_CHUNK_BYTES))
+    )
+    for first, last in zip(bounds, np.append(bounds[1:], len(lineStart))):
+        window = data[lineStart[first] : lineEnd[last - 1] + 1]
+        starts = lineStart[first:last] - lineStart[first]
+        lengths = lineEnd[first:last] - lineStart[first:last] + 1
+        windowKinds = kinds[first:last]
+        # 行の途中からのコメント ("#" から行末まで) を空白で消す
+        comment = window == ord("#")
+        if np.any(comment):
+            seen = np.cumsum(comment)
+            before = np.repeat(seen[starts] - comment[starts], lengths)
+            window = np.where(seen > before, np.uint8(ord(" ")), window)
+        for kind, keyword in LINE_KEYWORDS.items():
+            keep = windowKinds == kind
+            if not np.any(keep):
+                continue
+            # この種類の行だけを残し、キーワードを空白で消す
+            buf = np.where(np.repeat(keep, lengths), window, ord(" ")).astype(np.uint8)
+            for k in range(len(keyword)):
+                buf[starts[keep] + k] = ord(" ")
+            if kind != LINE_FACE:
+                values[kind].append(
+                    parseFloatLines(buf, starts[keep], LINE_WIDTHS[kind])
+                )
+                continue
+
+            counts, indices = parseFaceLines(buf, starts[keep])
+            triangles = triangulateFans(counts)
+            for column, indexKind in enumerate(LINE_WIDTHS):
+                index = indices[:, column] - 1  # 書かれていない番号は -1 になる
+                negative = index < -1
+                if np.any(negative):
+                    lines = np.repeat(np.flatnonzero(keep) + first, counts)[negative]
+                    index[negative] = defined[indexKind][lines] + index[negative] + 1
+                    if np.any(index[negative] < 0):
+                        raise ValueError("negative index out of range")
+                faceIndices[indexKind].append(index[triangles])
+
+    mesh = {}
+    for kind, name, faceName in (
+        (LINE_VERTEX, "vertices", "faces"),
+        (LINE_TEXCOORD, "texcoords", "faceTexcoords"),
+        (LINE_NORMAL, "normals", "faceNormals"),
+    ):
+        empty = np.empty((0, LINE_WIDTHS[kind]))
+        mesh[name] = np.concatenate(values[kind] or [empty])
+        indices = np.concatenate(faceIndices[kind] or [np.empty((0, 3), np.int64)])
+        if np.any(indices >= len(mesh[name])):
+            raise ValueError(f"{faceName} index out of range")
+        mesh[faceName] = indices.astype(np.int32)
+    return mesh
+
+
+# OBJ ファイルを読み込み、parseOBJ と同じ辞書を返す
+# cache が True なら、解析した配列を filename + ".npz" に保存しておき、
+# 次からは元のファイルの更新時刻と大きさが同じ間、それを np.memmap で割り当てて返す
+def loadOBJ(filename, cache=True):
+    cacheName = filename + ".npz"
+    status = os.stat(filename)
+    source = np.array([status.st_mtime_ns, status.st_size], dtype=np.int64)
+    if cache and os.path.exists(cacheName):
+        try:
+            mesh = loadMappedNpz(cacheName)
+            if np.array_equal(mesh.pop("source", None), source):
+                return mesh
+        except (OSError, ValueError, zipfile.BadZipFile):
+            pass  # 壊れたキャッシュは作り直す
+
+    mesh = parseOBJ(filename)
+    if cache:
+        # 書き込み途中のキャッシュを読まないように、別の名前で書いてから置き換える
+        temporaryName = f"{cacheName}.{os.getpid()}.tmp"
+        try:
+            with open(temporaryName, "wb") as f:
+                np.savez(f, source=source, **mesh)
+            os.replace(temporaryName, cacheName)
+        except IOError as e:
+            print(f"Warning: cannot write {cacheName}: {e}")
+    return mesh
+
+
+WELD_EPSILON = 1e-6  # この距離より近い頂点を1つにまとめる
+CACHE_SIZE = 16  # 三角形の並べ替えで想定する頂点キャッシュの大きさ
+# 縮退しているとみなす三角形の面積 (メッシュのバウンディングボックスの対角線の長さの2乗に対する比)
+DEGENERATE_AREA = 1e-12
+
+
+# 距離が epsilon 未満の頂点をまとめ、各頂点をまとめた先の頂点 (まとまりの中で最小の番号) の配列を返す
+# 一辺 2 * epsilon の格子の空間ハッシュで、各頂点から epsilon 以内にかかる 8 セルだけを調べる
+def weldVertices(vertices, epsilon=WELD_EPSILON):
+    n = len(vertices)
+    tableSize = 1 << max(2 * n - 1, 1).bit_length()
+    scaled = vertices / (2 * epsilon)
+    cells = np.floor(scaled).astype(np.int64)
+    keys = getCellKeys(cells, tableSize)
+    order = np.argsort(keys, kind="stable")
+    # ハッシュ表の各番号のバケットが order の何番目から何個あるか
+    bucketCounts = np.bincount(keys, minlength=tableSize)
+    bucketStarts = np.cumsum(bucketCounts) - bucketCounts
+
+    # 各軸でセルの中心より小さい側にある頂点は -1 側、大きい側にある頂点は +1 側の隣を調べる
+    side = np.where(scaled - cells < 0.5, -1, 1)
+    corners = np.stack(
+        np.meshgrid([0, 1], [0, 1], [0, 1], indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    queryKeys = getCellKeys(cells[:, None, :] + corners * side[:, None, :], tableSize)
+    start = bucketStarts[queryKeys.ravel()]
+    counts = bucketCounts[queryKeys.ravel()]
+
+    # バケットの中の頂点を全て候補の組にし、近いものだけを残す
+    total = counts.sum()
+    a = np.repeat(np.arange(n).repeat(len(corners)), counts)
+    first = np.cumsum(counts) - counts
+    b = order[np.repeat(start - first, counts) + np.arange(total)]
+    keep = a < b
+    a, b = a[keep], b[keep]
+    d = vertices[b] - vertices[a]
+    close = np.einsum("ij,ij->i", d, d) < epsilon * epsilon
+    a, b = a[close], b[close]
+
+    # 組でつながった頂点に、その中で最小の番号が行き渡るまで繰り返す
+    labels = np.arange(n)
+    while True:
+        smaller = np.minimum(labels[a], labels[b])
+        updated = labels.copy()
+        np.minimum.at(updated, a, smaller)
+        np.minimum.at(updated, b, smaller)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+# 三角形の頂点番号 faces の順に、大きさ cacheSize の FIFO の頂点キャッシュを使ったときの
+# 三角形あたりのキャッシュミスの数 (ACMR) を返す
+def getACMR(faces, cacheSize=CACHE_SIZE):
+    cache = deque()
+    cached = set()
+    misses = 0
+    for v in faces.ravel().tolist():
+        if v not in cached:
+            misses += 1
+            cache.append(v)
+            cached.add(v)
+            if len(cache) > cacheSize:
+                cached.discard(cache.popleft())
+    return misses / max(len(faces), 1)
+
+
+# 頂点キャッシュを効率よく使えるように三角形を並べ替えた faces を返す (Tipsify)
+# 頂点のまわりの三角形を扇形にまとめて出し、次の頂点はキャッシュに残っている頂点から選ぶ
+# (P. V. Sander, D. Nehab, J. Barczak, "Fast Triangle Reordering for Vertex Locality
+# and Reduced Overdraw", 2007)
+# 三角形を1つずつ順に決めるので Python のループになり、三角形 100 万個あたり 4 秒ほどかかる
+def tipsify(faces, numVertices, cacheSize=CACHE_SIZE):
+    corners = faces.ravel()
+    live = np.bincount(corners, minlength=numVertices)
+    offsets = np.concatenate(([0], np.cumsum(live))).tolist()
+    adjacency = (np.argsort(corners, kind="stable") // 3).tolist()
+    live = live.tolist()
+    triangles = faces.tolist()
+    emitted = [False] * len(triangles)
+    timestamps = [0] * numVertices
+    clock = cacheSize + 1
+    deadEnd = []
+    cursor = 0
+    output = []
+
+    fanning = int(corners[0]) if len(corners) > 0 else -1
+    while fanning >= 0:
+        # fanning のまわりのまだ出していない三角形を出す
+        candidates = []
+        for t in adjacency[offsets[fanning] : offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            output.append(t)
+            for v in triangles[t]:
+                deadEnd.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if clock - timestamps[v] > cacheSize:
+                    timestamps[v] = clock
+                    clock += 1
+
+        # 次の頂点は、残りの三角形を出し終えるまでキャッシュに残っていそうなもののうち最も古いもの
+        fanning, best = -1, -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if clock - timestamps[v] + 2 * live[v] <= cacheSize:
+                    priority = clock - timestamps[v]
+                if priority > best:
+                    fanning, best = v, priority
+        if fanning < 0:
+            # 候補がなければ、最近使った頂点、それもなければ番号順に残りの三角形を持つ頂点を探す
+            while deadEnd and fanning < 0:
+                v = deadEnd.pop()
+                if live[v] > 0:
+                    fanning = v
+            while fanning < 0 and cursor < numVertices:
+                if live[cursor] > 0:
+                    fanning = cursor
+                cursor += 1
+    return faces[output]
+
+
+# メッシュを最適化し、頂点、三角形の頂点番号と、各段階の頂点と三角形の数の辞書を返す
+# 距離 epsilon 未満の頂点をまとめ、縮退した (面積がバウンディングボックスの対角線の長さの2乗の
+# DEGENERATE_AREA 倍以下の) 三角形を取り除き、
+# reorder が True なら三角形を tipsify で並べ替え、頂点を三角形で最初に使われる順に詰め直す
+def optimizeMesh(vertices, faces, epsilon=WELD_EPSILON, reorder=True):
+    stats = {"vertices": len(vertices), "faces": len(faces)}
+    labels = weldVertices(vertices, epsilon)
+    faces = labels[faces]
+    stats["weldedVertices"] = len(np.unique(labels))
+
+    p0, p1, p2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    area = np.linalg.norm(np.cross(p1 - p0, p2 - p0), axis=1) / 2
+    diagonal = np.linalg.norm(np.ptp(vertices, axis=0)) if len(vertices) > 0 else 0.0
+    degenerate = (
+        (faces[:, 0] == faces[:, 1])
+        | (faces[:, 1] == faces[:, 2])
+        | (faces[:, 2] == faces[:, 0])
+        | (area <= DEGENERATE_AREA * diagonal * diagonal)
+    )
+    faces = faces[~degenerate]
+    stats["degenerateFaces"] = int(degenerate.sum())
+
+    if reorder:
+        faces = tipsify(faces, len(vertices))
+
+    # 使われている頂点だけを、三角形で最初に使われる順に並べる
+    used, firstUse = np.unique(faces.ravel(), return_index=True)
+    order = used[np.argsort(firstUse)]
+    remap = np.full(len(vertices), -1, dtype=np.int32)
+    remap[order] = np.arange(len(order), dtype=np.int32)
+    stats["optimizedVertices"] = len(order)
+    stats["optimizedFaces"] = len(faces)
+    return vertices[order], remap[faces], stats
+
+
+# optimizeMesh の結果と、最適化の前後の faces から求めた ACMR を表示する
+def printOptimizeStats(stats, facesBefore, facesAfter):
+    vertices, optimizedVertices = stats["vertices"], stats["optimizedVertices"]
+    faces, optimizedFaces = stats["faces"], stats["optimizedFaces"]
+    print(
+        f"vertices: {vertices} -> {optimizedVertices}"
+        f" (-{vertices - optimizedVertices}, -{100 * (1 - optimizedVertices / vertices):.1f}%)"
+    )
+    print(
+        f"faces: {faces} -> {optimizedFaces}"
+        f" (-{stats['degenerateFaces']} degenerate, -{100 * (1 - optimizedFaces / faces):.1f}%)"
+    )
+    print(
+        f"ACMR (FIFO {CACHE_SIZE}): {getACMR(facesBefore):.3f} -> {getACMR(facesAfter):.3f}"
+    )
+
+
+# 分割数 size x size のメッシュを作る時間を測る
+# 比較のため、1頂点ずつ function を呼んで面を二重ループで作る場合の時間も loopSize x loopSize で測る
+def benchmark(size=2000, loopSize=200):
+    start = time.perf_counter()
+    vertices, faces = buildMesh(function, size, size)
+    elapsed = time.perf_counter() - start
+    print(
+        f"build {size}x{size}: {elapsed * 1000:.1f} ms"
+        f" ({len(vertices)} vertices, {len(faces)} faces)"
+    )
+
+    start = time.perf_counter()
+    loopVertices = []
+    for i in range(loopSize + 1):
+        for j in range(loopSize + 1):
+            u = 1.0 / loopSize * i
+            v = 1.0 / loopSize * j
+            loopVertices.append([float(c) for c in function(u, v)])
+    loopFaces = []
+    for i in range(loopSize):
+        for j in range(loopSize):
+            lb = i * (loopSize + 1) + j + 1
+            lt = i * (loopSize + 1) + j
+            rb = (i + 1) * (loopSize + 1) + j + 1
+            rt = (i + 1) * (loopSize + 1) + j
+            loopFaces.append([lb, rt, lt])
+            loopFaces.append([lb, rb, rt])
+    loopTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vertices, faces = buildMesh(function, loopSize, loopSize)
+    elapsed = time.perf_counter() - start
+    print(
+        f"loop  {loopSize}x{loopSize}: {loopTime * 1000:.1f} ms,"
+        f" build {elapsed * 1000:.2f} ms, same faces:"
+        f" {np.array_equal(faces, loopFaces)},"
+        f" max diff {np.abs(vertices - loopVertices).max():.1e}"
+    )
+
+
+# プロセスの最大メモリ使用量を返す
+# resource モジュールは Unix にしかないので、使えない環境では "n/a" を返す
+def getPeakMemory():
+    try:
+        import resource
+    except ImportError:
+        return "n/a"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB 単位、macOS はバイト単位
+    if sys.platform == "darwin":
+        peak /= 1024
+    return f"{peak / 1024:.0f} MB"
+
+
+# 分割数 size x size のメッシュを OBJ 形式で書き出す時間を測る
+# buildMeshChunks で作りながら書き出す場合 (メッシュ全体を作る前に最大メモリ使用量を測る)、
+# 1行ずつ repr で書く場合、まとめて整形する場合 (誤差なし、小数点以下 DEFAULT_DECIMALS 桁)、
+# gzip で圧縮する場合を比べる
+# 書き出したファイルは directory に置く
+def benchmarkExport(size=1000, directory="."):
+    streamName = os.path.join(directory, "bench_stream.obj")
+    start = time.perf_counter()
+    writeOBJ(buildMeshChunks(function, size, size), streamName)
+    elapsed = time.perf_counter() - start
+    print(f"{size}x{size} stream: {elapsed:.2f} s, peak memory {getPeakMemory()}")
+
+    vertices, faces = buildMesh(function, size, size)
+    print(f"  {len(vertices)} vertices, {len(faces)} faces")
+    loopName = os.path.join(directory, "bench_loop.obj")
+    start = time.perf_counter()
+    with open(loopName, "w") as fout:
+        for x, y, z in vertices.tolist():
+            fout.write(f"v {x} {y} {z}\n")
+        for a, b, c in (faces + 1).tolist():
+            fout.write(f"f {a} {b} {c}\n")
+    loopTime = time.perf_counter() - start
+    print(f"  per line: {loopTime:.2f} s")
+
+    # 誤差なしの出力は1行ずつ書いた場合と、桁数を指定した出力は stream と同じになるはず
+    for name, decimals, sameName in (
+        ("bench_lossless.obj", None, loopName),
+        ("bench.obj", DEFAULT_DECIMALS, streamName),
+        ("bench.obj.gz", DEFAULT_DECIMALS, None),
+    ):
+        filename = os.path.join(directory, name)
+        start = time.perf_counter()
+        exportOBJ(vertices, faces, filename, decimals)
+        elapsed = time.perf_counter() - start
+        same = ""
+        if sameName is not None:
+            with open(filename, "rb") as f1, open(sameName, "rb") as f2:
+                same = (
+                    f", same as {os.path.basename(sameName)}: {f1.read() == f2.read()}"
+                )
+        print(
+            f"  {name}: {elapsed:.2f} s ({loopTime / elapsed:.1f}x),"
+            f" {os.path.getsize(filename) / 2**20:.1f} MB{same}"
+        )
+
+
+# 分割数 size x size のメッシュを書き出した OBJ を読み込む時間を測る
+# 1行ずつ読む場合、parseOBJ で解析する場合 (キャッシュの保存を含む)、キャッシュから読む場合を比べる
+def benchmarkLoad(size=1000, directory="."):
+    vertices, faces = buildMesh(function, size, size)
+    filename = os.path.join(directory, "bench_load.obj")
+    # 読み込んだ座標を元の座標と比べるため、誤差なく書き出す
+    exportOBJ(vertices, faces, filename, None)
+    if os.path.exists(filename + ".npz"):
+        os.remove(filename + ".npz")
+    print(
+        f"{size}x{size}: {len(vertices)} vertices, {len(faces)} faces,"
+        f" {os.path.getsize(filename) / 2**20:.1f} MB"
+    )
+
+    start = time.perf_counter()
+    loopVertices, loopFaces = [], []
+    with open(filename) as fin:
+        for line in fin:
+            tokens = line.split()
+            if tokens[0] == "v":
+                loopVertices.append([float(t) for t in tokens[1:4]])
+            elif tokens[0] == "f":
+                loopFaces.append([int(t.split("/")[0]) - 1 for t in tokens[1:]])
+    loopTime = time.perf_counter() - start
+    print(f"  per line: {loopTime:.2f} s")
+
+    for name in ("parse", "cached"):
+        start = time.perf_counter()
+        mesh = loadOBJ(filename)
+        elapsed = time.perf_counter() - start
+        same = np.array_equal(mesh["vertices"], vertices) and np.array_equal(
+            mesh["faces"], faces
+        )
+        print(
+            f"  {name}: {elapsed * 1000:.1f} ms ({loopTime / elapsed:.0f}x),"
+            f" same as written: {same}"
+        )
+
+
+# 分割数 size x size のメッシュを最適化する時間と、最適化の前後の OBJ の大きさ、ACMR を比べる
+# 書き出したファイルは directory に置く
+def benchmarkOptimize(size=500, directory="."):
+    vertices, faces = buildMesh(function, size, size)
+    start = time.perf_counter()
+    weldVertices(vertices)
+    weldTime = time.perf_counter() - start
+    start = time.perf_counter()
+    optimizedVertices, optimizedFaces, stats = optimizeMesh(vertices, faces)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{size}x{size}: optimize {elapsed:.2f} s (weld {weldTime:.2f} s,"
+        f" reorder and compact {elapsed - weldTime:.2f} s)"
+    )
+    printOptimizeStats(stats, faces, optimizedFaces)
+
+    for name, v, f in (
+        ("bench_plain.obj", vertices, faces),
+        ("bench_optimized.obj", optimizedVertices, optimizedFaces),
+    ):
+        filename = os.path.join(directory, name)
+        exportOBJ(v, f, filename)
+        print(f"  {name}: {os.path.getsize(filename) / 2**20:.2f} MB")
+
+
 # メイン処理
 if __name__ == "__main__":
-    setCoordinates()
-    exportOBJ()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-u", type=int, default=NUM_U, help="U方向の分割数")
+    parser.add_argument("--num-v", type=int, default=NUM_V, help="V方向の分割数")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=OUTPUT_FILENAME,
+        help="出力ファイル名 (.gz で終わるときは gzip で圧縮する)",
+    )
+    parser.add_argument(
+        "--bench", action="store_true", help="メッシュを作る時間を測って終了する"
+    )
+    parser.add_argument(
+        "--decimals",
+        type=int,
+        default=DEFAULT_DECIMALS,
+        help="座標を書き出す小数点以下の桁数",
+    )
+    parser.add_argument(
+        "--lossless",
+        action="store_true",
+        help="座標を誤差なく書き出す (--decimals より数倍遅い)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="メッシュを少しずつ作りながら書き出す (メモリに乗らない大きさ向け)",
+    )
+    parser.add_argument(
+        "--bench-export",
+        action="store_true",
+        help="OBJ を書き出す時間を測って終了する",
+    )
+    parser.add_argument(
+        "--load", metavar="FILE", help="OBJ を読み込んで頂点と面の数を表示する"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="--load でキャッシュを使わない"
+    )
+    parser.add_argument(
+        "--bench-load",
+        action="store_true",
+        help="OBJ を読み込む時間を測って終了する",
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="頂点をまとめ、縮退した三角形を除き、三角形を並べ替えてから書き出す",
+    )
+    parser.add_argument(
+        "--epsilon",
+        type=float,
+        default=WELD_EPSILON,
+        help="--optimize でまとめる頂点の距離",
+    )
+    parser.add_argument(
+        "--no-reorder",
+        action="store_true",
+        help="--optimize で三角形を並べ替えない",
+    )
+    parser.add_argument(
+        "--bench-optimize",
+        action="store_true",
+        help="メッシュを最適化する時間と効果を測って終了する",
+    )
+    args = parser.parse_args()
+    if args.lossless:
+        args.decimals = None
+    if args.optimize and args.stream:
+        parser.error("--optimize needs the whole mesh and cannot be used with --stream")
+    if args.load:
+        start = time.perf_counter()
+        mesh = loadOBJ(args.load, not args.no_cache)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{args.load}: {len(mesh['vertices'])} vertices,"
+            f" {len(mesh['normals'])} normals, {len(mesh['texcoords'])} texcoords,"
+            f" {len(mesh['faces'])} faces ({elapsed * 1000:.1f} ms)"
+        )
+    elif args.bench:
+        benchmark()
+    elif args.bench_export:
+        benchmarkExport()
+    elif args.bench_load:
+        benchmarkLoad()
+    elif args.bench_optimize:
+        benchmarkOptimize()
+    elif args.stream:
+        writeOBJ(
+            buildMeshChunks(function, args.num_u, args.num_v),
+            args.output,
+            args.decimals,
+        )
+    else:
+        vertices, faces = buildMesh(function, args.num_u, args.num_v)
+        if args.optimize:
+            optimizedVertices, optimizedFaces, stats = optimizeMesh(
+                vertices, faces, args.epsilon, not args.no_reorder
+            )
+            printOptimizeStats(stats, faces, optimizedFaces)
+            vertices, faces = optimizedVertices, optimizedFaces
+        exportOBJ(vertices, faces, args.output, args.decimals)
@@ -1,9 +1,15 @@
+import argparse
+import atexit
+import os
+import pickle
+import struct
 import sys
+import zlib
+from multiprocessing import Pool, shared_memory
 
 import numpy as np
-from OpenGL.GL import *
-from OpenGL.GLU import *
-from OpenGL.GLUT import *
+
+# OpenGL はウィンドウに表示するときだけ読み込む (ファイル出力のときは読み込まない)
 
 
 # 3次元ベクトルを作る
@@ -17,6 +23,19 @@ def normalize(v):
     return v / norm if norm > 0.0 else v
 
 
+# ベクトル v を y 軸まわりに deg 度回転する
+def rotateY(v, deg):
+    c = np.cos(np.radians(deg))
+    s = np.sin(np.radians(deg))
+    return vec3(c * v[0] + s * v[2], v[1], -s * v[0] + c * v[2])
+
+
+# (N, 3) の配列の各行を長さ1に正規化する
+def normalizeRows(v):
+    norm = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, norm, out=np.array(v, dtype=np.float64), where=norm > 0.0)
+
+
 # 球体
 class Sphere:
     def __init__(self, center, radius, color):
@@ -45,10 +64,30 @@ class Sphere:
         else:
             return -1.0
 
+    # getIntersect のレイ束版。p は (3,) または (N, 3)、v は (N, 3) の配列
+    # 各レイについて t の値を並べた (N,) の配列を返す。交わらないレイは -1
+    def getIntersectBatch(self, p, v):
+        pc = p - self.center
+        A = np.einsum("ij,ij->i", v, v)
+        B = 2.0 * np.einsum("ij,ij->i", v, np.broadcast_to(pc, v.shape))
+        C = np.einsum("...j,...j->...", pc, pc) - self.radius * self.radius
+        D = B * B - 4 * A * C  # 判別式
+
+        t = np.full(len(v), -1.0)
+        hit = D > 0.0  # 交わる
+        sqrtD = np.sqrt(D[hit])
+        t1 = (-B[hit] - sqrtD) / (2.0 * A[hit])
+        t2 = (-B[hit] + sqrtD) / (2.0 * A[hit])
+        t[hit] = np.where(t1 >= 0.0, t1, t2)
+        return t
+
 
 g_WindowID = 0  # ウィンドウ識別子
 g_HalfWidth = 200  # 描画領域の横幅/2
 g_HalfHeight = 200  # 描画領域の縦幅/2
+g_ImageBuffer = None  # 画面に表示する (H, W, 3) の画像バッファ
+g_GBufferCache = None  # 前回の一次レイの交差判定の結果 (GBuffer)
+g_GBufferCacheKey = None  # g_GBufferCache を作ったときの getGBufferKey の値
 
 # 各種定数
 g_Distance = 1000  # 視点と投影面との距離
@@ -57,6 +96,9 @@ g_Kd = 0.8  # 拡散反射定数
 g_Ks = 0.8  # 鏡面反射定数
 g_Iin = 1.0  # 入射光の強さ
 g_Ia = 0.2  # 環境光
+g_SuperSampling = 1  # 1ピクセルあたりの縦横のサンプル数
+g_NumProcesses = os.cpu_count() or 1  # レンダリングに使うプロセス数
+g_TileSize = 64  # 並列レンダリングで分割するタイルの一辺のピクセル数
 
 g_Viewpoint = vec3(0.0, 0.0, 0.0)  # 視点位置
 g_LightDirection = vec3(-2.0, -4.0, -2.0)  # 入射光の進行方向
@@ -100,25 +142,462 @@ def getPixelColor(x, y):
     return vec3(0.0, 0.0, 0.0)  # 背景色
 
 
+# x0 <= x < x1, y0 <= y < y1 の範囲のピクセルについて、全サンプルの一次レイの方向を
+# (H*S*W*S, 3) の配列としてまとめて作る (S はサンプル数)
+# 並びは (H, S, W, S) を平坦化した順で、ピクセル (x, y) のサンプルは
+# (x + x_i / S, y + y_i / S) になる
+def getPrimaryRays(x0, x1, y0, y1, samples=1):
+    offsets = np.arange(samples) / samples
+    xs = (np.arange(x0, x1)[:, None] + offsets).ravel()
+    ys = (np.arange(y0, y1)[:, None] + offsets).ravel()
+    X, Y = np.meshgrid(xs, ys)
+    rays = np.empty((X.size, 3))
+    rays[:, 0] = X.ravel()
+    rays[:, 1] = Y.ravel()
+    rays[:, 2] = -g_Distance
+    return normalizeRows(rays - g_Viewpoint)
+
+
+# 一次レイの交差判定の結果 (G-buffer)。レイごとに交点の t、物体の番号、交点の位置、法線を持つ
+# 光源や材質の定数を変えただけなら、これを使い回して陰影の計算だけをやり直せばよい
+class GBuffer:
+    def __init__(self, rays, t, objectId, position, normal):
+        self.rays = rays  # 一次レイの方向 (N, 3)
+        self.t = t  # 交点までの距離 (N,)。交わらない場合は -1
+        self.objectId = objectId  # 交わった物体の番号 (N,)。0 が球、-1 は交点なし
+        self.position = position  # 交点の位置 (N, 3)
+        self.normal = normal  # 交点での単位法線ベクトル (N, 3)
+
+    # (..., GBUFFER_COLUMNS) の配列 out に詰めて書き込む (プロセス間で受け渡すため)
+    # out の (...) の部分の要素数はレイの数と同じにする
+    def pack(self, out):
+        shape = out.shape[:-1]
+        out[..., 0:3] = self.rays.reshape(shape + (3,))
+        out[..., 3] = self.t.reshape(shape)
+        out[..., 4] = self.objectId.reshape(shape)
+        out[..., 5:8] = self.position.reshape(shape + (3,))
+        out[..., 8:11] = self.normal.reshape(shape + (3,))
+
+    # pack で詰めた配列から G-buffer を作る (配列はコピーする)
+    @classmethod
+    def unpack(cls, packed):
+        packed = packed.reshape(-1, GBUFFER_COLUMNS)
+        return cls(
+            packed[:, 0:3].copy(),
+            packed[:, 3].copy(),
+            packed[:, 4].astype(np.int64),
+            packed[:, 5:8].copy(),
+            packed[:, 8:11].copy(),
+        )
+
+
+GBUFFER_COLUMNS = 11  # GBuffer.pack で1レイあたりに使う値の数
+
+
+# 一次レイの交差判定だけを行い、G-buffer を作る
+def getGBuffer(rays):
+    # レイを飛ばして球との交点を求める
+    t = g_Sphere.getIntersectBatch(g_Viewpoint, rays)
+    hit = t > 0.0  # 球との交点がある
+    objectId = np.where(hit, 0, -1)
+
+    # 交点の位置と単位法線ベクトルを求める
+    position = np.zeros((len(rays), 3))
+    normal = np.zeros((len(rays), 3))
+    position[hit] = g_Viewpoint + t[hit, None] * rays[hit]
+    normal[hit] = normalizeRows(position[hit] - g_Sphere.center)
+    return GBuffer(rays, t, objectId, position, normal)
+
+
+# G-buffer から陰影を計算する。(N, 3) の色の配列を返す
+def shadeGBuffer(gbuffer):
+    hit = gbuffer.objectId == 0  # 球との交点がある
+    ray = gbuffer.rays[hit]
+    n = gbuffer.normal[hit]
+
+    # 光線の反射方向ベクトルを求める
+    LN = n @ -g_LightDirection
+    r = g_LightDirection + 2 * LN[:, None] * n
+
+    Id = g_Iin * g_Kd * np.maximum(LN, 0.0)
+    Is = g_Iin * g_Ks * np.maximum(np.einsum("ij,ij->i", r, -ray), 0.0) ** 5
+
+    colors = np.zeros((len(gbuffer.rays), 3))  # 背景色
+    I = Id[:, None] * g_Sphere.color + Is[:, None] + g_Ia
+    colors[hit] = np.minimum(I, 1.0)  # 1.0 を超えないようにする
+    return colors
+
+
+# getPixelColor を全レイ分まとめて配列演算で計算する。(N, 3) の色の配列を返す
+def getRayColors(rays):
+    return shadeGBuffer(getGBuffer(rays))
+
+
+# G-buffer のキャッシュが使えるかどうかを決める値
+# 視点、描画範囲、サンプル数、物体の形のどれかが変わると変わる
+def getGBufferKey(x0, x1, y0, y1, samples):
+    return (
+        (x0, x1, y0, y1, samples),
+        tuple(g_Viewpoint),
+        g_Distance,
+        tuple(g_Sphere.center),
+        g_Sphere.radius,
+    )
+
+
+# 前回と同じ一次レイなら保存しておいた G-buffer を返し、そうでなければ作り直す
+def getCachedGBuffer(x0, x1, y0, y1, samples=1):
+    global g_GBufferCache, g_GBufferCacheKey
+    key = getGBufferKey(x0, x1, y0, y1, samples)
+    if g_GBufferCache is None or g_GBufferCacheKey != key:
+        g_GBufferCache = getGBuffer(getPrimaryRays(x0, x1, y0, y1, samples))
+        g_GBufferCacheKey = key
+    return g_GBufferCache
+
+
+# x0 <= x < x1, y0 <= y < y1 の範囲について、1ピクセルあたり samples x samples 個の
+# サンプルを平均した画像を計算する
+# 結果は (H, W, 3) の画像で、tile[y - y0, x - x0] が座標 (x, y) の色
+# out を指定するとその配列に書き込んで返す
+# 一次レイの交差判定は前回から変わっていなければ G-buffer のキャッシュを使う
+def renderTile(x0, x1, y0, y1, samples=1, out=None):
+    H = y1 - y0
+    W = x1 - x0
+    colors = shadeGBuffer(getCachedGBuffer(x0, x1, y0, y1, samples))
+    return colors.reshape(H, samples, W, samples, 3).mean(axis=(1, 3), out=out)
+
+
+# 画面全体を計算する
+# 結果は (H, W, 3) の画像で、image[y + halfHeight, x + halfWidth] が座標 (x, y) の色
+def renderImage(halfWidth, halfHeight, samples=1, out=None):
+    return renderTile(
+        -halfWidth, halfWidth + 1, -halfHeight, halfHeight + 1, samples, out
+    )
+
+
+# ワーカープロセスへ送るシーンの変数
+SCENE_NAMES = [
+    "g_Sphere",
+    "g_Viewpoint",
+    "g_LightDirection",
+    "g_Distance",
+    "g_Shininess",
+    "g_Kd",
+    "g_Ks",
+    "g_Iin",
+    "g_Ia",
+]
+
+g_Pool = None  # 並列レンダリングに使い続けるプロセスプール
+g_PoolProcesses = 0  # g_Pool のプロセス数
+g_SceneMemory = None  # ワーカープロセスへ渡すシーン (pickle したもの) の共有メモリ
+g_SceneBytes = None  # g_SceneMemory に置いてあるシーン
+g_SceneVersion = 0  # シーンを置き直すたびに増やす番号
+g_ImageMemory = None  # ワーカープロセスが計算した画像を受け取る共有メモリ
+g_GBufferMemory = None  # ワーカープロセスが作った G-buffer を受け取る共有メモリ
+g_ParallelMinRays = 1 << 20  # 一次レイがこれより少ない画像はプロセスを使わずに計算する
+
+g_WorkerMemories = {}  # ワーカープロセスが開いている共有メモリ (用途ごとに1つ)
+g_WorkerSceneVersion = -1  # ワーカープロセスが読み込んであるシーンの番号
+
+
+# 現在のシーンを辞書にまとめる
+def getScene():
+    return {name: globals()[name] for name in SCENE_NAMES}
+
+
+# 並列レンダリングに使うプロセスプールを返す
+# 最初に1回だけ作って使い回すので、プロセスの起動は描画のたびには起こらない
+def getPool(processes):
+    global g_Pool, g_PoolProcesses
+    if g_Pool is None or g_PoolProcesses != processes:
+        if g_Pool is not None:
+            g_Pool.close()
+            g_Pool.join()
+        g_Pool = Pool(processes)
+        g_PoolProcesses = processes
+    return g_Pool
+
+
+# 大きさ size バイト以上の共有メモリを返す。memory が足りなければ作り直す
+def reserveSharedMemory(memory, size):
+    if memory is not None and memory.size >= size:
+        return memory
+    if memory is not None:
+        memory.close()
+        memory.unlink()
+    return shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+
+# 現在のシーンを共有メモリに置き、(共有メモリの名前, 大きさ, 番号) を返す
+# 前回から変わっていなければ置き直さず、番号も変えないのでワーカーも読み込み直さない
+def shareScene():
+    global g_SceneMemory, g_SceneBytes, g_SceneVersion
+    data = pickle.dumps(getScene())
+    if data != g_SceneBytes:
+        g_SceneMemory = reserveSharedMemory(g_SceneMemory, len(data))
+        g_SceneMemory.buf[: len(data)] = data
+        g_SceneBytes = data
+        g_SceneVersion += 1
+    return g_SceneMemory.name, len(data), g_SceneVersion
+
+
+# プロセスプールと共有メモリを片付ける (終了時に呼ばれる)
+def closePool():
+    global g_Pool, g_SceneMemory, g_SceneBytes, g_ImageMemory, g_GBufferMemory
+    if g_Pool is not None:
+        g_Pool.close()
+        g_Pool.join()
+        g_Pool = None
+    for memory in (g_SceneMemory, g_ImageMemory, g_GBufferMemory):
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+    g_SceneMemory = g_SceneBytes = g_ImageMemory = g_GBufferMemory = None
+
+
+atexit.register(closePool)
+
+
+# ワーカープロセスで用途 role の共有メモリ name を開く。前回と同じ名前なら開いたものを使う
+def openSharedMemory(role, name):
+    memory = g_WorkerMemories.get(role)
+    if memory is None or memory.name != name:
+        if memory is not None:
+            memory.close()
+        memory = shared_memory.SharedMemory(name=name)
+        g_WorkerMemories[role] = memory
+    return memory
+
+
+# タイルを1枚計算して共有メモリ上の画像に書き込み、タイルの G-buffer も共有メモリに書き込む
+# task はタイルの画像の添字での範囲 (row0, row1, col0, col1)、サンプル数、
+# shareScene の返り値、画像と G-buffer の共有メモリの名前と画像の形
+def renderTileTask(task):
+    global g_WorkerSceneVersion
+    row0, row1, col0, col1, samples, scene, imageName, gbufferName, shape = task
+    sceneName, sceneSize, sceneVersion = scene
+    if sceneVersion != g_WorkerSceneVersion:
+        # シーンが変わったときだけ読み込み直す
+        memory = openSharedMemory("scene", sceneName)
+        globals().update(pickle.loads(memory.buf[:sceneSize]))
+        g_WorkerSceneVersion = sceneVersion
+
+    H, W, _ = shape
+    S = samples
+    image = np.ndarray(
+        shape, dtype=np.float64, buffer=openSharedMemory("image", imageName).buf
+    )
+    grid = np.ndarray(
+        (H * S, W * S, GBUFFER_COLUMNS),
+        dtype=np.float64,
+        buffer=openSharedMemory("gbuffer", gbufferName).buf,
+    )
+    halfWidth = (W - 1) // 2
+    halfHeight = (H - 1) // 2
+    gbuffer = getGBuffer(
+        getPrimaryRays(
+            col0 - halfWidth, col1 - halfWidth, row0 - halfHeight, row1 - halfHeight, S
+        )
+    )
+    colors = shadeGBuffer(gbuffer)
+    image[row0:row1, col0:col1] = colors.reshape(
+        row1 - row0, S, col1 - col0, S, 3
+    ).mean(axis=(1, 3))
+    # 画面全体の一次レイは (H*S, W*S) の格子を平坦化した順に並ぶので、その格子のタイルの位置に書く
+    gbuffer.pack(grid[row0 * S : row1 * S, col0 * S : col1 * S])
+    return task[:4]
+
+
+# 画像を tileSize 四方のタイルに分割する
+def splitTiles(H, W, tileSize):
+    return [
+        (row, min(row + tileSize, H), col, min(col + tileSize, W))
+        for row in range(0, H, tileSize)
+        for col in range(0, W, tileSize)
+    ]
+
+
+# renderImage と同じ画像を、タイルに分割して複数のプロセスで計算する
+# プロセスプールと共有メモリは前回のものを使い回し、シーンは変わったときだけ送り直す
+# ワーカーが作った G-buffer は g_GBufferCache に保存するので、次に光源などを変えただけなら
+# renderImage が陰影の計算だけで済ませられる
+# 一次レイが g_ParallelMinRays より少ない画像は、分割の手間の方が大きいので renderImage で計算する
+def renderImageParallel(
+    halfWidth, halfHeight, samples=1, processes=None, tileSize=64, out=None
+):
+    global g_ImageMemory, g_GBufferMemory, g_GBufferCache, g_GBufferCacheKey
+    H = 2 * halfHeight + 1
+    W = 2 * halfWidth + 1
+    processes = processes or os.cpu_count() or 1
+    if processes <= 1 or H * W * samples * samples < g_ParallelMinRays:
+        return renderImage(halfWidth, halfHeight, samples, out)
+
+    shape = (H, W, 3)
+    rays = H * W * samples * samples
+    g_ImageMemory = reserveSharedMemory(g_ImageMemory, H * W * 3 * 8)
+    g_GBufferMemory = reserveSharedMemory(g_GBufferMemory, rays * GBUFFER_COLUMNS * 8)
+    scene = shareScene()
+    tasks = [
+        tile + (samples, scene, g_ImageMemory.name, g_GBufferMemory.name, shape)
+        for tile in splitTiles(H, W, tileSize)
+    ]
+    for _ in getPool(processes).imap_unordered(renderTileTask, tasks):
+        pass
+
+    grid = np.ndarray(
+        (rays, GBUFFER_COLUMNS), dtype=np.float64, buffer=g_GBufferMemory.buf
+    )
+    g_GBufferCache = GBuffer.unpack(grid)
+    g_GBufferCacheKey = getGBufferKey(
+        -halfWidth, halfWidth + 1, -halfHeight, halfHeight + 1, samples
+    )
+    image = np.ndarray(shape, dtype=np.float64, buffer=g_ImageMemory.buf)
+    if out is None:
+        out = image.copy()
+    else:
+        np.copyto(out, image)
+    return out
+
+
+# (H, W, 3) の画像 (0.0～1.0、image[0] が画面の一番下の行) を
+# ファイルに書き出すための 8bit RGB のバイト列に変換する
+def toRGB8(image):
+    rgb = np.rint(np.clip(image, 0.0, 1.0) * 255.0).astype(np.uint8)
+    return np.ascontiguousarray(rgb[::-1])  # ファイルは上の行から並べる
+
+
+# 画像を PPM (P6) 形式で書き出す
+def savePPM(image, path):
+    rgb = toRGB8(image)
+    H, W, _ = rgb.shape
+    with open(path, "wb") as fout:
+        fout.write(f"P6\n{W} {H}\n255\n".encode("ascii"))
+        fout.write(rgb.tobytes())
+
+
+# 画像を PNG 形式で書き出す
+def savePNG(image, path):
+    rgb = toRGB8(image)
+    H, W, _ = rgb.shape
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data))
+        )
+
+    # 各行の先頭にフィルタ種別 0 (None) を付ける
+    raw = np.zeros((H, W * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(H, W * 3)
+    with open(path, "wb") as fout:
+        fout.write(b"\x89PNG\r\n\x1a\n")
+        fout.write(chunk(b"IHDR", struct.pack(">IIBBBBB", W, H, 8, 2, 0, 0, 0)))
+        fout.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        fout.write(chunk(b"IEND", b""))
+
+
+# 拡張子 (.png または .ppm) に応じた形式で画像を書き出す
+def saveImage(image, path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        savePNG(image, path)
+    elif ext == ".ppm":
+        savePPM(image, path)
+    else:
+        raise ValueError(f"unsupported image format: {path}")
+
+
+# 幅 width、高さ height の画像を計算する (ウィンドウを開かずに使う)
+def renderToSize(width, height, samples=1, processes=1):
+    halfWidth = width // 2
+    halfHeight = height // 2
+    if processes > 1:
+        image = renderImageParallel(
+            halfWidth, halfHeight, samples, processes, g_TileSize
+        )
+    else:
+        image = renderImage(halfWidth, halfHeight, samples)
+    # 幅や高さが偶数のときは 1 ピクセル多く計算されるので切り詰める
+    return image[:height, :width]
+
+
+# コマンドライン引数の解析
+def parseArgs(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="画像ファイル (.png / .ppm) に書き出す。指定するとウィンドウを開かない",
+    )
+    parser.add_argument("--width", type=int, default=400, help="画像の幅")
+    parser.add_argument("--height", type=int, default=400, help="画像の高さ")
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=g_SuperSampling,
+        help="1ピクセルあたりの縦横のサンプル数",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=g_NumProcesses,
+        help="レンダリングに使うプロセス数",
+    )
+    return parser.parse_args(argv)
+
+
+# 画像バッファを返す。サイズが変わったときだけ作り直し、それ以外は同じ配列を使い回す
+def getImageBuffer(width, height):
+    global g_ImageBuffer
+    if g_ImageBuffer is None or g_ImageBuffer.shape[:2] != (height, width):
+        g_ImageBuffer = np.zeros((height, width, 3), dtype=np.float32)
+    return g_ImageBuffer
+
+
+# (H, W, 3) の float32 の画像を glDrawPixels 1回で画面の左下から描画する
+# image は C 連続な配列で、コピーせずにそのまま OpenGL へ渡す
+def presentImage(image):
+    H, W, _ = image.shape
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    glWindowPos2i(0, 0)
+    glDrawPixels(W, H, GL_RGB, GL_FLOAT, image)
+
+
 def display():
     glClear(GL_COLOR_BUFFER_BIT)
 
-    glBegin(GL_POINTS)
-    for y in range(-g_HalfHeight, g_HalfHeight + 1):
-        for x in range(-g_HalfWidth, g_HalfWidth + 1):
-            colorVec = getPixelColor(x, y)  # 座標 (x, y) の色を取得する
-            glColor3dv(colorVec)  # (x, y) の画素を描画
-            glVertex2i(x, y)
-    glEnd()
+    # 全ピクセルの色をまとめて画像バッファに計算する
+    # G-buffer のキャッシュが使えるとき (光源などを変えただけのとき) は陰影の計算だけで済む
+    image = getImageBuffer(2 * g_HalfWidth + 1, 2 * g_HalfHeight + 1)
+    key = getGBufferKey(
+        -g_HalfWidth, g_HalfWidth + 1, -g_HalfHeight, g_HalfHeight + 1, g_SuperSampling
+    )
+    if g_NumProcesses > 1 and key != g_GBufferCacheKey:
+        renderImageParallel(
+            g_HalfWidth,
+            g_HalfHeight,
+            g_SuperSampling,
+            g_NumProcesses,
+            g_TileSize,
+            out=image,
+        )
+    else:
+        renderImage(g_HalfWidth, g_HalfHeight, g_SuperSampling, out=image)
+
+    presentImage(image)
     glFlush()
 
 
 # ウィンドウのサイズが変更されたときの処理
 def resize(w, h):
+    global g_HalfWidth, g_HalfHeight
     if h > 0:
-        glViewport(0, 0, w, h)
-        g_HalfWidth = w / 2
-        g_HalfHeight = h / 2
+        g_HalfWidth = w // 2
+        g_HalfHeight = h // 2
+        getImageBuffer(2 * g_HalfWidth + 1, 2 * g_HalfHeight + 1)
         glViewport(0, 0, w, h)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
@@ -130,23 +609,45 @@ def resize(w, h):
 
 # キーが押されたときのイベント処理
 def keyboard(key, x, y):
+    global g_LightDirection
     if key in [b"q", b"Q", b"\x1b"]:  # b'\x1b'は ESC の ASCII コード
         glutDestroyWindow(g_WindowID)
         return
+    elif key in [b"l", b"L"]:  # l / L キーで入射光の方向を y 軸まわりに回す
+        g_LightDirection = rotateY(g_LightDirection, 10.0 if key == b"l" else -10.0)
 
     glutPostRedisplay()
 
 
 if __name__ == "__main__":
+    args = parseArgs(sys.argv[1:])
+    g_LightDirection = normalize(g_LightDirection)
+    g_SuperSampling = args.samples
+    g_NumProcesses = args.processes
+
+    if args.output:
+        # ウィンドウを開かずに画像ファイルへ書き出す
+        saveImage(
+            renderToSize(args.width, args.height, args.samples, args.processes),
+            args.output,
+        )
+        sys.exit(0)
+
+    from OpenGL.GL import *
+    from OpenGL.GLU import *
+    from OpenGL.GLUT import *
+
+    g_HalfWidth = args.width // 2
+    g_HalfHeight = args.height // 2
+
     glutInit(sys.argv)  # ライブラリの初期化
     glutInitDisplayMode(GLUT_SINGLE | GLUT_RGB)
-    glutInitWindowSize(400, 400)  # ウィンドウサイズを指定
+    glutInitWindowSize(args.width, args.height)  # ウィンドウサイズを指定
     g_WindowID = glutCreateWindow(sys.argv[0])  # ウィンドウを作成
     glutDisplayFunc(display)  # 表示関数を指定
     glutReshapeFunc(resize)  # ウィンドウサイズが変更されたときの関数を指定
     glutKeyboardFunc(keyboard)  # キーボード関数を指定
 
-    g_LightDirection = normalize(g_LightDirection)
     glClearColor(1.0, 1.0, 1.0, 1.0)  # 消去色指定
 
     glutMainLoop()  # イベント待ち
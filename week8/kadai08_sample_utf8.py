@@ -1,8 +1,15 @@
+import argparse
+import atexit
+import os
+import pickle
+import struct
 import sys
+import zlib
+from multiprocessing import Pool, shared_memory
+
 import numpy as np
-from OpenGL.GLUT import *
-from OpenGL.GL import *
-from OpenGL.GLU import *
+
+# OpenGL はウィンドウに表示するときだけ読み込む (ファイル出力のときは読み込まない)
 
 
 # 3次元ベクトルを作る
@@ -16,6 +23,19 @@ def normalize(v):
     return v / norm if norm > 0.0 else v
 
 
+# ベクトル v を y 軸まわりに deg 度回転する
+def rotateY(v, deg):
+    c = np.cos(np.radians(deg))
+    s = np.sin(np.radians(deg))
+    return vec3(c * v[0] + s * v[2], v[1], -s * v[0] + c * v[2])
+
+
+# (N, 3) の配列の各行を長さ1に正規化する
+def normalizeRows(v):
+    norm = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, norm, out=np.array(v, dtype=np.float64), where=norm > 0.0)
+
+
 # 球体
 class Sphere:
     def __init__(self, center, radius, color):
@@ -44,6 +64,23 @@ class Sphere:
         else:
             return -1.0
 
+    # getIntersect のレイ束版。p は (3,) または (N, 3)、v は (N, 3) の配列
+    # 各レイについて t の値を並べた (N,) の配列を返す。交わらないレイは -1
+    def getIntersectBatch(self, p, v):
+        pc = p - self.center
+        A = np.einsum("ij,ij->i", v, v)
+        B = 2.0 * np.einsum("ij,ij->i", v, np.broadcast_to(pc, v.shape))
+        C = np.einsum("...j,...j->...", pc, pc) - self.radius * self.radius
+        D = B * B - 4 * A * C  # 判別式
+
+        t = np.full(len(v), -1.0)
+        hit = D > 0.0  # 交わる
+        sqrtD = np.sqrt(D[hit])
+        t1 = (-B[hit] - sqrtD) / (2.0 * A[hit])
+        t2 = (-B[hit] + sqrtD) / (2.0 * A[hit])
+        t[hit] = np.where(t1 >= 0.0, t1, t2)
+        return t
+
 
 # 板。xz平面に平行な面とする
 class Board:
@@ -70,6 +107,18 @@ class Board:
 
         return t
 
+    # getIntersect のレイ束版。p は (3,) または (N, 3)、v は (N, 3) の配列
+    # 各レイについて t の値を並べた (N,) の配列を返す。交わらないレイは -1
+    def getIntersectBatch(self, p, v):
+        p = np.broadcast_to(p, v.shape)
+        t = np.full(len(v), -1.0)
+        ok = np.abs(v[:, 1]) >= 1.0e-6  # 水平なRayは交わらない
+        t[ok] = (self.y - p[ok, 1]) / v[ok, 1]
+
+        Qz = p[:, 2] + t * v[:, 2]
+        t[(t < 0.0) | (Qz < -3000.0)] = -1.0
+        return t
+
     # x と z の値から床の色を返す（格子模様になるように）
     def getColorVec(self, x, z):
         # x, z の値によって(1.0, 1.0, 0.7)または(0.6, 0.6, 0.6)のどちらかの色を返すようにする
@@ -84,10 +133,167 @@ class Board:
         else:
             return vec3(0.6, 0.6, 0.6)
 
+    # getColorVec の配列版。x, z は (N,) の配列で、(N, 3) の色の配列を返す
+    def getColorVecBatch(self, x, z):
+        size = 100.0
+
+        ix = np.floor(x / size).astype(np.int64)
+        iz = np.floor(z / size).astype(np.int64)
+
+        even = ((ix + iz) % 2 == 0)[:, None]
+        return np.where(even, vec3(1.0, 1.0, 0.7), vec3(0.6, 0.6, 0.6))
+
+
+# 複数の球と床をまとめたシーン
+# 球は BVH (バウンディングボリューム階層) で管理し、レイ束に対する最も近い交点をまとめて求める
+class Scene:
+    def __init__(self, spheres, board, leafSize=4):
+        self.spheres = spheres  # 球のリスト
+        self.board = board  # 床
+        self.leafSize = leafSize  # BVH の葉に入れる球の最大数
+
+        # 球の情報を配列にまとめておく
+        self.centers = np.array([s.center for s in spheres], dtype=np.float64)
+        self.centers = self.centers.reshape(-1, 3)
+        self.radii = np.array([s.radius for s in spheres], dtype=np.float64)
+        self.colors = np.array([s.color for s in spheres], dtype=np.float64)
+        self.colors = self.colors.reshape(-1, 3)
+
+        self.buildBVH()
+
+    # BVH を作る。各節点は球を囲む AABB (nodeMin, nodeMax) を持ち、
+    # 内部節点は子の番号 (nodeLeft, nodeRight)、葉は order[nodeStart:nodeStart + nodeCount] の球を持つ
+    def buildBVH(self):
+        self.order = np.arange(len(self.spheres))
+        self.nodeMin = []
+        self.nodeMax = []
+        self.nodeLeft = []
+        self.nodeRight = []
+        self.nodeStart = []
+        self.nodeCount = []
+        if len(self.spheres) > 0:  # 球がなければ節点も作らない (床だけのシーン)
+            self.buildNode(0, len(self.spheres))
+
+        self.nodeMin = np.array(self.nodeMin).reshape(-1, 3)
+        self.nodeMax = np.array(self.nodeMax).reshape(-1, 3)
+        self.nodeLeft = np.array(self.nodeLeft, dtype=np.int64)
+        self.nodeRight = np.array(self.nodeRight, dtype=np.int64)
+        self.nodeStart = np.array(self.nodeStart, dtype=np.int64)
+        self.nodeCount = np.array(self.nodeCount, dtype=np.int64)
+
+    # order[start:end] の球を囲む節点を作り、その番号を返す
+    # 重心の広がりが最も大きい軸の中央値で2つに分ける
+    def buildNode(self, start, end):
+        node = len(self.nodeMin)
+        index = self.order[start:end]
+        centers = self.centers[index]
+        radii = self.radii[index, None]
+        self.nodeMin.append((centers - radii).min(axis=0))
+        self.nodeMax.append((centers + radii).max(axis=0))
+        self.nodeLeft.append(-1)
+        self.nodeRight.append(-1)
+        self.nodeStart.append(start)
+        self.nodeCount.append(end - start)
+
+        if end - start > self.leafSize:
+            axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+            mid = (start + end) // 2
+            split = np.argpartition(centers[:, axis], mid - start)
+            self.order[start:end] = index[split]
+            self.nodeCount[node] = 0  # 内部節点は球を直接持たない
+            self.nodeLeft[node] = self.buildNode(start, mid)
+            self.nodeRight[node] = self.buildNode(mid, end)
+        return node
+
+    # 点 p[k] を通り、v[k] 方向の Ray と番号 index[k] の球との交わりを判定する
+    # Sphere.getIntersect と同じく t の値を返し、交わらない場合は -1
+    def intersectSpheres(self, p, v, index):
+        pc = p - self.centers[index]
+        A = np.einsum("ij,ij->i", v, v)
+        B = 2.0 * np.einsum("ij,ij->i", v, pc)
+        C = np.einsum("ij,ij->i", pc, pc) - self.radii[index] ** 2
+        D = B * B - 4 * A * C  # 判別式
+
+        t = np.full(len(v), -1.0)
+        hit = D > 0.0  # 交わる
+        sqrtD = np.sqrt(D[hit])
+        t1 = (-B[hit] - sqrtD) / (2.0 * A[hit])
+        t2 = (-B[hit] + sqrtD) / (2.0 * A[hit])
+        t[hit] = np.where(t1 >= 0.0, t1, t2)
+        return t
+
+    # 点 p を通り、v 方向の Ray の束 ((N, 3) の配列) について、最も近い球をまとめて求める
+    # (球の番号, t) の配列の組を返す。交わらないレイは番号・t ともに -1
+    # (レイ, 節点) の組を BVH の深さごとにまとめて処理する
+    def getIntersectBatch(self, p, v):
+        p = np.broadcast_to(p, v.shape)
+        invV = 1.0 / np.where(v == 0.0, 1.0e-30, v)
+        bestT = np.full(len(v), np.inf)
+        bestIndex = np.full(len(v), -1)
+
+        rays = np.arange(len(v))
+        nodes = np.zeros(len(v), dtype=np.int64)
+        pr, invVr = p, invV  # 最初は全レイが根にあるので添字で集めなくてよい
+        while len(rays) > 0 and len(self.spheres) > 0:
+            # AABB との交差判定 (スラブ法)。すでに見つかった交点より遠い節点は調べない
+            t0 = (self.nodeMin[nodes] - pr) * invVr
+            t1 = (self.nodeMax[nodes] - pr) * invVr
+            tMin = np.minimum(t0, t1)
+            tMax = np.maximum(t0, t1)
+            tNear = np.maximum(np.maximum(tMin[:, 0], tMin[:, 1]), tMin[:, 2])
+            tFar = np.minimum(np.minimum(tMax[:, 0], tMax[:, 1]), tMax[:, 2])
+            keep = (tFar >= np.maximum(tNear, 0.0)) & (tNear <= bestT[rays])
+            rays = rays[keep]
+            nodes = nodes[keep]
+
+            # 葉に入っている球との交差判定
+            leaf = self.nodeCount[nodes] > 0
+            counts = self.nodeCount[nodes[leaf]]
+            pairRays = np.repeat(rays[leaf], counts)
+            firsts = np.repeat(self.nodeStart[nodes[leaf]], counts)
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            pairSpheres = self.order[firsts + offsets]
+            t = self.intersectSpheres(p[pairRays], v[pairRays], pairSpheres)
+            hit = t > 0.0
+            pairRays, pairSpheres, t = pairRays[hit], pairSpheres[hit], t[hit]
+            np.minimum.at(bestT, pairRays, t)
+            closest = t == bestT[pairRays]
+            bestIndex[pairRays[closest]] = pairSpheres[closest]
+
+            # 内部節点は2つの子へ進む
+            inner = ~leaf
+            rays = np.concatenate([rays[inner], rays[inner]])
+            nodes = np.concatenate(
+                [self.nodeLeft[nodes[inner]], self.nodeRight[nodes[inner]]]
+            )
+            pr, invVr = p[rays], invV[rays]
+
+        return bestIndex, np.where(bestIndex >= 0, bestT, -1.0)
+
+
+# 床の上に num 個の球をランダムに並べたシーンを作る
+def makeRandomScene(num, board, seed=0):
+    rng = np.random.default_rng(seed)
+    radii = rng.uniform(10.0, 60.0, num)
+    xs = rng.uniform(-2000.0, 2000.0, num)
+    zs = rng.uniform(-3000.0, -1200.0, num)
+    colors = rng.uniform(0.2, 1.0, (num, 3))
+    spheres = [
+        Sphere(vec3(x, board.y + r, z), r, c)
+        for x, z, r, c in zip(xs, zs, radii, colors)
+    ]
+    return Scene(spheres, board)
+
 
 g_WindowID = 0  # ウィンドウ識別子
 g_HalfWidth = 200  # 描画領域の横幅/2
 g_HalfHeight = 200  # 描画領域の縦幅/2
+g_ImageBuffer = None  # 画面に表示する (H, W, 3) の画像バッファ
+# サンプル数ごとの、前回の一次レイの交差判定の結果 (getGBufferKey の値, GBuffer)
+# AdaptiveRenderer の粗い画像 (1サンプル) が通常の描画の G-buffer を追い出さないように分けておく
+g_GBufferCache = {}
 
 # 各種定数
 g_Distance = 1000  # 視点と投影面との距離
@@ -96,6 +302,13 @@ g_Kd = 0.8  # 拡散反射定数
 g_Ks = 0.8  # 鏡面反射定数
 g_Iin = 1.0  # 入射光の強さ
 g_Ia = 0.2  # 環境光
+g_SuperSampling = 3  # 1ピクセルあたりの縦横のサンプル数
+g_NumProcesses = os.cpu_count() or 1  # レンダリングに使うプロセス数
+g_TileSize = 64  # 並列レンダリングで分割するタイルの一辺のピクセル数
+g_AdaptiveThreshold = 0.0  # 適応的サンプリングのしきい値 (0 なら使わない)
+g_Progressive = False  # 粗い画像を先に表示し、タイマーで少しずつ細かくするかどうか
+g_ProgressivePixels = 5000  # タイマー1回あたりに細分化するピクセル数
+g_ProgressiveRenderer = None  # 段階的に計算中の AdaptiveRenderer
 
 g_Viewpoint = vec3(0.0, 0.0, 0.0)  # 視点位置
 g_LightDirection = vec3(-2.0, -4.0, -2.0)  # 入射光の進行方向
@@ -109,6 +322,9 @@ g_Sphere = Sphere(
 # 球体の置かれている床
 g_Board = Board(-150)  # y座標値を -150 にする。（球と接するようにする）
 
+# 描画するシーン (球のリストと床)
+g_Scene = Scene([g_Sphere], g_Board)
+
 
 # x, y で指定されたスクリーン座標での色 (RGB) を計算する
 def getPixelColor(x, y):
@@ -163,31 +379,604 @@ def getPixelColor(x, y):
     return vec3(0.0, 0.0, 0.0)  # 背景色
 
 
+# x0 <= x < x1, y0 <= y < y1 の範囲のピクセルについて、全サンプルの一次レイの方向を
+# (H*S*W*S, 3) の配列としてまとめて作る (S はサンプル数)
+# 並びは (H, S, W, S) を平坦化した順で、ピクセル (x, y) のサンプルは
+# (x + x_i / S, y + y_i / S) になる
+def getPrimaryRays(x0, x1, y0, y1, samples=1):
+    offsets = np.arange(samples) / samples
+    xs = (np.arange(x0, x1)[:, None] + offsets).ravel()
+    ys = (np.arange(y0, y1)[:, None] + offsets).ravel()
+    X, Y = np.meshgrid(xs, ys)
+    return getRaysThrough(X.ravel(), Y.ravel())
+
+
+# スクリーン上の点 (xs[k], ys[k]) へ飛ばす一次レイの方向を (N, 3) の配列で返す
+def getRaysThrough(xs, ys):
+    rays = np.empty((len(xs), 3))
+    rays[:, 0] = xs
+    rays[:, 1] = ys
+    rays[:, 2] = -g_Distance
+    return normalizeRows(rays - g_Viewpoint)
+
+
+# G-buffer の物体の番号で、球以外を表す値 (球は Scene の中での番号 0, 1, 2, ... を使う)
+ID_NONE = -1  # 何とも交差しない
+ID_BOARD = -2  # 床
+
+
+# 一次レイの交差判定の結果 (G-buffer)。レイごとに交点の t、物体の番号、交点の位置、法線を持つ
+# 光源や材質の定数を変えただけなら、これを使い回して陰影と影の計算だけをやり直せばよい
+class GBuffer:
+    def __init__(self, rays, t, objectId, position, normal):
+        self.rays = rays  # 一次レイの方向 (N, 3)
+        self.t = t  # 交点までの距離 (N,)。交わらない場合は -1
+        self.objectId = objectId  # 物体の番号 (N,)。ID_NONE, ID_BOARD または球の番号
+        self.position = position  # 交点の位置 (N, 3)
+        self.normal = normal  # 交点での単位法線ベクトル (N, 3)
+
+    # (..., GBUFFER_COLUMNS) の配列 out に詰めて書き込む (プロセス間で受け渡すため)
+    # out の (...) の部分の要素数はレイの数と同じにする
+    def pack(self, out):
+        shape = out.shape[:-1]
+        out[..., 0:3] = self.rays.reshape(shape + (3,))
+        out[..., 3] = self.t.reshape(shape)
+        out[..., 4] = self.objectId.reshape(shape)
+        out[..., 5:8] = self.position.reshape(shape + (3,))
+        out[..., 8:11] = self.normal.reshape(shape + (3,))
+
+    # pack で詰めた配列から G-buffer を作る (配列はコピーする)
+    @classmethod
+    def unpack(cls, packed):
+        packed = packed.reshape(-1, GBUFFER_COLUMNS)
+        return cls(
+            packed[:, 0:3].copy(),
+            packed[:, 3].copy(),
+            packed[:, 4].astype(np.int64),
+            packed[:, 5:8].copy(),
+            packed[:, 8:11].copy(),
+        )
+
+
+GBUFFER_COLUMNS = 11  # GBuffer.pack で1レイあたりに使う値の数
+
+
+# 一次レイの交差判定だけを行い、G-buffer を作る
+def getGBuffer(rays):
+    position = np.zeros((len(rays), 3))
+    normal = np.zeros((len(rays), 3))
+
+    # レイを飛ばして最も近い球との交点を求める
+    objectId, t = g_Scene.getIntersectBatch(g_Viewpoint, rays)
+    hitSphere = t > 0.0  # 球との交点がある
+    position[hitSphere] = g_Viewpoint + t[hitSphere, None] * rays[hitSphere]
+    normal[hitSphere] = normalizeRows(
+        position[hitSphere] - g_Scene.centers[objectId[hitSphere]]
+    )
+
+    # 球に当たらなかったレイだけ床と交差するか求める
+    rest = np.flatnonzero(~hitSphere)
+    tBoard = g_Scene.board.getIntersectBatch(g_Viewpoint, rays[rest])
+    hitBoard = tBoard > 0.0  # 床との交点がある
+    rest = rest[hitBoard]
+    t[rest] = tBoard[hitBoard]
+    objectId[rest] = ID_BOARD
+    position[rest] = g_Viewpoint + tBoard[hitBoard, None] * rays[rest]
+    normal[rest] = vec3(0.0, 1.0, 0.0)
+    return GBuffer(rays, t, objectId, position, normal)
+
+
+# G-buffer から陰影と床の影を計算する。(N, 3) の色の配列を返す
+def shadeGBuffer(gbuffer):
+    colors = np.zeros((len(gbuffer.rays), 3))  # 背景色
+    L = -g_LightDirection
+
+    # 球の表面の色
+    hitSphere = gbuffer.objectId >= 0
+    ray = gbuffer.rays[hitSphere]
+    index = gbuffer.objectId[hitSphere]
+    N_s = gbuffer.normal[hitSphere]
+    LN = N_s @ L
+
+    Id = g_Kd * g_Iin * np.maximum(0.0, LN)
+
+    R = normalizeRows(2.0 * LN[:, None] * N_s - L)
+    Is = g_Ks * g_Iin * np.maximum(0.0, np.einsum("ij,ij->i", -ray, R)) ** g_Shininess
+
+    I = Id[:, None] * g_Scene.colors[index] + Is[:, None] + g_Ia
+    colors[hitSphere] = np.minimum(I, 1.0)  # 1.0 を超えないようにする
+
+    # 床の色
+    hitBoard = gbuffer.objectId == ID_BOARD
+    P_b = gbuffer.position[hitBoard]
+
+    colorVec_base = g_Scene.board.getColorVecBatch(P_b[:, 0], P_b[:, 2])
+
+    # 床に当たったレイの分だけ影を判定するレイをまとめて飛ばす
+    shadow_ray_start = P_b + L * 1.0e-4
+    _, t_shadow = g_Scene.getIntersectBatch(
+        shadow_ray_start, np.broadcast_to(L, P_b.shape)
+    )
+    colorVec_base[t_shadow > 0.0] *= 0.5  # 球の影になる
+    colors[hitBoard] = colorVec_base
+    return colors
+
+
+# getPixelColor を全レイ分まとめて配列演算で計算する。(N, 3) の色の配列を返す
+def getRayColors(rays):
+    return shadeGBuffer(getGBuffer(rays))
+
+
+# G-buffer のキャッシュが使えるかどうかを決める値
+# 視点、描画範囲、サンプル数、シーン (物体の形) のどれかが変わると変わる
+# シーンは Scene オブジェクトそのもので比べるので、物体を動かすときは g_Scene を作り直す
+def getGBufferKey(x0, x1, y0, y1, samples):
+    return (
+        (x0, x1, y0, y1, samples),
+        tuple(g_Viewpoint),
+        g_Distance,
+        g_Scene,
+        g_Scene.board.y,
+    )
+
+
+# G-buffer のキャッシュのうち、サンプル数 samples のものを作ったときの getGBufferKey の値
+def getCachedGBufferKey(samples):
+    cached = g_GBufferCache.get(samples)
+    return None if cached is None else cached[0]
+
+
+# 前回と同じ一次レイなら保存しておいた G-buffer を返し、そうでなければ作り直す
+def getCachedGBuffer(x0, x1, y0, y1, samples=1):
+    key = getGBufferKey(x0, x1, y0, y1, samples)
+    if getCachedGBufferKey(samples) != key:
+        gbuffer = getGBuffer(getPrimaryRays(x0, x1, y0, y1, samples))
+        g_GBufferCache[samples] = (key, gbuffer)
+    return g_GBufferCache[samples][1]
+
+
+# x0 <= x < x1, y0 <= y < y1 の範囲について、1ピクセルあたり samples x samples 個の
+# サンプルを平均した画像を計算する
+# 結果は (H, W, 3) の画像で、tile[y - y0, x - x0] が座標 (x, y) の色
+# out を指定するとその配列に書き込んで返す
+# 一次レイの交差判定は前回から変わっていなければ G-buffer のキャッシュを使う
+def renderTile(x0, x1, y0, y1, samples=1, out=None):
+    H = y1 - y0
+    W = x1 - x0
+    colors = shadeGBuffer(getCachedGBuffer(x0, x1, y0, y1, samples))
+    return colors.reshape(H, samples, W, samples, 3).mean(axis=(1, 3), out=out)
+
+
+# 画面全体を計算する
+# 結果は (H, W, 3) の画像で、image[y + halfHeight, x + halfWidth] が座標 (x, y) の色
+def renderImage(halfWidth, halfHeight, samples=1, out=None):
+    return renderTile(
+        -halfWidth, halfWidth + 1, -halfHeight, halfHeight + 1, samples, out
+    )
+
+
+# ワーカープロセスへ送るシーンの変数
+SCENE_NAMES = [
+    "g_Scene",
+    "g_Viewpoint",
+    "g_LightDirection",
+    "g_Distance",
+    "g_Shininess",
+    "g_Kd",
+    "g_Ks",
+    "g_Iin",
+    "g_Ia",
+]
+
+g_Pool = None  # 並列レンダリングに使い続けるプロセスプール
+g_PoolProcesses = 0  # g_Pool のプロセス数
+g_SceneMemory = None  # ワーカープロセスへ渡すシーン (pickle したもの) の共有メモリ
+g_SceneBytes = None  # g_SceneMemory に置いてあるシーン
+g_SceneVersion = 0  # シーンを置き直すたびに増やす番号
+g_ImageMemory = None  # ワーカープロセスが計算した画像を受け取る共有メモリ
+g_GBufferMemory = None  # ワーカープロセスが作った G-buffer を受け取る共有メモリ
+g_ParallelMinRays = 1 << 20  # 一次レイがこれより少ない画像はプロセスを使わずに計算する
+
+g_WorkerMemories = {}  # ワーカープロセスが開いている共有メモリ (用途ごとに1つ)
+g_WorkerSceneVersion = -1  # ワーカープロセスが読み込んであるシーンの番号
+
+
+# 現在のシーンを辞書にまとめる
+def getScene():
+    return {name: globals()[name] for name in SCENE_NAMES}
+
+
+# 並列レンダリングに使うプロセスプールを返す
+# 最初に1回だけ作って使い回すので、プロセスの起動は描画のたびには起こらない
+def getPool(processes):
+    global g_Pool, g_PoolProcesses
+    if g_Pool is None or g_PoolProcesses != processes:
+        if g_Pool is not None:
+            g_Pool.close()
+            g_Pool.join()
+        g_Pool = Pool(processes)
+        g_PoolProcesses = processes
+    return g_Pool
+
+
+# 大きさ size バイト以上の共有メモリを返す。memory が足りなければ作り直す
+def reserveSharedMemory(memory, size):
+    if memory is not None and memory.size >= size:
+        return memory
+    if memory is not None:
+        memory.close()
+        memory.unlink()
+    return shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+
+# 現在のシーンを共有メモリに置き、(共有メモリの名前, 大きさ, 番号) を返す
+# 前回から変わっていなければ置き直さず、番号も変えないのでワーカーも読み込み直さない
+def shareScene():
+    global g_SceneMemory, g_SceneBytes, g_SceneVersion
+    data = pickle.dumps(getScene())
+    if data != g_SceneBytes:
+        g_SceneMemory = reserveSharedMemory(g_SceneMemory, len(data))
+        g_SceneMemory.buf[: len(data)] = data
+        g_SceneBytes = data
+        g_SceneVersion += 1
+    return g_SceneMemory.name, len(data), g_SceneVersion
+
+
+# プロセスプールと共有メモリを片付ける (終了時に呼ばれる)
+def closePool():
+    global g_Pool, g_SceneMemory, g_SceneBytes, g_ImageMemory, g_GBufferMemory
+    if g_Pool is not None:
+        g_Pool.close()
+        g_Pool.join()
+        g_Pool = None
+    for memory in (g_SceneMemory, g_ImageMemory, g_GBufferMemory):
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+    g_SceneMemory = g_SceneBytes = g_ImageMemory = g_GBufferMemory = None
+
+
+atexit.register(closePool)
+
+
+# ワーカープロセスで用途 role の共有メモリ name を開く。前回と同じ名前なら開いたものを使う
+def openSharedMemory(role, name):
+    memory = g_WorkerMemories.get(role)
+    if memory is None or memory.name != name:
+        if memory is not None:
+            memory.close()
+        memory = shared_memory.SharedMemory(name=name)
+        g_WorkerMemories[role] = memory
+    return memory
+
+
+# タイルを1枚計算して共有メモリ上の画像に書き込み、タイルの G-buffer も共有メモリに書き込む
+# task はタイルの画像の添字での範囲 (row0, row1, col0, col1)、サンプル数、
+# shareScene の返り値、画像と G-buffer の共有メモリの名前と画像の形
+def renderTileTask(task):
+    global g_WorkerSceneVersion
+    row0, row1, col0, col1, samples, scene, imageName, gbufferName, shape = task
+    sceneName, sceneSize, sceneVersion = scene
+    if sceneVersion != g_WorkerSceneVersion:
+        # シーンが変わったときだけ読み込み直す
+        memory = openSharedMemory("scene", sceneName)
+        globals().update(pickle.loads(memory.buf[:sceneSize]))
+        g_WorkerSceneVersion = sceneVersion
+
+    H, W, _ = shape
+    S = samples
+    image = np.ndarray(
+        shape, dtype=np.float64, buffer=openSharedMemory("image", imageName).buf
+    )
+    grid = np.ndarray(
+        (H * S, W * S, GBUFFER_COLUMNS),
+        dtype=np.float64,
+        buffer=openSharedMemory("gbuffer", gbufferName).buf,
+    )
+    halfWidth = (W - 1) // 2
+    halfHeight = (H - 1) // 2
+    gbuffer = getGBuffer(
+        getPrimaryRays(
+            col0 - halfWidth, col1 - halfWidth, row0 - halfHeight, row1 - halfHeight, S
+        )
+    )
+    colors = shadeGBuffer(gbuffer)
+    image[row0:row1, col0:col1] = colors.reshape(
+        row1 - row0, S, col1 - col0, S, 3
+    ).mean(axis=(1, 3))
+    # 画面全体の一次レイは (H*S, W*S) の格子を平坦化した順に並ぶので、その格子のタイルの位置に書く
+    gbuffer.pack(grid[row0 * S : row1 * S, col0 * S : col1 * S])
+    return task[:4]
+
+
+# 画像を tileSize 四方のタイルに分割する
+def splitTiles(H, W, tileSize):
+    return [
+        (row, min(row + tileSize, H), col, min(col + tileSize, W))
+        for row in range(0, H, tileSize)
+        for col in range(0, W, tileSize)
+    ]
+
+
+# renderImage と同じ画像を、タイルに分割して複数のプロセスで計算する
+# プロセスプールと共有メモリは前回のものを使い回し、シーンは変わったときだけ送り直す
+# ワーカーが作った G-buffer は g_GBufferCache に保存するので、次に光源などを変えただけなら
+# renderImage が陰影の計算だけで済ませられる
+# 一次レイが g_ParallelMinRays より少ない画像は、分割の手間の方が大きいので renderImage で計算する
+def renderImageParallel(
+    halfWidth, halfHeight, samples=1, processes=None, tileSize=64, out=None
+):
+    global g_ImageMemory, g_GBufferMemory
+    H = 2 * halfHeight + 1
+    W = 2 * halfWidth + 1
+    processes = processes or os.cpu_count() or 1
+    if processes <= 1 or H * W * samples * samples < g_ParallelMinRays:
+        return renderImage(halfWidth, halfHeight, samples, out)
+
+    shape = (H, W, 3)
+    rays = H * W * samples * samples
+    g_ImageMemory = reserveSharedMemory(g_ImageMemory, H * W * 3 * 8)
+    g_GBufferMemory = reserveSharedMemory(g_GBufferMemory, rays * GBUFFER_COLUMNS * 8)
+    scene = shareScene()
+    tasks = [
+        tile + (samples, scene, g_ImageMemory.name, g_GBufferMemory.name, shape)
+        for tile in splitTiles(H, W, tileSize)
+    ]
+    for _ in getPool(processes).imap_unordered(renderTileTask, tasks):
+        pass
+
+    grid = np.ndarray(
+        (rays, GBUFFER_COLUMNS), dtype=np.float64, buffer=g_GBufferMemory.buf
+    )
+    key = getGBufferKey(-halfWidth, halfWidth + 1, -halfHeight, halfHeight + 1, samples)
+    g_GBufferCache[samples] = (key, GBuffer.unpack(grid))
+    image = np.ndarray(shape, dtype=np.float64, buffer=g_ImageMemory.buf)
+    if out is None:
+        out = image.copy()
+    else:
+        np.copyto(out, image)
+    return out
+
+
+# 隣り合うピクセルとの色の差 (RGB の最大値) が threshold を超えるピクセルを求める
+# 球の輪郭、床の格子の境目、影の境目などが該当する。(H, W) の bool 配列を返す
+def findEdgePixels(image, threshold):
+    H, W, _ = image.shape
+    mask = np.zeros((H, W), dtype=bool)
+    # 右、上、右上、左上の隣と比べ、差が大きければ両方のピクセルに印を付ける
+    for dy, dx in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        a = (slice(0, H - dy), slice(max(-dx, 0), W - max(dx, 0)))
+        b = (slice(dy, H), slice(max(dx, 0), W - max(-dx, 0)))
+        edge = np.abs(image[a] - image[b]).max(axis=2) > threshold
+        mask[a] |= edge
+        mask[b] |= edge
+    return mask
+
+
+# 適応的スーパーサンプリング
+# まず1ピクセル1サンプルで画像を作り、隣との色の差が大きいピクセルだけを
+# samples x samples 個のサンプルの平均で計算し直す。
+# step() を少しずつ呼ぶと、粗い画像から段階的に細かくしていくことができる
+class AdaptiveRenderer:
+    def __init__(self, halfWidth, halfHeight, samples=3, threshold=0.1):
+        self.halfWidth = halfWidth
+        self.halfHeight = halfHeight
+        self.samples = samples
+        H = 2 * halfHeight + 1
+        W = 2 * halfWidth + 1
+
+        # 1ピクセル1サンプルの粗い画像。サンプル位置は細分化したときの (x_i, y_i) = (0, 0) と同じ
+        self.image = renderImage(halfWidth, halfHeight, 1)
+        self.numRays = H * W  # これまでに飛ばした一次レイの数
+
+        # 細分化するピクセルの添字 (image を平坦化したときの番号)
+        self.pending = np.flatnonzero(findEdgePixels(self.image, threshold))
+
+    # 細分化が残っていないかどうか
+    def isFinished(self):
+        return len(self.pending) == 0
+
+    # 残りのうち最大 maxPixels 個のピクセルを細分化する。None なら残り全部
+    def step(self, maxPixels=None):
+        index = self.pending[:maxPixels]
+        self.pending = self.pending[len(index) :]
+        if len(index) == 0:
+            return
+
+        S = self.samples
+        H, W, _ = self.image.shape
+        y_i, x_i = np.divmod(np.arange(1, S * S), S)  # (0, 0) は計算済み
+        xs = (index % W - self.halfWidth)[:, None] + x_i / S
+        ys = (index // W - self.halfHeight)[:, None] + y_i / S
+        colors = getRayColors(getRaysThrough(xs.ravel(), ys.ravel()))
+        self.numRays += len(colors)
+
+        pixels = self.image.reshape(H * W, 3)
+        total = pixels[index] + colors.reshape(len(index), S * S - 1, 3).sum(axis=1)
+        pixels[index] = total / (S * S)
+
+
+# 適応的スーパーサンプリングで画面全体を計算する
+# 画像と、飛ばした一次レイの数を返す
+def renderImageAdaptive(halfWidth, halfHeight, samples=3, threshold=0.1):
+    renderer = AdaptiveRenderer(halfWidth, halfHeight, samples, threshold)
+    renderer.step()
+    return renderer.image, renderer.numRays
+
+
+# (H, W, 3) の画像 (0.0～1.0、image[0] が画面の一番下の行) を
+# ファイルに書き出すための 8bit RGB のバイト列に変換する
+def toRGB8(image):
+    rgb = np.rint(np.clip(image, 0.0, 1.0) * 255.0).astype(np.uint8)
+    return np.ascontiguousarray(rgb[::-1])  # ファイルは上の行から並べる
+
+
+# 画像を PPM (P6) 形式で書き出す
+def savePPM(image, path):
+    rgb = toRGB8(image)
+    H, W, _ = rgb.shape
+    with open(path, "wb") as fout:
+        fout.write(f"P6\n{W} {H}\n255\n".encode("ascii"))
+        fout.write(rgb.tobytes())
+
+
+# 画像を PNG 形式で書き出す
+def savePNG(image, path):
+    rgb = toRGB8(image)
+    H, W, _ = rgb.shape
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data))
+        )
+
+    # 各行の先頭にフィルタ種別 0 (None) を付ける
+    raw = np.zeros((H, W * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(H, W * 3)
+    with open(path, "wb") as fout:
+        fout.write(b"\x89PNG\r\n\x1a\n")
+        fout.write(chunk(b"IHDR", struct.pack(">IIBBBBB", W, H, 8, 2, 0, 0, 0)))
+        fout.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        fout.write(chunk(b"IEND", b""))
+
+
+# 拡張子 (.png または .ppm) に応じた形式で画像を書き出す
+def saveImage(image, path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        savePNG(image, path)
+    elif ext == ".ppm":
+        savePPM(image, path)
+    else:
+        raise ValueError(f"unsupported image format: {path}")
+
+
+# 幅 width、高さ height の画像を計算する (ウィンドウを開かずに使う)
+# threshold が正なら適応的スーパーサンプリングを使う
+def renderToSize(width, height, samples=1, processes=1, threshold=0.0):
+    halfWidth = width // 2
+    halfHeight = height // 2
+    if threshold > 0.0:
+        image, _ = renderImageAdaptive(halfWidth, halfHeight, samples, threshold)
+    elif processes > 1:
+        image = renderImageParallel(
+            halfWidth, halfHeight, samples, processes, g_TileSize
+        )
+    else:
+        image = renderImage(halfWidth, halfHeight, samples)
+    # 幅や高さが偶数のときは 1 ピクセル多く計算されるので切り詰める
+    return image[:height, :width]
+
+
+# コマンドライン引数の解析
+def parseArgs(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="画像ファイル (.png / .ppm) に書き出す。指定するとウィンドウを開かない",
+    )
+    parser.add_argument("--width", type=int, default=400, help="画像の幅")
+    parser.add_argument("--height", type=int, default=400, help="画像の高さ")
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=g_SuperSampling,
+        help="1ピクセルあたりの縦横のサンプル数",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=g_NumProcesses,
+        help="レンダリングに使うプロセス数",
+    )
+    parser.add_argument(
+        "--spheres",
+        type=int,
+        default=0,
+        help="床の上にランダムに並べる球の数 (0 なら球1つの課題のシーン)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        type=float,
+        default=g_AdaptiveThreshold,
+        help="隣との色の差がこの値を超えるピクセルだけ細分化する (0 なら全ピクセル)",
+    )
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="粗い画像を先に表示し、少しずつ細かくする (ウィンドウ表示のみ)",
+    )
+    return parser.parse_args(argv)
+
+
+# 画像バッファを返す。サイズが変わったときだけ作り直し、それ以外は同じ配列を使い回す
+def getImageBuffer(width, height):
+    global g_ImageBuffer
+    if g_ImageBuffer is None or g_ImageBuffer.shape[:2] != (height, width):
+        g_ImageBuffer = np.zeros((height, width, 3), dtype=np.float32)
+    return g_ImageBuffer
+
+
+# (H, W, 3) の float32 の画像を glDrawPixels 1回で画面の左下から描画する
+# image は C 連続な配列で、コピーせずにそのまま OpenGL へ渡す
+def presentImage(image):
+    H, W, _ = image.shape
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    glWindowPos2i(0, 0)
+    glDrawPixels(W, H, GL_RGB, GL_FLOAT, image)
+
+
 def display():
+    global g_ProgressiveRenderer
     glClear(GL_COLOR_BUFFER_BIT)
 
-    glBegin(GL_POINTS)
-    for y in range(-g_HalfHeight, g_HalfHeight + 1):
-        for x in range(-g_HalfWidth, g_HalfWidth + 1):
-            colorVec = vec3(0.0, 0.0, 0.0)
-
-            for y_i in range(3):
-                for x_i in range(3):
-                    c = getPixelColor(x + x_i / 3, y + y_i / 3)
-                    colorVec += c
-            colorVec /= 9
-            glColor3dv(colorVec)  # (x, y) の画素を描画
-            glVertex2i(x, y)
-    glEnd()
+    # 全ピクセルの色をまとめて画像バッファに計算する
+    # G-buffer のキャッシュが使えるとき (光源などを変えただけのとき) は陰影の計算だけで済む
+    image = getImageBuffer(2 * g_HalfWidth + 1, 2 * g_HalfHeight + 1)
+    key = getGBufferKey(
+        -g_HalfWidth, g_HalfWidth + 1, -g_HalfHeight, g_HalfHeight + 1, g_SuperSampling
+    )
+    if g_Progressive:
+        # 粗い画像だけをすぐに計算し、細分化は timer() で少しずつ進める
+        renderer = g_ProgressiveRenderer
+        if renderer is None or renderer.image.shape != image.shape:
+            renderer = AdaptiveRenderer(
+                g_HalfWidth, g_HalfHeight, g_SuperSampling, g_AdaptiveThreshold
+            )
+            g_ProgressiveRenderer = renderer
+        np.copyto(image, renderer.image)
+    elif g_AdaptiveThreshold > 0.0:
+        adaptive, _ = renderImageAdaptive(
+            g_HalfWidth, g_HalfHeight, g_SuperSampling, g_AdaptiveThreshold
+        )
+        np.copyto(image, adaptive)
+    elif g_NumProcesses > 1 and key != getCachedGBufferKey(g_SuperSampling):
+        renderImageParallel(
+            g_HalfWidth,
+            g_HalfHeight,
+            g_SuperSampling,
+            g_NumProcesses,
+            g_TileSize,
+            out=image,
+        )
+    else:
+        renderImage(g_HalfWidth, g_HalfHeight, g_SuperSampling, out=image)
+
+    presentImage(image)
     glFlush()
 
 
 # ウィンドウのサイズが変更されたときの処理
 def resize(w, h):
+    global g_HalfWidth, g_HalfHeight
     if h > 0:
-        glViewport(0, 0, w, h)
-        g_HalfWidth = w / 2
-        g_HalfHeight = h / 2
+        g_HalfWidth = w // 2
+        g_HalfHeight = h // 2
+        getImageBuffer(2 * g_HalfWidth + 1, 2 * g_HalfHeight + 1)
         glViewport(0, 0, w, h)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
@@ -197,25 +986,67 @@ def resize(w, h):
         glMatrixMode(GL_MODELVIEW)
 
 
+# 一定時間ごとに呼び出される関数。段階的な描画の細分化を進める
+def timer(value):
+    renderer = g_ProgressiveRenderer
+    if g_Progressive and renderer is not None and not renderer.isFinished():
+        renderer.step(g_ProgressivePixels)
+        glutPostRedisplay()
+    glutTimerFunc(10, timer, 0)
+
+
 # キーが押されたときのイベント処理
 def keyboard(key, x, y):
+    global g_Progressive, g_ProgressiveRenderer, g_LightDirection
     if key in [b"q", b"Q", b"\x1b"]:
         glutDestroyWindow(g_WindowID)
         return
+    elif key in [b"l", b"L"]:  # l / L キーで入射光の方向を y 軸まわりに回す
+        g_LightDirection = rotateY(g_LightDirection, 10.0 if key == b"l" else -10.0)
+        g_ProgressiveRenderer = None
+    elif key == b"p":  # p キーで段階的な描画のオン/オフ
+        g_Progressive = not g_Progressive
+        g_ProgressiveRenderer = None
 
     glutPostRedisplay()
 
 
 if __name__ == "__main__":
+    args = parseArgs(sys.argv[1:])
+    g_LightDirection = normalize(g_LightDirection)
+    g_SuperSampling = args.samples
+    g_NumProcesses = args.processes
+    g_AdaptiveThreshold = args.adaptive
+    g_Progressive = args.progressive
+    if args.spheres > 0:
+        g_Scene = makeRandomScene(args.spheres, g_Board)
+
+    if args.output:
+        # ウィンドウを開かずに画像ファイルへ書き出す
+        saveImage(
+            renderToSize(
+                args.width, args.height, args.samples, args.processes, args.adaptive
+            ),
+            args.output,
+        )
+        sys.exit(0)
+
+    from OpenGL.GL import *
+    from OpenGL.GLU import *
+    from OpenGL.GLUT import *
+
+    g_HalfWidth = args.width // 2
+    g_HalfHeight = args.height // 2
+
     glutInit(sys.argv)  # ライブラリの初期化
     glutInitDisplayMode(GLUT_SINGLE | GLUT_RGB)
-    glutInitWindowSize(400, 400)  # ウィンドウサイズを指定
+    glutInitWindowSize(args.width, args.height)  # ウィンドウサイズを指定
     g_WindowID = glutCreateWindow(sys.argv[0])  # ウィンドウを作成
     glutDisplayFunc(display)  # 表示関数を指定
     glutReshapeFunc(resize)  # ウィンドウサイズが変更されたときの関数を指定
     glutKeyboardFunc(keyboard)  # キーボード関数を指定
+    glutTimerFunc(10, timer, 0)  # タイマー関数を指定
 
-    g_LightDirection = normalize(g_LightDirection)
     glClearColor(1.0, 1.0, 1.0, 1.0)  # 消去色指定
 
     glutMainLoop()  # イベント待ち
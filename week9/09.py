@@ -1,9 +1,16 @@
+import argparse
+import hashlib
+import os
 import sys
 import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from OpenGL.GLUT import *
-from OpenGL.GL import *
-from OpenGL.GLU import *
+
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.arrays import getCellKeys, loadMappedNpz
 
 
 # 3次元ベクトルを作る
@@ -23,115 +30,727 @@ def normalize(v):
 
 
 # 質点
+# 値は Cloth の配列 (positions, velocities, forces, fixed) の1行を指すビューになっている
 class Point:
-    def __init__(self):
-        self.f = vec3(0, 0, 0)  # 質点に働く力のベクトル
-        self.v = vec3(0, 0, 0)  # 速度ベクトル
-        self.p = vec3(0, 0, 0)  # 位置
-        self.bFixed = False  # 固定されているかどうか
+    def __init__(self, cloth=None, index=0):
+        if cloth is None:  # 単独で使うときは1点分の配列を自分で持つ
+            cloth = PointArrays(1)
+            index = 0
+        self.cloth = cloth
+        self.index = index
+
+    # 質点に働く力のベクトル
+    @property
+    def f(self):
+        return self.cloth.forces[self.index]
+
+    @f.setter
+    def f(self, value):
+        self.cloth.forces[self.index] = value
+
+    # 速度ベクトル
+    @property
+    def v(self):
+        return self.cloth.velocities[self.index]
+
+    @v.setter
+    def v(self, value):
+        self.cloth.velocities[self.index] = value
+
+    # 位置
+    @property
+    def p(self):
+        return self.cloth.positions[self.index]
+
+    @p.setter
+    def p(self, value):
+        self.cloth.positions[self.index] = value
+
+    # 固定されているかどうか
+    @property
+    def bFixed(self):
+        return bool(self.cloth.fixed[self.index])
+
+    @bFixed.setter
+    def bFixed(self, value):
+        self.cloth.fixed[self.index] = value
 
 
 # バネ
+# 以前と同じように Spring(p0, p1) と2つの質点から作ると、質点と自然長を自分で持つバネになる
+# Spring.fromCloth(cloth, index) で作ると、Cloth の配列 (springIndex, restLengths) の
+# index 行目を指すビューになる
 class Spring:
     def __init__(self, p0, p1):
-        self.p0 = p0  # 質点0
-        self.p1 = p1  # 質点1
-        self.restLength = length(p0.p - p1.p)  # 自然長
+        self.cloth = None
+        self.points = (p0, p1)
+        self.length = length(p0.p - p1.p)
+
+    # cloth の index 番目のバネを指すビューを作る
+    @classmethod
+    def fromCloth(cls, cloth, index):
+        spring = cls.__new__(cls)
+        spring.cloth = cloth
+        spring.index = index
+        return spring
+
+    # 質点0
+    @property
+    def p0(self):
+        if self.cloth is None:
+            return self.points[0]
+        return Point(self.cloth, self.cloth.springIndex[self.index, 0])
+
+    # 質点1
+    @property
+    def p1(self):
+        if self.cloth is None:
+            return self.points[1]
+        return Point(self.cloth, self.cloth.springIndex[self.index, 1])
+
+    # 自然長
+    @property
+    def restLength(self):
+        if self.cloth is None:
+            return self.length
+        return self.cloth.restLengths[self.index]
+
+    @restLength.setter
+    def restLength(self, value):
+        if self.cloth is None:
+            self.length = value
+        else:
+            self.cloth.restLengths[self.index] = value
+
+
+# n 個の質点の位置・速度・力を (n, 3) の配列で、固定されているかどうかを (n,) の配列で持つ
+class PointArrays:
+    def __init__(self, n):
+        self.positions = np.zeros((n, 3))  # 位置
+        self.velocities = np.zeros((n, 3))  # 速度ベクトル
+        self.forces = np.zeros((n, 3))  # 質点に働く力のベクトル
+        self.fixed = np.zeros(n, dtype=bool)  # 固定されているかどうか
+
+
+# 共役勾配法で対称正定値な連立方程式 A x = b を解く (A は行列とベクトルの積を返す関数)
+def conjugateGradient(multiplyA, b, tolerance=1.0e-8, maxIterations=200):
+    x = np.zeros_like(b)
+    r = b.copy()
+    d = r.copy()
+    rr = np.vdot(r, r)
+    threshold = tolerance * tolerance * max(rr, 1.0e-300)
+    for _ in range(maxIterations):
+        if rr <= threshold:
+            break
+        Ad = multiplyA(d)
+        alpha = rr / np.vdot(d, Ad)
+        x += alpha * d
+        r -= alpha * Ad
+        rrNew = np.vdot(r, r)
+        d = r + (rrNew / rr) * d
+        rr = rrNew
+    return x
+
+
+# 番号 i[k], j[k] の質点を結び、自然長が restLengths[k] のバネの力を、
+# p0 (i) には +force、p1 (j) には -force として足し込んだ (n, 3) の配列を返す
+def getSpringForces(positions, i, j, restLengths, n):
+    v = positions[j] - positions[i]
+    l = np.linalg.norm(v, axis=1)
+    force_magnitude = g_Ks * (l - restLengths)
+    force = np.zeros_like(v)
+    np.divide(force_magnitude[:, None] * v, l[:, None], out=force, where=l[:, None] > 0)
+
+    forces = np.empty((n, 3))
+    target = np.concatenate([i, j])
+    for k in range(3):
+        weights = np.concatenate([force[:, k], -force[:, k]])
+        forces[:, k] = np.bincount(target, weights, minlength=n)
+    return forces
+
+
+# 番号 index[k] の行に values[k] を足し込んだ (n, 3) の配列を返す
+def scatterRows(index, values, n):
+    result = np.empty((n, 3))
+    for k in range(3):
+        result[:, k] = np.bincount(index, values[:, k], minlength=n)
+    return result
+
+
+# 一辺 distance の一様な格子の空間ハッシュを使って、距離が distance 未満の点の組 (a < b) を探す
+# 点をセルの番号でソートしてバケットにまとめ、各点の周り 27 セルのバケットだけを調べるので
+# 点が密集していなければ O(N) で済む。番号の配列の組 (a, b) を返す
+def findClosePairs(positions, distance):
+    n = len(positions)
+    tableSize = 1 << max(2 * n - 1, 1).bit_length()
+    cells = np.floor(positions / distance).astype(np.int64)
+    keys = getCellKeys(cells, tableSize)
+    order = np.argsort(keys, kind="stable")
+    sortedKeys = keys[order]
+
+    # 各点の周り 27 セルのバケットの範囲 [start, end)
+    offsets = np.stack(
+        np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    queryKeys = getCellKeys(cells[:, None, :] + offsets, tableSize).ravel()
+    start = np.searchsorted(sortedKeys, queryKeys, side="left")
+    counts = np.searchsorted(sortedKeys, queryKeys, side="right") - start
+
+    # バケットの中の点を全て候補の組にする
+    total = counts.sum()
+    a = np.repeat(np.arange(n).repeat(len(offsets)), counts)
+    first = np.cumsum(counts) - counts
+    b = order[np.repeat(start - first, counts) + np.arange(total)]
+
+    keep = a < b
+    a, b = a[keep], b[keep]
+    d = positions[b] - positions[a]
+    close = np.einsum("ij,ij->i", d, d) < distance * distance
+    a, b = a[close], b[close]
+
+    # 異なるセルが同じバケットに入ると同じ組が重複するので取り除く
+    pairs = np.unique(a * n + b)
+    return pairs // n, pairs % n
+
+
+# 球の障害物
+class Sphere:
+    def __init__(self, center, radius, color):
+        self.center = center  # 中心座標
+        self.radius = radius  # 半径
+        self.color = color  # Red, Green, Blue 値 0.0～1.0
+
+    # 各点が球の表面から thickness 以内に入り込んだ深さと、押し出す向きの単位ベクトルを返す
+    def getPenetration(self, positions, thickness):
+        d = positions - self.center
+        l = np.linalg.norm(d, axis=1)
+        normal = np.where(
+            l[:, None] > 0, d / np.where(l > 0, l, 1.0)[:, None], vec3(0, 1, 0)
+        )
+        return self.radius + thickness - l, normal
+
+    def draw(self):
+        glColor3dv(self.color)
+        glPushMatrix()
+        glTranslated(*self.center)
+        glutWireSphere(self.radius, 24, 16)
+        glPopMatrix()
+
+
+# 床 (y 座標が一定の平面)
+class Board:
+    def __init__(self, y):
+        self.y = y  # y座標値
+
+    # 各点が床から thickness 以内に入り込んだ深さと、押し出す向き (上向き) を返す
+    def getPenetration(self, positions, thickness):
+        normal = np.broadcast_to(vec3(0, 1, 0), positions.shape)
+        return self.y + thickness - positions[:, 1], normal
+
+    def draw(self, size):
+        glColor3f(0.6, 0.6, 0.6)
+        glBegin(GL_LINES)
+        for k in range(-size, size + 1, 2):
+            glVertex3d(k, self.y, -size)
+            glVertex3d(k, self.y, size)
+            glVertex3d(-size, self.y, k)
+            glVertex3d(size, self.y, k)
+        glEnd()
+
+
+# Cloth.saveSnapshot で保存した .npz を読み込み、名前から配列への辞書を返す
+# mmap が True なら、各配列をファイルに割り当てた読み取り専用の np.memmap にする (loadMappedNpz)
+def loadSnapshot(path, mmap=False):
+    if not mmap:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    return loadMappedNpz(path)
 
 
 POINT_NUM = 20
 
 
 # 布の定義
-class Cloth:
-    def __init__(self):
-        self.points = [[Point() for x in range(POINT_NUM)] for y in range(POINT_NUM)]
-        self.springs: list[Spring] = []
+# 質点は PointArrays の配列にまとめて持ち (質点 (x, y) は x * pointNum + y 番目)、
+# バネは両端の質点の番号の組 springIndex と自然長 restLengths の配列で持つ
+# points[x][y] と springs は、これらの配列を指す Point / Spring のビューを返す
+class Cloth(PointArrays):
+    def __init__(self, pointNum=POINT_NUM):
+        super().__init__(pointNum * pointNum)
+        self.pointNum = pointNum
 
         # 質点の定義
-        for y in range(POINT_NUM):
-            for x in range(POINT_NUM):
-                self.points[x][y].bFixed = False
-                self.points[x][y].p = vec3(x - POINT_NUM / 2, POINT_NUM / 2, -y)
+        x, y = np.meshgrid(np.arange(pointNum), np.arange(pointNum), indexing="ij")
+        self.positions[:, 0] = (x - pointNum / 2).ravel()
+        self.positions[:, 1] = pointNum / 2
+        self.positions[:, 2] = -y.ravel()
 
         # バネの設定
-        for y in range(POINT_NUM):
-            for x in range(POINT_NUM):
-                # 横方向のバネ
-                if x < POINT_NUM - 1:
-                    self.springs.append(
-                        Spring(self.points[x][y], self.points[x + 1][y])
-                    )
-
-                # 縦方向のバネ
-                if y < POINT_NUM - 1:
-                    self.springs.append(
-                        Spring(self.points[x][y], self.points[x][y + 1])
-                    )
-
-                # 右下方向のバネ
-                if x < POINT_NUM - 1 and y < POINT_NUM - 1:
-                    self.springs.append(
-                        Spring(self.points[x][y], self.points[x + 1][y + 1])
-                    )
-
-                # 左下方向のバネ
-                if x > 0 and y < POINT_NUM - 1:
-                    self.springs.append(
-                        Spring(self.points[x][y], self.points[x - 1][y + 1])
-                    )
+        index = np.arange(pointNum * pointNum).reshape(pointNum, pointNum)
+        pairs = [
+            (index[:-1, :], index[1:, :]),  # 横方向のバネ
+            (index[:, :-1], index[:, 1:]),  # 縦方向のバネ
+            (index[:-1, :-1], index[1:, 1:]),  # 右下方向のバネ
+            (index[1:, :-1], index[:-1, 1:]),  # 左下方向のバネ
+        ]
+        self.springIndex = np.concatenate(
+            [np.stack([a.ravel(), b.ravel()], axis=1) for a, b in pairs]
+        )
+        self.restLengths = self.getSpringLengths()  # 自然長
 
         # 固定点の指定
-        self.points[0][0].bFixed = True
-        self.points[POINT_NUM - 1][0].bFixed = True
+        self.fixed[index[0, 0]] = True
+        self.fixed[index[pointNum - 1, 0]] = True
 
+        self.previousPositions = None  # 1ステップ前の位置 (ベルレ法で使う)
+        self.springColors = None  # 質点を共有しないバネのグループ (XPBD で使う)
+        self.partitions = None  # 領域ごとに分けたバネ (並列計算で使う)
+        self.executor = None  # 並列計算のスレッドプール
+        self.executorWorkers = 0  # executor のスレッド数
+        self.stepCount = 0  # これまでに進めたステップ数
+        self.triangleIndex = None  # 描画用の三角形の頂点番号
+        self.buffers = None  # 描画用の頂点・法線・インデックスのバッファ
+        self.pointViews = None
+        self.springViews = None
+
+    # 質点のビュー。points[x][y] で質点 (x, y) を表す
+    @property
+    def points(self):
+        if self.pointViews is None:
+            n = self.pointNum
+            self.pointViews = [
+                [Point(self, x * n + y) for y in range(n)] for x in range(n)
+            ]
+        return self.pointViews
+
+    # バネのビューのリスト
+    @property
+    def springs(self) -> list[Spring]:
+        if self.springViews is None:
+            self.springViews = [
+                Spring.fromCloth(self, k) for k in range(len(self.springIndex))
+            ]
+        return self.springViews
+
+    # 状態 (位置・速度・固定点・バネ・ステップ数) を path の .npz に保存する
+    # loadSnapshot でメモリに割り当てられるように、圧縮はしない
+    def saveSnapshot(self, path):
+        arrays = {
+            "pointNum": np.int64(self.pointNum),
+            "step": np.int64(self.stepCount),
+            "positions": self.positions,
+            "velocities": self.velocities,
+            "fixed": self.fixed,
+            "springIndex": self.springIndex.astype(np.int32),
+            "restLengths": self.restLengths,
+        }
+        if self.previousPositions is not None:
+            arrays["previousPositions"] = self.previousPositions
+        np.savez(path, **arrays)
+
+    # saveSnapshot で保存した状態から布を作る。時間刻みなどのパラメータは保存していない
+    @classmethod
+    def fromSnapshot(cls, path, mmap=True):
+        data = loadSnapshot(path, mmap)
+        cloth = cls(int(data["pointNum"]))
+        cloth.stepCount = int(data["step"])
+        cloth.positions[:] = data["positions"]
+        cloth.velocities[:] = data["velocities"]
+        cloth.fixed[:] = data["fixed"]
+        cloth.springIndex = np.array(data["springIndex"], dtype=np.int64)
+        cloth.restLengths = np.array(data["restLengths"])
+        if "previousPositions" in data:
+            cloth.previousPositions = np.array(data["previousPositions"])
+        return cloth
+
+    # 位置と速度のハッシュ値。実行結果がビット単位で一致するかを比べるのに使う
+    def getStateHash(self):
+        digest = hashlib.sha1(self.positions.tobytes())
+        digest.update(self.velocities.tobytes())
+        return digest.hexdigest()[:16]
+
+    # 各バネの現在の長さ
+    def getSpringLengths(self):
+        i, j = self.springIndex.T
+        return np.linalg.norm(self.positions[j] - self.positions[i], axis=1)
+
+    # 全ての質点に働く力 (重力とバネの力) を forces に計算する
+    # バネの力は getPartitions の帯ごとのバッファに計算し、帯の順番に足し合わせる
+    # g_NumWorkers が 1 以上なら、帯をその数のスレッドで計算する (NumPy の配列演算は GIL を解放する)
+    # 帯の分け方と足し合わせる順番はスレッド数によらないので、
+    # スレッドを使わない場合も含めて、スレッド数を変えても結果は全く同じになる
+    def computeForces(self):
+        partitions = self.getPartitions(g_NumPartitions)
+        if g_NumWorkers > 0:
+            executor = self.getExecutor(g_NumWorkers)
+            buffers = list(executor.map(self.getPartitionForces, partitions))
+        else:
+            buffers = [self.getPartitionForces(partition) for partition in partitions]
+
+        self.forces[:] = 0.0
+        self.forces[~self.fixed] += g_Gravity * g_Mass
+        for (_, _, _, lo, hi), buffer in zip(partitions, buffers):
+            self.forces[lo:hi] += buffer
+
+    # 質点の格子を x 方向に numPartitions 個の帯に分け、p0 が各帯に入るバネをまとめる
+    # 帯ごとに (バネの番号, p0, p1 の番号, 力を足し込む質点の範囲 lo, hi) を返す
+    # p0, p1 の番号は lo を引いた、範囲内での番号にしてある
+    # 自然長は変わることがあるので、ここでは持たずに力を計算するときに restLengths から読む
+    def getPartitions(self, numPartitions):
+        if self.partitions is None or len(self.partitions) != numPartitions:
+            n = self.pointNum
+            bounds = np.linspace(0, n, numPartitions + 1).astype(np.int64)
+            owner = np.searchsorted(bounds, self.springIndex[:, 0] // n, side="right")
+            self.partitions = []
+            for k in range(numPartitions):
+                springs = np.flatnonzero(owner - 1 == k)
+                # バネは隣の列の質点ともつながるので、前後1列ずつ広げた範囲に足し込む
+                lo = max(bounds[k] - 1, 0) * n
+                hi = min(bounds[k + 1] + 1, n) * n
+                i, j = self.springIndex[springs].T
+                self.partitions.append((springs, i - lo, j - lo, lo, hi))
+        return self.partitions
+
+    # getPartitions の帯 partition のバネの力を、帯の質点の範囲 lo から hi の (hi - lo, 3) の配列で返す
+    def getPartitionForces(self, partition):
+        springs, i, j, lo, hi = partition
+        return getSpringForces(
+            self.positions[lo:hi], i, j, self.restLengths[springs], hi - lo
+        )
+
+    # numWorkers 個のスレッドのスレッドプールを返す (スレッド数が変わったときだけ作り直す)
+    def getExecutor(self, numWorkers):
+        if self.executor is None or self.executorWorkers != numWorkers:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.executor = ThreadPoolExecutor(numWorkers)
+            self.executorWorkers = numWorkers
+        return self.executor
+
+    # 1ステップ進める。時間積分の方法は g_Integrator で選ぶ
+    # 積分の後、g_Obstacles の障害物と (g_SelfCollision なら) 布自身との衝突を処理する
     def update(self):
-        for y in range(POINT_NUM):
-            for x in range(POINT_NUM):
-                self.points[x][y].f = vec3(0, 0, 0)
-
-        for y in range(POINT_NUM):
-            for x in range(POINT_NUM):
-                if not self.points[x][y].bFixed:
-                    self.points[x][y].f += g_Gravity * g_Mass
-
-        for s in self.springs:
-            p0 = s.p0
-            p1 = s.p1
-            v = p1.p - p0.p
-            l = length(v)
-            if l > 0:
-                direction = v / l
-                force_magnitude = g_Ks * (l - s.restLength)
-                force = force_magnitude * direction
-                p0.f += force
-                p1.f -= force
-
-        for y in range(POINT_NUM):
-            for x in range(POINT_NUM):
-                p = self.points[x][y]
-                if not p.bFixed:
-                    p.f -= g_Dk * p.v
-
-                    acceleration = p.f / g_Mass
-                    p.v += acceleration * g_dT
-                    p.p += p.v * g_dT
+        self.stepCount += 1
+        if g_Integrator == "verlet":
+            self.stepVerlet(g_dT)
+        elif g_Integrator == "backward":
+            self.stepBackwardEuler(g_dT)
+        elif g_Integrator == "xpbd":
+            self.stepXPBD(g_dT, g_Compliance, g_XPBDIterations)
+        else:
+            self.stepSymplecticEuler(g_dT)
 
-    def draw(self):
-        glColor3f(0.0, 0.0, 0.0)
-        glBegin(GL_LINES)
-        for spring in self.springs:
-            glVertex3dv(spring.p0.p)
-            glVertex3dv(spring.p1.p)
-        glEnd()
+        moved = self.collideObstacles(g_Obstacles, g_Thickness, g_Friction)
+        if g_SelfCollision:
+            moved |= self.collideSelf(g_CollisionDistance)
+        if self.previousPositions is not None:
+            # ベルレ法の1ステップ前の位置を、衝突後の速度に合わせる
+            self.previousPositions[moved] = (
+                self.positions[moved] - self.velocities[moved] * g_dT
+            )
 
-        glColor3f(1.0, 0.0, 0.0)
-        glPointSize(4.0)
-        glBegin(GL_POINTS)
-        for y in range(POINT_NUM):
-            for x in range(POINT_NUM):
-                glVertex3dv(self.points[x][y].p)
-        glEnd()
+    # 障害物に入り込んだ質点を表面 (から thickness 離れた位置) まで押し出し、
+    # 速度の障害物に向かう成分を取り除いて、接線方向の成分を friction の割合だけ減らす
+    # 押し出した質点のマスクを返す
+    def collideObstacles(self, obstacles, thickness, friction):
+        moved = np.zeros(len(self.positions), dtype=bool)
+        for obstacle in obstacles:
+            depth, normal = obstacle.getPenetration(self.positions, thickness)
+            hit = np.flatnonzero((depth > 0) & ~self.fixed)
+            if len(hit) == 0:
+                continue
+            n = normal[hit]
+            self.positions[hit] += n * depth[hit, None]
+            v = self.velocities[hit]
+            vn = np.einsum("ij,ij->i", v, n)
+            tangent = v - n * vn[:, None]
+            self.velocities[hit] = (1.0 - friction) * tangent + n * np.maximum(vn, 0.0)[
+                :, None
+            ]
+            moved[hit] = True
+        return moved
+
+    # 距離が distance 未満に近づいた質点の組を空間ハッシュで探し、distance まで引き離して
+    # 互いに近づく向きの相対速度を取り除く。バネでつながった隣の質点同士は除く
+    # 1つの質点が複数の組に入るときは、修正量を組の数で平均する。動かした質点のマスクを返す
+    def collideSelf(self, distance):
+        n = len(self.positions)
+        a, b = findClosePairs(self.positions, distance)
+        m = self.pointNum
+        neighbor = (np.abs(a // m - b // m) <= 1) & (np.abs(a % m - b % m) <= 1)
+        a, b = a[~neighbor], b[~neighbor]
+        w = np.where(self.fixed, 0.0, 1.0)  # 固定点は動かさない
+        wSum = w[a] + w[b]
+        valid = wSum > 0
+        a, b, wSum = a[valid], b[valid], wSum[valid]
+        moved = np.zeros(n, dtype=bool)
+        if len(a) == 0:
+            return moved
+
+        d = self.positions[b] - self.positions[a]
+        l = np.linalg.norm(d, axis=1)
+        normal = d / np.where(l > 0, l, 1.0)[:, None]
+        correction = normal * ((distance - l) / wSum)[:, None]
+        vn = np.einsum("ij,ij->i", self.velocities[b] - self.velocities[a], normal)
+        impulse = normal * (np.minimum(vn, 0.0) / wSum)[:, None]
+
+        target = np.concatenate([a, b])
+        weights = np.concatenate([-w[a], w[b]])[:, None]
+        count = np.bincount(target, minlength=n)
+        scale = 1.0 / np.maximum(count, 1)[:, None]
+        self.positions += (
+            scatterRows(target, weights * np.concatenate([correction, correction]), n)
+            * scale
+        )
+        self.velocities -= (
+            scatterRows(target, weights * np.concatenate([impulse, impulse]), n) * scale
+        )
+        moved[target] = True
+        return moved
+
+    # 半陰的 (シンプレクティック) オイラー法。速度を更新してから、新しい速度で位置を更新する
+    def stepSymplecticEuler(self, dt):
+        self.previousPositions = None
+        self.computeForces()
+
+        free = ~self.fixed
+        self.forces[free] -= g_Dk * self.velocities[free]
+
+        acceleration = self.forces[free] / g_Mass
+        self.velocities[free] += acceleration * dt
+        self.positions[free] += self.velocities[free] * dt
+
+    # 位置ベルレ法。x(t + dt) = 2x(t) - x(t - dt) + a dt^2 で位置を更新し、
+    # 速度は位置の差分から求める
+    def stepVerlet(self, dt):
+        if self.previousPositions is None:
+            self.previousPositions = self.positions - self.velocities * dt
+        self.computeForces()
+
+        free = ~self.fixed
+        self.forces[free] -= g_Dk * self.velocities[free]
+
+        acceleration = self.forces[free] / g_Mass
+        current = self.positions[free]
+        nextPositions = (
+            2.0 * current - self.previousPositions[free] + acceleration * dt * dt
+        )
+        self.previousPositions[free] = current
+        self.positions[free] = nextPositions
+        self.velocities[free] = (nextPositions - current) / dt
+
+    # バネの力の位置についてのヤコビアン ∂f/∂x を、バネごとの 3x3 ブロック K で返す
+    # バネ (i, j) について ∂f_i/∂x_j = ∂f_j/∂x_i = K, ∂f_i/∂x_i = ∂f_j/∂x_j = -K となる
+    # 縮んでいるバネの (1 - 自然長/長さ) の項は 0 に切り詰めて、連立方程式を正定値に保つ
+    def getSpringJacobian(self):
+        i, j = self.springIndex.T
+        d = self.positions[j] - self.positions[i]
+        l = np.linalg.norm(d, axis=1)
+        u = d / np.where(l > 0, l, 1.0)[:, None]
+        uu = u[:, :, None] * u[:, None, :]
+        stretch = np.maximum(1.0 - self.restLengths / np.where(l > 0, l, 1.0), 0.0)
+        return g_Ks * (uu + stretch[:, None, None] * (np.eye(3) - uu))
+
+    # ヤコビアン K とベクトル x (N, 3) の積 (∂f/∂x) x を計算する
+    def multiplyJacobian(self, K, x):
+        i, j = self.springIndex.T
+        y = np.einsum("sab,sb->sa", K, x[j] - x[i])
+        result = np.empty_like(x)
+        target = np.concatenate([i, j])
+        for k in range(3):
+            weights = np.concatenate([y[:, k], -y[:, k]])
+            result[:, k] = np.bincount(target, weights, minlength=len(x))
+        return result
+
+    # 後退オイラー法 (Baraff & Witkin)。力を1次近似して
+    # (M + dt Dk - dt^2 ∂f/∂x) Δv = dt (f + dt (∂f/∂x) v)
+    # を共役勾配法で解く。固定点の Δv は 0 に拘束する
+    def stepBackwardEuler(self, dt, tolerance=1.0e-8, maxIterations=200):
+        self.previousPositions = None
+        self.computeForces()
+
+        free = ~self.fixed
+        self.forces[free] -= g_Dk * self.velocities[free]
+
+        K = self.getSpringJacobian()
+        mask = free[:, None].astype(np.float64)
+        diagonal = g_Mass + dt * g_Dk
+
+        def multiplyA(x):
+            return (diagonal * x - dt * dt * self.multiplyJacobian(K, x)) * mask
+
+        b = dt * (self.forces + dt * self.multiplyJacobian(K, self.velocities)) * mask
+        dv = conjugateGradient(multiplyA, b, tolerance, maxIterations)
+
+        self.velocities[free] += dv[free]
+        self.positions[free] += self.velocities[free] * dt
+
+    # バネを、同じ質点を共有しないグループ (色) に分ける (貪欲法による辺彩色)
+    # 同じ色のバネは互いに独立なので、XPBD で1色分をまとめて配列演算で処理できる
+    # 色ごとに (バネの番号, 質点0の番号, 質点1の番号) の配列の組のリストを返す
+    # (自然長は変わることがあるので、ここでは持たずに使うときに restLengths から読む)
+    def getSpringColors(self):
+        if self.springColors is None:
+            used = [0] * len(self.positions)  # 質点ごとに使用済みの色をビットで持つ
+            colors = np.empty(len(self.springIndex), dtype=np.int64)
+            for k, (i, j) in enumerate(self.springIndex.tolist()):
+                mask = used[i] | used[j]
+                c = (~mask & (mask + 1)).bit_length() - 1  # 使われていない最小の色
+                colors[k] = c
+                used[i] |= 1 << c
+                used[j] |= 1 << c
+            self.springColors = []
+            for c in range(colors.max() + 1):
+                springs = np.flatnonzero(colors == c)
+                i, j = self.springIndex[springs].T
+                self.springColors.append((springs, i, j))
+        return self.springColors
+
+    # XPBD (拡張位置ベース法)。各バネを、コンプライアンス compliance (バネ定数の逆数) を持つ
+    # 距離拘束として扱い、色ごとにまとめて iterations 回射影する
+    # 固定点は質量無限大 (質量の逆数 0) の質点として扱う
+    def stepXPBD(self, dt, compliance=0.0, iterations=10):
+        self.previousPositions = None
+        free = ~self.fixed
+        w = np.where(free, 1.0 / g_Mass, 0.0)  # 質量の逆数
+
+        # 重力と空気抵抗で速度を更新し、位置を予測する
+        self.velocities[free] += (
+            g_Gravity - g_Dk * self.velocities[free] / g_Mass
+        ) * dt
+        predicted = self.positions + self.velocities * dt * free[:, None]
+
+        alpha = compliance / (dt * dt)
+        batches = []  # 色ごとに反復の間変わらない値をまとめておく
+        for springs, i, j in self.getSpringColors():
+            restLengths = self.restLengths[springs]
+            # 同じ色のバネは質点を共有しないので、両端の番号 ij に重複はない
+            ij = np.concatenate([i, j])
+            wSum = w[i] + w[j] + alpha
+            wInv = np.divide(1.0, wSum, out=np.zeros_like(wSum), where=wSum > 0)
+            weights = np.concatenate([w[i], -w[j]])[:, None]
+            lambdas = np.zeros(len(springs))
+            batches.append((ij, restLengths, wInv, weights, lambdas))
+
+        for _ in range(iterations):
+            for ij, restLengths, wInv, weights, lambdas in batches:
+                p = predicted[ij].reshape(2, -1, 3)
+                d = p[0] - p[1]
+                l = np.sqrt(np.einsum("ij,ij->i", d, d))
+                dLambda = (restLengths - l - alpha * lambdas) * wInv
+                lambdas += dLambda
+                n = d * (dLambda / np.where(l > 0, l, 1.0))[:, None]
+                predicted[ij] += weights * np.concatenate([n, n])
+
+        self.velocities[free] = (predicted[free] - self.positions[free]) / dt
+        self.positions[free] = predicted[free]
+
+    # 描画用の三角形の頂点番号 (格子の1マスを2つの三角形に分ける)
+    def getTriangleIndex(self):
+        if self.triangleIndex is None:
+            n = self.pointNum
+            index = np.arange(n * n).reshape(n, n)
+            a, b = index[:-1, :-1], index[1:, :-1]
+            c, d = index[1:, 1:], index[:-1, 1:]
+            self.triangleIndex = np.concatenate(
+                [
+                    np.stack([a, b, c], axis=-1).reshape(-1, 3),
+                    np.stack([a, c, d], axis=-1).reshape(-1, 3),
+                ]
+            ).astype(np.uint32)
+        return self.triangleIndex
+
+    # 各質点の単位法線ベクトル。周りの三角形の法線を面積で重み付けして足し合わせる
+    def getVertexNormals(self):
+        triangles = self.getTriangleIndex()
+        p0, p1, p2 = (self.positions[triangles[:, k]] for k in range(3))
+        faceNormals = np.cross(p1 - p0, p2 - p0)  # 長さは三角形の面積の2倍
+        normals = scatterRows(
+            triangles.ravel(), np.repeat(faceNormals, 3, axis=0), len(self.positions)
+        )
+        l = np.linalg.norm(normals, axis=1)
+        return normals / np.where(l > 0, l, 1.0)[:, None]
+
+    # 描画用のバッファを作る。インデックスは変わらないので最初に1回だけ転送しておく
+    # 頂点バッファオブジェクトが使えない環境では、クライアント側の配列をそのまま使う
+    def initBuffers(self):
+        lines = self.springIndex.astype(np.uint32)
+        triangles = self.getTriangleIndex()
+        if not bool(glGenBuffers):
+            self.buffers = {"lines": lines, "triangles": triangles}
+            return
+
+        vertex, normal, lineBuffer, triangleBuffer = glGenBuffers(4)
+        size = len(self.positions) * 3 * 4  # float32 の (N, 3) 配列の大きさ
+        for buffer in [vertex, normal]:
+            glBindBuffer(GL_ARRAY_BUFFER, buffer)
+            glBufferData(GL_ARRAY_BUFFER, size, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        for buffer, index in [(lineBuffer, lines), (triangleBuffer, triangles)]:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, buffer)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, index.nbytes, index, GL_STATIC_DRAW)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        self.buffers = {
+            "vertex": vertex,
+            "normal": normal,
+            "lines": lineBuffer,
+            "triangles": triangleBuffer,
+            "linesCount": lines.size,
+            "trianglesCount": triangles.size,
+        }
+
+    # (N, 3) の配列 values を頂点バッファ name に転送し、glVertexPointer などに渡す値を返す
+    # バッファを使わない場合は float32 の配列をそのまま返す
+    def uploadArray(self, name, values):
+        data = np.ascontiguousarray(values, dtype=np.float32)
+        if name not in self.buffers:
+            return data
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[name])
+        glBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data)
+        return None
+
+    # インデックス name の要素で primitive を1回の glDrawElements で描く
+    def drawElements(self, primitive, name):
+        index = self.buffers[name]
+        if isinstance(index, np.ndarray):
+            glDrawElements(primitive, index.size, GL_UNSIGNED_INT, index)
+        else:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index)
+            glDrawElements(
+                primitive, self.buffers[name + "Count"], GL_UNSIGNED_INT, None
+            )
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    # 布を描く。位置はフレームごとに1回だけバッファに転送し、
+    # バネは glDrawElements(GL_LINES)、質点は glDrawArrays(GL_POINTS) でまとめて描く
+    # mesh が True なら、頂点の法線を使って陰影を付けた三角形のメッシュとして描く
+    def draw(self, mesh=False):
+        if self.buffers is None:
+            self.initBuffers()
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, self.uploadArray("vertex", self.positions))
+        if mesh:
+            glEnableClientState(GL_NORMAL_ARRAY)
+            glNormalPointer(
+                GL_FLOAT, 0, self.uploadArray("normal", self.getVertexNormals())
+            )
+            glEnable(GL_LIGHTING)
+            glDisable(GL_CULL_FACE)
+            glColor3f(0.9, 0.3, 0.2)
+            self.drawElements(GL_TRIANGLES, "triangles")
+            glEnable(GL_CULL_FACE)
+            glDisable(GL_LIGHTING)
+            glDisableClientState(GL_NORMAL_ARRAY)
+        else:
+            glColor3f(0.0, 0.0, 0.0)
+            self.drawElements(GL_LINES, "lines")
+            glColor3f(1.0, 0.0, 0.0)
+            glPointSize(4.0)
+            glDrawArrays(GL_POINTS, 0, len(self.positions))
+        glDisableClientState(GL_VERTEX_ARRAY)
+        if "vertex" in self.buffers:
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
 
 
 g_WindowID = 0  # ウィンドウ識別子
@@ -148,6 +767,207 @@ g_Mass = 30.0  # 質点の質量
 g_dT = 1.0  # 時間刻み幅
 g_Dk = 0.1  # 空気抵抗係数
 g_Gravity = vec3(0, -0.002, 0)  # 重力加速度
+g_Integrator = "symplectic"  # 時間積分の方法 (INTEGRATORS のどれか)
+g_Compliance = 0.0  # XPBD のバネのコンプライアンス (バネ定数の逆数。0 なら伸びない)
+g_XPBDIterations = 10  # XPBD の1ステップあたりの拘束の射影の反復回数
+g_NumWorkers = 0  # バネの力を領域に分けて計算するスレッド数 (0 なら分けない)
+g_NumPartitions = 8  # 並列計算でバネを分ける領域の数 (スレッド数によらず一定)
+g_Obstacles = []  # 布と衝突する障害物 (Sphere, Board) のリスト
+g_Thickness = 0.2  # 障害物の表面から質点までの最小の距離
+g_Friction = 0.1  # 障害物との接触で接線方向の速度を減らす割合
+g_SelfCollision = False  # 布自身との衝突を処理するかどうか
+g_DrawMesh = False  # 布を陰影を付けた三角形のメッシュで描くかどうか
+g_StepsPerSecond = 100  # 実時間1秒あたりのシミュレーションのステップ数
+g_Loop = None  # シミュレーションループ (FixedStepLoop)
+g_CollisionDistance = 0.8  # 布自身との衝突で質点同士を離しておく距離
+
+# 使える時間積分の方法 ("xpbd" はバネを距離拘束として解く位置ベース法)
+INTEGRATORS = ["symplectic", "verlet", "backward", "xpbd"]
+
+
+# 時間積分の方法ごとに、時間 span だけシミュレーションするのにかかる時間を比べる
+# 各方法で発散しない (全ての値が有限で、バネの伸びが自然長の2倍未満) 最大の時間刻みを
+# dtList から大きい順に探し、その時間刻みでの実行時間を表示する
+def benchmarkIntegrators(pointNum=20, ks=100.0, span=400.0, dtList=None):
+    global g_Integrator, g_dT, g_Ks
+    if dtList is None:
+        dtList = [1 / 16, 1 / 8, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0]
+    saved = (g_Integrator, g_dT, g_Ks)
+    g_Ks = ks
+    print(f"points={pointNum}x{pointNum} Ks={ks} span={span}")
+    print(f"{'integrator':>12} {'dt':>8} {'steps':>6} {'time[s]':>8}")
+    try:
+        for integrator in INTEGRATORS:
+            g_Integrator = integrator
+            result = None
+            for dt in sorted(dtList, reverse=True):
+                g_dT = dt
+                cloth = Cloth(pointNum)
+                steps = int(round(span / dt))
+                stable = True
+                start = time.perf_counter()
+                with np.errstate(all="ignore"):
+                    for step in range(steps):
+                        cloth.update()
+                        if step % 10 == 0 and not np.isfinite(cloth.positions).all():
+                            stable = False  # 発散したら打ち切る
+                            break
+                    elapsed = time.perf_counter() - start
+                    strain = cloth.getSpringLengths() / cloth.restLengths
+                if stable and np.isfinite(cloth.positions).all() and strain.max() < 2.0:
+                    result = (dt, steps, elapsed)
+                    break
+            if result is None:
+                print(f"{integrator:>12} {'unstable':>8}")
+            else:
+                print(
+                    f"{integrator:>12} {result[0]:8g} {result[1]:6d} {result[2]:8.3f}"
+                )
+    finally:
+        g_Integrator, g_dT, g_Ks = saved
+
+
+# バネの力の計算に使うスレッド数ごとに、1秒あたりのステップ数を比べる (0 はスレッドを使わない場合)
+# 結果がスレッドを使わない場合とビット単位で一致するかも表示する
+def benchmarkWorkers(pointNum=200, steps=50, workerList=(0, 1, 2, 4, 8)):
+    global g_NumWorkers
+    saved = g_NumWorkers
+    print(f"points={pointNum}x{pointNum} steps={steps} partitions={g_NumPartitions}")
+    print(f"{'workers':>8} {'steps/s':>8} {'speedup':>8} {'same':>5}")
+    try:
+        reference = None
+        baseTime = None
+        for workers in workerList:
+            g_NumWorkers = workers
+            cloth = Cloth(pointNum)
+            start = time.perf_counter()
+            for _ in range(steps):
+                cloth.update()
+            elapsed = time.perf_counter() - start
+            if cloth.executor is not None:
+                cloth.executor.shutdown()
+            if reference is None:
+                reference = cloth.positions.copy()
+                baseTime = elapsed
+            same = np.array_equal(cloth.positions, reference)
+            print(
+                f"{workers:>8} {steps / elapsed:8.1f} {baseTime / elapsed:8.2f}"
+                f" {str(same):>5}"
+            )
+    finally:
+        g_NumWorkers = saved
+
+
+# プロセスのメモリの最大使用量 (resource が使えない Windows では n/a)
+def getPeakMemory():
+    try:
+        import resource
+    except ImportError:
+        return "n/a"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB 単位、macOS はバイト単位
+    if sys.platform == "darwin":
+        peak /= 1024
+    return f"{peak / 1024:.0f} MB"
+
+
+# OpenGL を使わずに布を steps ステップ進め、1秒あたりのステップ数とメモリの最大使用量を表示する
+# (tracemalloc は計測を遅くするので、メモリはプロセス全体の最大使用量で見る)
+# restore が指定されればその状態から再開し、save が指定されれば最後の状態を保存する
+def runHeadless(pointNum, steps, restore=None, save=None):
+    cloth = Cloth.fromSnapshot(restore) if restore else Cloth(pointNum)
+    firstStep = cloth.stepCount
+    start = time.perf_counter()
+    for _ in range(steps):
+        cloth.update()
+    elapsed = time.perf_counter() - start
+    if cloth.executor is not None:
+        cloth.executor.shutdown()
+
+    print(
+        f"points={cloth.pointNum}x{cloth.pointNum} integrator={g_Integrator}"
+        f" steps={firstStep}->{cloth.stepCount}"
+    )
+    print(f"time {elapsed:.3f} s, {steps / elapsed:.1f} steps/s")
+    print(f"peak memory {getPeakMemory()}")
+    print(f"state hash {cloth.getStateHash()}")
+    if save:
+        cloth.saveSnapshot(save)
+        print(f"saved {save}")
+
+
+# 2つのスナップショットの配列をメモリに割り当てて比べ、一致するかと最大の差を表示する
+def compareSnapshots(pathA, pathB):
+    a = loadSnapshot(pathA, mmap=True)
+    b = loadSnapshot(pathB, mmap=True)
+    identical = a.keys() == b.keys()
+    for name in sorted(a.keys() & b.keys()):
+        same = a[name].shape == b[name].shape and np.array_equal(a[name], b[name])
+        identical &= same
+        diff = ""
+        if not same and a[name].shape == b[name].shape and a[name].dtype.kind == "f":
+            diff = f" max diff {np.abs(a[name] - b[name]).max():.3e}"
+        print(f"{name:>18} {'same' if same else 'differ'}{diff}")
+    for name in sorted(a.keys() ^ b.keys()):
+        print(f"{name:>18} only in {pathA if name in a else pathB}")
+    print("identical" if identical else "different")
+    return identical
+
+
+# 布の中央の下に置く球と、布が垂れ下がった先の床を作る
+def makeObstacles(pointNum, sphere=True, board=True):
+    obstacles = []
+    if sphere:
+        center = vec3(-0.5, pointNum / 4, -(pointNum - 1) / 2)
+        obstacles.append(Sphere(center, pointNum / 5, vec3(0.2, 0.4, 0.8)))
+    if board:
+        obstacles.append(Board(-pointNum / 4))
+    return obstacles
+
+
+# 質点の数を増やしながら、布自身との衝突処理の1ステップあたりの時間を測る
+# 衝突が多く起きるように、布を縮めて乱数で揺らした状態から始める
+# 空間ハッシュで探した組が全ての組を調べた結果と一致するかも (bruteForceLimit 点以下で) 確かめる
+def benchmarkCollision(pointNumList=(20, 40, 80, 160), steps=20, bruteForceLimit=2000):
+    global g_Obstacles, g_SelfCollision
+    saved = (g_Obstacles, g_SelfCollision)
+    print(f"steps={steps} distance={g_CollisionDistance}")
+    print(
+        f"{'points':>8} {'N':>7} {'pairs':>7} {'step[ms]':>9} {'query[ms]':>10}"
+        f" {'us/point':>9} {'brute':>6}"
+    )
+    try:
+        for pointNum in pointNumList:
+            g_Obstacles = makeObstacles(pointNum)
+            g_SelfCollision = True
+            cloth = Cloth(pointNum)
+            rng = np.random.default_rng(0)
+            cloth.positions[:, [0, 2]] *= 0.6
+            cloth.positions += rng.normal(scale=0.3, size=cloth.positions.shape)
+            with np.errstate(all="ignore"):
+                start = time.perf_counter()
+                for _ in range(steps):
+                    cloth.update()
+                stepTime = (time.perf_counter() - start) / steps
+
+                start = time.perf_counter()
+                for _ in range(steps):
+                    a, b = findClosePairs(cloth.positions, g_CollisionDistance)
+                queryTime = (time.perf_counter() - start) / steps
+
+            n = len(cloth.positions)
+            brute = "-"
+            if n <= bruteForceLimit:
+                d = cloth.positions[None, :] - cloth.positions[:, None]
+                close = np.einsum("ijk,ijk->ij", d, d) < g_CollisionDistance**2
+                ba, bb = np.nonzero(np.triu(close, 1))
+                brute = str(np.array_equal(a, ba) and np.array_equal(b, bb))
+            print(
+                f"{pointNum:>8} {n:>7} {len(a):>7} {stepTime * 1e3:9.2f}"
+                f" {queryTime * 1e3:10.2f} {queryTime / n * 1e6:9.3f} {brute:>6}"
+            )
+    finally:
+        g_Obstacles, g_SelfCollision = saved
 
 
 def display():
@@ -159,8 +979,15 @@ def display():
     glRotated(g_RotateAngleV_deg, 1.0, 0.0, 0.0)
     glRotated(g_RotateAngleH_deg, 0.0, 1.0, 0.0)
 
-    g_Cloth.draw()
+    g_Cloth.draw(g_DrawMesh)
+    for obstacle in g_Obstacles:
+        if isinstance(obstacle, Board):
+            obstacle.draw(g_Cloth.pointNum)
+        else:
+            obstacle.draw()
 
+    if g_Loop is not None:
+        g_Loop.drawOverlay()
     glutSwapBuffers()
 
 
@@ -195,22 +1022,32 @@ def motion(x, y):
     glutPostRedisplay()
 
 
-def timer(value):
-    global g_bRunning
+# シミュレーションを1ステップ進める (g_Loop から呼ばれる)
+def stepSimulation(step):
     if g_bRunning:
         g_Cloth.update()
-    glutPostRedisplay()
-    glutTimerFunc(10, timer, 0)
 
 
 # キーが押されたときのイベント処理
 def keyboard(key, x, y):
-    global g_bRunning
+    global g_bRunning, g_Integrator, g_SelfCollision, g_DrawMesh
     if key in [b"q", b"Q", b"\x1b"]:
         glutDestroyWindow(g_WindowID)
         return
     elif key == b"a":  # a キーでアニメーションのオン/オフ
         g_bRunning = not g_bRunning
+    elif key == b"i":  # i キーで時間積分の方法を切り替える
+        g_Integrator = INTEGRATORS[
+            (INTEGRATORS.index(g_Integrator) + 1) % len(INTEGRATORS)
+        ]
+        print("integrator:", g_Integrator)
+    elif key == b"c":  # c キーで布自身との衝突のオン/オフ
+        g_SelfCollision = not g_SelfCollision
+        print("self collision:", g_SelfCollision)
+    elif key == b"m":  # m キーでバネの線と三角形のメッシュの表示を切り替える
+        g_DrawMesh = not g_DrawMesh
+    elif key == b"s":  # s キーで統計の表示のオン/オフ
+        g_Loop.showOverlay = not g_Loop.showOverlay
 
     glutPostRedisplay()
 
@@ -221,20 +1058,146 @@ def init():
     glEnable(GL_CULL_FACE)
     glEnable(GL_LIGHTING)
     glEnable(GL_LIGHT0)
+    glEnable(GL_COLOR_MATERIAL)  # メッシュの色を glColor で指定する
+    glLightModeli(GL_LIGHT_MODEL_TWO_SIDE, GL_TRUE)  # 布の裏側にも陰影を付ける
+
+
+# コマンドライン引数の解析
+def parseArgs(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--points", type=int, default=POINT_NUM, help="布の一辺の質点の数"
+    )
+    parser.add_argument(
+        "--integrator",
+        choices=INTEGRATORS,
+        default=g_Integrator,
+        help="時間積分の方法",
+    )
+    parser.add_argument("--dt", type=float, default=g_dT, help="時間刻み幅")
+    parser.add_argument("--ks", type=float, default=g_Ks, help="バネ定数")
+    parser.add_argument(
+        "--span", type=float, default=400.0, help="ベンチマークで進める時間"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=g_NumWorkers,
+        help="バネの力を計算するスレッド数 (0 なら領域に分けない)",
+    )
+    parser.add_argument(
+        "--bench-workers",
+        action="store_true",
+        help="スレッド数ごとの1秒あたりのステップ数を比べて終了する",
+    )
+    parser.add_argument(
+        "--sphere", action="store_true", help="布の下に球の障害物を置く"
+    )
+    parser.add_argument("--board", action="store_true", help="布の下に床を置く")
+    parser.add_argument(
+        "--self-collision", action="store_true", help="布自身との衝突を処理する"
+    )
+    parser.add_argument(
+        "--mesh", action="store_true", help="布を陰影を付けた三角形のメッシュで描く"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=g_StepsPerSecond,
+        help="実時間1秒あたりのシミュレーションのステップ数",
+    )
+    parser.add_argument(
+        "--max-substeps",
+        type=int,
+        default=8,
+        help="1フレームで進める最大のステップ数",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="フレームの統計を画面に表示する"
+    )
+    parser.add_argument(
+        "--trace", metavar="FILE", help="フレームの統計を CSV ファイルに書き出す"
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="ウィンドウを開かずに --steps ステップ進めて速さを表示する",
+    )
+    parser.add_argument(
+        "--steps", type=int, default=1000, help="--headless で進めるステップ数"
+    )
+    parser.add_argument(
+        "--save", metavar="FILE", help="--headless の最後の状態を .npz に保存する"
+    )
+    parser.add_argument(
+        "--restore", metavar="FILE", help="--headless を .npz の状態から再開する"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar="FILE",
+        help="2つのスナップショットを比べて終了する",
+    )
+    parser.add_argument(
+        "--bench-collision",
+        action="store_true",
+        help="質点の数ごとの衝突処理の時間を測って終了する",
+    )
+    parser.add_argument(
+        "--bench-integrators",
+        action="store_true",
+        help="時間積分の方法ごとの実行時間を比べて終了する",
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    args = parseArgs(sys.argv[1:])
+    g_Integrator = args.integrator
+    g_dT = args.dt
+    g_Ks = args.ks
+    g_NumWorkers = args.workers
+    g_Obstacles = makeObstacles(args.points, args.sphere, args.board)
+    g_SelfCollision = args.self_collision
+    g_DrawMesh = args.mesh
+    if args.compare:
+        sys.exit(0 if compareSnapshots(*args.compare) else 1)
+    if args.headless:
+        runHeadless(args.points, args.steps, args.restore, args.save)
+        sys.exit(0)
+    if args.bench_integrators:
+        benchmarkIntegrators(args.points, args.ks, args.span)
+        sys.exit(0)
+    if args.bench_workers:
+        benchmarkWorkers(args.points)
+        sys.exit(0)
+    if args.bench_collision:
+        benchmarkCollision()
+        sys.exit(0)
+
+    from OpenGL.GL import *
+    from OpenGL.GLU import *
+    from OpenGL.GLUT import *
+
+    from common.loop import FixedStepLoop, openTrace  # OpenGL を使うのでここで読み込む
+
+    g_Cloth = Cloth(args.points)
     glutInit(sys.argv)  # ライブラリの初期化
     glutInitWindowSize(600, 600)  # ウィンドウサイズを指定
     glutInitDisplayMode(
         GLUT_RGBA | GLUT_DEPTH | GLUT_DOUBLE
     )  # ディスプレイモードの設定
     g_WindowID = glutCreateWindow(sys.argv[0])  # ウィンドウを作成
-    glutDisplayFunc(display)  # 表示関数を指定
-    glutReshapeFunc(resize)  # ウィンドウサイズが変更されたときの関数を指定
-    glutKeyboardFunc(keyboard)  # キーボード関数を指定
-    glutMouseFunc(mouse)  # マウス関数を指定
-    glutMotionFunc(motion)  # マウスの動きを指定
-    timer(0)  # タイマー関数を指定
-    init()  # 初期設定を行う関数を指定
-    glutMainLoop()  # イベント待ち
+    with openTrace(args.trace) as traceFile:
+        g_Loop = FixedStepLoop(
+            stepSimulation, 1.0 / args.rate, args.max_substeps, traceFile=traceFile
+        )
+        g_Loop.showOverlay = args.stats
+        glutDisplayFunc(g_Loop.wrapDisplay(display))  # 表示関数を指定
+        glutReshapeFunc(resize)  # ウィンドウサイズが変更されたときの関数を指定
+        glutKeyboardFunc(keyboard)  # キーボード関数を指定
+        glutMouseFunc(mouse)  # マウス関数を指定
+        glutMotionFunc(motion)  # マウスの動きを指定
+        g_Loop.start()  # シミュレーションループを開始する
+        init()  # 初期設定を行う関数を指定
+        glutMainLoop()  # イベント待ち